@@ -0,0 +1,382 @@
+'''
+Benchmarks for tkfm: listing, rendering and navigation.
+
+    python bench.py                      # run, compare against bench_baseline.json
+    python bench.py --update-baseline    # run and store the results as baseline
+    python bench.py --sizes 10,1000 --no-ui
+
+Each tree runs in its own process so peak RSS is per tree. UI benchmarks
+need an X display; without $DISPLAY an Xvfb server is started if one is
+installed, otherwise they are skipped. Exits with 1 if a metric regressed
+past the baseline by more than --tolerance, and with 2 if there is no
+baseline to compare with. Baselines are machine specific: their python
+and platform are recorded and a mismatch is printed.
+'''
+from pathlib import Path
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import tkfm
+
+DEFAULT_SIZES = [10, 1000, 10000, 100000]
+DEFAULT_BASELINE = Path(__file__).with_name("bench_baseline.json")
+
+# fraction of generated entries that are hidden files / directories
+HIDDEN_RATIO = 0.1
+DIR_RATIO = 0.1
+# entries per directory in the deep trees
+DEEP_FANOUT = 100
+
+# timings below this many seconds are never reported as regressions
+NOISE_FLOOR = 0.002
+
+
+"""
+Synthetic trees
+"""
+
+def entry_names(count, rng):
+    names = []
+    for i in range(count):
+        name = "{}_{}{}".format(
+                rng.choice(["file", "img", "Report", "data", "x"]),
+                i,
+                rng.choice(["", ".txt", ".png", ".py", ".tar.gz"])
+                )
+        if rng.random() < HIDDEN_RATIO:
+            name = "." + name
+        names.append(name)
+    return names
+
+
+def make_flat(path, count, seed):
+    rng = random.Random(seed)
+    os.makedirs(path)
+    for name in entry_names(count, rng):
+        full = os.path.join(path, name)
+        if rng.random() < DIR_RATIO:
+            os.mkdir(full)
+        else:
+            with open(full, "wb") as f:
+                f.write(b"x" * rng.randrange(0, 4096))
+
+
+def make_deep(path, count, seed):
+    # count entries spread over nested directories, DEEP_FANOUT per level
+    rng = random.Random(seed)
+    os.makedirs(path)
+    dirs = [path]
+    made = 0
+    while made < count:
+        parent = dirs.pop(0)
+        for name in entry_names(min(DEEP_FANOUT, count - made), rng):
+            full = os.path.join(parent, name)
+            if rng.random() < DIR_RATIO * 2:
+                os.mkdir(full)
+                dirs.append(full)
+            else:
+                open(full, "wb").close()
+            made += 1
+        if not dirs:
+            dirs.append(parent)
+
+
+"""
+Measurements
+"""
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def tuple_list(path):
+    # the listing model before the columnar Listing, as a reference
+    entries = []
+    with os.scandir(path) as it:
+        for direntry in it:
+            kind = tkfm.FileType.DIRECTORY if direntry.is_dir() else tkfm.FileType.FILE
+            entries.append((direntry.name, kind))
+    return entries
+
+
+def peak_bytes(func):
+    # peak Python heap while func runs, its result included
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_core(path, repeat):
+    fm = tkfm.FileManager(None, Path(path))
+    results = {}
+
+    results["list_dir"] = best_of(fm.list_dir, repeat)
+    results["list_dir_hidden"] = best_of(lambda: tkfm.Listing.scan(path).visible(True), repeat)
+
+    listing = tkfm.Listing.scan(path)
+    order = tkfm.SortOrder(tkfm.SortKey.NAME)
+    results["sort_name"] = best_of(lambda: order.sort(listing, listing.visible(True)), repeat)
+    results["stat_calls_per_listing"] = listing.get_stats()["stat"]
+
+    # columnar Listing against a list of (name, FileType) tuples
+    results["listing_build"] = best_of(lambda: tkfm.Listing.scan(path), repeat)
+    results["tuple_list_build"] = best_of(lambda: tuple_list(path), repeat)
+    results["listing_peak_bytes"] = peak_bytes(lambda: tkfm.Listing.scan(path))
+    results["tuple_list_peak_bytes"] = peak_bytes(lambda: tuple_list(path))
+
+    def search():
+        index = tkfm.SearchIndex(path, show_hidden=True)
+        index.thread.join()
+    results["search_index"] = best_of(search, repeat)
+
+    results["dir_size"] = best_of(lambda: tkfm.DirSizer(path, tkfm.SizeMemo()).start().wait(), repeat)
+    results["find_duplicates"] = best_of(lambda: tkfm.DuplicateFinder(path).start().wait(), repeat)
+
+    # MetadataIndex: first write of a listing, then a revisit and a search
+    with tempfile.TemporaryDirectory(prefix="tkfm-index-") as tmp:
+        db = os.path.join(tmp, "index.sqlite3")
+        def index_write():
+            index = tkfm.MetadataIndex(db, max_dir_entries=len(listing))
+            index.put(listing)
+            index.flush()
+            index.close()
+            os.remove(index.path)
+        results["index_write"] = best_of(index_write, repeat)
+
+        index = tkfm.MetadataIndex(db, max_dir_entries=len(listing))
+        index.put(listing)
+        index.flush()
+        results["index_load"] = best_of(lambda: index.get(path), repeat)
+        results["index_search"] = best_of(lambda: index.search("report_1"), repeat)
+        index.close()
+    return results
+
+
+def wait_loaded(app):
+    while app.fm.loader is not None:
+        app.update()
+
+
+def bench_ui(path, repeat):
+    app = tkfm.Tkfm(path)
+    app.update()
+    wait_loaded(app)
+
+    fm = app.fm
+    frame = app.files_frame
+    canvas = app.files_frame_canvas
+    results = {}
+
+    # cold start of this process: constructor, first paint, first rows
+    for name, elapsed in app.startup.items():
+        results["startup_" + name] = elapsed
+
+    files = fm.list_dir()
+
+    def refresh():
+        frame.refresh(files)
+        app.update_idletasks()
+    results["files_frame_refresh"] = best_of(refresh, repeat)
+
+    parent = os.path.dirname(path)
+
+    def navigate():
+        fm.goto(parent)
+        wait_loaded(app)
+        app.update_idletasks()
+        fm.goto(path)
+        wait_loaded(app)
+        app.update_idletasks()
+    # first round fills the listing cache, like a user going back and forth
+    results["goto"] = best_of(navigate, repeat)
+
+    def back_up():
+        fm.up()
+        wait_loaded(app)
+        fm.back()
+        wait_loaded(app)
+        app.update_idletasks()
+    results["up_back"] = best_of(back_up, repeat)
+
+    steps = 50
+    def scroll():
+        for i in range(steps + 1):
+            canvas.yview_moveto(i / steps)
+            frame.update_visible()
+            app.update_idletasks()
+    results["scroll_50_steps"] = best_of(scroll, repeat)
+
+    def select():
+        frame.select_all()
+        app.update_idletasks()
+        frame.deselect_all()
+        app.update_idletasks()
+    results["select_all_clear"] = best_of(select, repeat)
+
+    # details view: every step of scroll() redraws a screen of cells
+    frame.set_details(True)
+    while fm.tasks_running:
+        app.update()
+    results["details_scroll_50_steps"] = best_of(scroll, repeat)
+
+    app.destroy()
+    return results
+
+
+def run_worker(tree, path, repeat, ui):
+    # runs in its own process, prints one JSON object
+    results = bench_core(path, repeat)
+    if ui:
+        results.update(bench_ui(path, repeat))
+    # ru_maxrss is KiB on Linux
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({tree: results}))
+
+
+"""
+Display
+"""
+
+def start_xvfb():
+    # returns the Xvfb process, or None if there is no way to get a display
+    if os.environ.get("DISPLAY"):
+        return None
+    xvfb = shutil.which("Xvfb")
+    if xvfb is None:
+        return None
+
+    display = ":{}".format(90 + os.getpid() % 100)
+    proc = subprocess.Popen([xvfb, display, "-screen", "0", "1024x768x24"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+    os.environ["DISPLAY"] = display
+    return proc
+
+
+"""
+Baseline
+"""
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for tree, metrics in results.items():
+        for name, value in metrics.items():
+            old = baseline.get(tree, {}).get(name)
+            if old is None:
+                continue
+            if name != "peak_rss_kb" and value < NOISE_FLOOR:
+                continue
+            if value > old * (1 + tolerance):
+                regressions.append((tree, name, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tkfm benchmarks")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before failing, 0.25 = 25%%")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--no-ui", action="store_true")
+    parser.add_argument("--worker", nargs=2, metavar=("TREE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker[0], args.worker[1], args.repeat, not args.no_ui)
+        return 0
+
+    xvfb = None
+    ui = not args.no_ui
+    if ui:
+        xvfb = start_xvfb()
+        if not os.environ.get("DISPLAY"):
+            print("No display and no Xvfb, skipping UI benchmarks")
+            ui = False
+
+    results = {}
+    tmp = tempfile.mkdtemp(prefix="tkfm-bench-")
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            for shape, make in (("flat", make_flat), ("deep", make_deep)):
+                tree = "{}_{}".format(shape, size)
+                path = os.path.join(tmp, tree)
+                make(path, size, args.seed)
+
+                cmd = [sys.executable, __file__, "--repeat", str(args.repeat), "--worker", tree, path]
+                if not ui:
+                    cmd.append("--no-ui")
+                out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+                # diagnostics and trace summaries go to stderr, stdout is the result
+                results.update(json.loads(out))
+                print(tree, json.dumps(results[tree]))
+
+                shutil.rmtree(path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if xvfb is not None:
+            xvfb.terminate()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "ui": ui,
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        # the report itself, so the baseline says where it was measured
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Baseline written to", args.baseline)
+        return 0
+
+    # a run that compares against nothing must not pass as "no regressions"
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, run with --update-baseline".format(args.baseline))
+        return 2
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    meta = baseline.get("meta", {})
+    for key in ("python", "platform"):
+        if meta.get(key) != report["meta"][key]:
+            print("Baseline {} is {}, this run is {}".format(key, meta.get(key), report["meta"][key]))
+
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for tree, name, old, new in regressions:
+        print("REGRESSION {} {}: {:.6g} -> {:.6g}".format(tree, name, old, new))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
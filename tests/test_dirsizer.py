@@ -0,0 +1,45 @@
+import os
+
+from tkfm import DirSizer, SizeMemo
+
+
+def write(path, size):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+def test_size_counts_hard_links_once(tmp_path):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    write(tmp_path / "one", 100)
+    write(tmp_path / "a" / "two", 20)
+    write(tmp_path / "a" / "b" / "three", 3)
+    os.link(tmp_path / "one", tmp_path / "a" / "link")
+    os.link(tmp_path / "one", tmp_path / "a" / "b" / "link")
+
+    sizer = DirSizer(str(tmp_path), SizeMemo()).start()
+    assert sizer.wait(10) == 123
+    assert sizer.errors == 0
+
+
+def test_memo_is_reused_and_bounded(tmp_path):
+    for i in range(5):
+        (tmp_path / str(i)).mkdir()
+        write(tmp_path / str(i) / "f", 10)
+
+    memo = SizeMemo()
+    assert DirSizer(str(tmp_path), memo).start().wait(10) == 50
+    assert len(memo) == 6
+    # a subdirectory is answered from the memo
+    assert DirSizer(str(tmp_path / "3"), memo).start().wait(10) == 10
+
+    small = SizeMemo(budget=2)
+    assert DirSizer(str(tmp_path), small).start().wait(10) == 50
+    assert len(small) == 2
+    assert small.evictions == 4
+
+
+def test_cancel(tmp_path):
+    sizer = DirSizer(str(tmp_path), SizeMemo())
+    sizer.cancel()
+    progress = sizer.progress()
+    assert progress["cancelled"] and progress["done"]
@@ -0,0 +1,45 @@
+from tkfm import DuplicateFinder
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def groups_of(finder):
+    assert finder.wait(10)
+    groups = []
+    while not finder.results.empty():
+        group = finder.results.get()
+        groups.append(sorted(finder.listing.name(i) for i in group))
+    return groups
+
+
+def test_finds_identical_files(tmp_path):
+    (tmp_path / "sub").mkdir()
+    big = b"a" * 100000
+    write(tmp_path / "big1", big)
+    write(tmp_path / "sub" / "big2", big)
+    # same size, same first and last block, different middle
+    write(tmp_path / "big3", big[:50000] + b"b" + big[50001:])
+    write(tmp_path / "small1", b"xyz")
+    write(tmp_path / "small2", b"xyz")
+    write(tmp_path / "other", b"abc")
+    write(tmp_path / "empty1", b"")
+    write(tmp_path / "empty2", b"")
+
+    finder = DuplicateFinder(str(tmp_path)).start()
+    groups = groups_of(finder)
+
+    assert sorted(groups) == [["big1", "sub/big2"], ["small1", "small2"]]
+    progress = finder.progress()
+    assert progress["groups"] == 2
+    assert progress["extra_bytes"] == 100000 + 3
+
+
+def test_hidden_files_are_skipped(tmp_path):
+    write(tmp_path / "a", b"same")
+    write(tmp_path / ".b", b"same")
+
+    assert groups_of(DuplicateFinder(str(tmp_path)).start()) == []
+    assert groups_of(DuplicateFinder(str(tmp_path), show_hidden=True).start()) == [[".b", "a"]]
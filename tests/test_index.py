@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from tkfm import FileType, Listing, MetadataIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = MetadataIndex(str(tmp_path / "index.sqlite3"))
+    yield index
+    index.close()
+
+
+def make_dir(tmp_path):
+    path = tmp_path / "dir"
+    (path / "sub").mkdir(parents=True)
+    (path / "report_1.txt").write_text("abc")
+    (path / "Report_2.txt").write_text("abcdef")
+    (path / ".hidden_report").write_text("")
+    return str(path)
+
+
+def test_put_and_get(tmp_path, index):
+    path = make_dir(tmp_path)
+    listing = Listing.scan(path)
+    listing.load_stats()
+    index.put(listing)
+    index.flush()
+
+    indexed = index.get(path)
+    entries = {indexed.name(i): (indexed.kind(i), indexed.sizes[i]) for i in range(len(indexed))}
+    assert entries["report_1.txt"] == (FileType.TEXT, 3)
+    assert entries["Report_2.txt"] == (FileType.TEXT, 6)
+    assert entries["sub"][0] == FileType.DIRECTORY
+    assert len(entries) == 4
+
+
+def test_get_misses_changed_and_unknown_directories(tmp_path, index):
+    path = make_dir(tmp_path)
+    index.put(Listing.scan(path))
+    index.flush()
+
+    assert index.get(str(tmp_path)) is None
+    # the directory mtime moves on
+    os.utime(path, ns=(0, 0))
+    assert index.get(path) is None
+
+
+def test_search(tmp_path, index):
+    path = make_dir(tmp_path)
+    index.put(Listing.scan(path))
+    index.flush()
+
+    found = index.search("REPORT")
+    names = sorted(found.name(i) for i in range(len(found)))
+    assert names == sorted(os.path.relpath(os.path.join(path, name), os.sep)
+                           for name in ("Report_2.txt", "report_1.txt"))
+
+    found = index.search("report", show_hidden=True)
+    assert len(found) == 3
+
+
+def test_large_directories_are_not_indexed(tmp_path):
+    index = MetadataIndex(str(tmp_path / "index.sqlite3"), max_dir_entries=2)
+    try:
+        path = make_dir(tmp_path)
+        index.put(Listing.scan(path))
+        index.flush()
+        assert index.get(path) is None
+    finally:
+        index.close()
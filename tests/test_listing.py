@@ -0,0 +1,107 @@
+import os
+
+from tkfm import FileType, Listing, SortKey, SortOrder
+
+
+def touch(path, size=0):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+def make_tree(tmp_path):
+    (tmp_path / "sub").mkdir()
+    touch(tmp_path / "file10.txt", 30)
+    touch(tmp_path / "file2.txt", 10)
+    touch(tmp_path / "b.png", 20)
+    touch(tmp_path / ".hidden")
+    return tmp_path
+
+
+def test_scan_reads_names_and_kinds(tmp_path):
+    listing = Listing.scan(str(make_tree(tmp_path)))
+
+    names = {listing.name(i): listing.kind(i) for i in range(len(listing))}
+    assert names == {
+        "sub": FileType.DIRECTORY,
+        "file10.txt": FileType.TEXT,
+        "file2.txt": FileType.TEXT,
+        "b.png": FileType.IMAGE,
+        ".hidden": FileType.FILE,
+    }
+    assert listing.scandir_calls == 1
+
+
+def test_visible_hides_dotfiles(tmp_path):
+    listing = Listing.scan(str(make_tree(tmp_path)))
+
+    assert len(listing.visible(True)) == 5
+    hidden = [listing.name(i) for i in listing.visible(False)]
+    assert ".hidden" not in hidden and len(hidden) == 4
+
+
+def test_sort_by_name_is_natural_with_directories_first(tmp_path):
+    listing = Listing.scan(str(make_tree(tmp_path)))
+
+    view = SortOrder(SortKey.NAME).sort(listing, listing.visible(False))
+    assert view.names() == ["sub", "b.png", "file2.txt", "file10.txt"]
+
+    view = SortOrder(SortKey.NAME, reverse=True).sort(listing, listing.visible(False))
+    assert view.names() == ["sub", "file10.txt", "file2.txt", "b.png"]
+
+
+def test_sort_by_size(tmp_path):
+    listing = Listing.scan(str(make_tree(tmp_path)))
+
+    view = SortOrder(SortKey.SIZE, dirs_first=False).sort(listing, listing.visible(False))
+    files = [name for name in view.names() if name != "sub"]
+    assert files == ["file2.txt", "b.png", "file10.txt"]
+
+
+def test_sort_order_insert_and_remove(tmp_path):
+    listing = Listing.scan(str(make_tree(tmp_path)))
+    order = SortOrder(SortKey.NAME)
+    view = listing.sorted_visible(order, False)
+
+    touch(tmp_path / "file3.txt")
+    order.insert(view, listing.entry_for("file3.txt"))
+    assert view.names() == ["sub", "b.png", "file2.txt", "file3.txt", "file10.txt"]
+
+    assert order.remove(view, listing.find("b.png"))
+    assert not order.remove(view, listing.find(".hidden"))
+    assert view.names() == ["sub", "file2.txt", "file3.txt", "file10.txt"]
+
+
+def test_update_name_updates_in_place(tmp_path):
+    listing = Listing.scan(str(make_tree(tmp_path)))
+    count = len(listing)
+
+    for size in (1, 2, 3):
+        touch(tmp_path / "b.png", size)
+        entry = listing.update_name(listing.find("b.png"), "b.png")
+    assert len(listing) == count
+    assert not listing.removed
+    assert entry.size == 3
+
+
+def test_update_name_kind_change_and_removal(tmp_path):
+    listing = Listing.scan(str(make_tree(tmp_path)))
+    old = listing.find("b.png")
+
+    os.remove(tmp_path / "b.png")
+    os.mkdir(tmp_path / "b.png")
+    entry = listing.update_name(old, "b.png")
+    assert entry.kind == FileType.DIRECTORY
+    assert old.index in listing.removed
+    assert listing.find("b.png") == entry
+
+    os.rmdir(tmp_path / "b.png")
+    assert listing.update_name(entry, "b.png") is None
+    assert listing.find("b.png") is None
+
+
+def test_update_name_new_file(tmp_path):
+    listing = Listing.scan(str(make_tree(tmp_path)))
+
+    touch(tmp_path / "new.txt", 5)
+    entry = listing.update_name(None, "new.txt")
+    assert entry.name == "new.txt" and entry.size == 5
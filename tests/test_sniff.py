@@ -0,0 +1,26 @@
+import pytest
+
+from tkfm import FileType, sniff_type
+
+
+@pytest.mark.parametrize("data, expected", [
+    (b"\x89PNG\r\n\x1a\n....", (FileType.IMAGE, ".png")),
+    (b"GIF89a", (FileType.IMAGE, ".gif")),
+    (b"%PDF-1.7", (FileType.DOCUMENT, ".pdf")),
+    (b"PK\x03\x04", (FileType.ARCHIVE, ".zip")),
+    (b"\0" * 257 + b"ustar", (FileType.ARCHIVE, ".tar")),
+    (b"RIFF\0\0\0\0WAVE", (FileType.AUDIO, ".wav")),
+    (b"\x7fELF\x02\x01", (FileType.EXECUTABLE, "")),
+    (b"#!/bin/sh\n", (FileType.EXECUTABLE, "")),
+    (b"plain text\n", (FileType.TEXT, ".txt")),
+    ("café".encode(), (FileType.TEXT, ".txt")),
+    (b"binary\0data", (FileType.FILE, "")),
+    (b"", (FileType.FILE, "")),
+])
+def test_sniff_type(data, expected):
+    assert sniff_type(data) == expected
+
+
+def test_cut_off_character_is_still_text():
+    data = ("x" * 10 + "€").encode()[:-1]
+    assert sniff_type(data) == (FileType.TEXT, ".txt")
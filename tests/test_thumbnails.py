@@ -0,0 +1,68 @@
+import struct
+
+import pytest
+
+from tkfm import png_chunk, read_png, read_pnm, write_png
+
+
+def rgba_rows(width, height):
+    return [bytes((x * 16 + y & 255, y * 16 & 255, 255 - x, 255)[c] for x in range(width) for c in range(4))
+            for y in range(height)]
+
+
+def test_png_roundtrip_full_size():
+    rows = rgba_rows(8, 6)
+    width, height, decoded = read_png(write_png(8, 6, rows, {}), 128)
+    assert (width, height) == (8, 6)
+    assert decoded == rows
+
+
+def test_png_downscaled():
+    width, height, rows = read_png(write_png(64, 32, rgba_rows(64, 32), {}), 16)
+    assert (width, height) == (64, 32)
+    assert len(rows) == 8
+    assert all(len(row) == 16 * 4 for row in rows)
+
+
+def test_png_split_and_truncated_idat():
+    rows = rgba_rows(8, 6)
+    png = write_png(8, 6, rows, {})
+    # one IDAT in many small chunks decodes the same
+    length = struct.unpack(">I", png[33:37])[0]
+    idat = png[41:41 + length]
+    split = png[:33] + b"".join(png_chunk(b"IDAT", idat[i:i + 7]) for i in range(0, len(idat), 7))
+    split += png_chunk(b"IEND", b"")
+    assert read_png(split, 128)[2] == rows
+
+    with pytest.raises(ValueError):
+        read_png(png[:33] + png_chunk(b"IDAT", idat[:len(idat) // 2]), 128)
+
+
+def test_png_too_large():
+    header = png_chunk(b"IHDR", struct.pack(">IIBBBBB", 20000, 20000, 8, 6, 0, 0, 0))
+    with pytest.raises(ValueError):
+        read_png(b"\x89PNG\r\n\x1a\n" + header + png_chunk(b"IEND", b""), 128)
+
+
+def test_png_rejects_other_data():
+    with pytest.raises(ValueError):
+        read_png(b"GIF89a", 128)
+
+
+def test_ppm():
+    data = b"P6\n# comment\n2 2\n255\n" + bytes([255, 0, 0, 0, 255, 0, 0, 0, 255, 10, 20, 30])
+    width, height, rows = read_pnm(data, 128)
+    assert (width, height) == (2, 2)
+    assert rows == [bytes([255, 0, 0, 255, 0, 255, 0, 255]),
+                    bytes([0, 0, 255, 255, 10, 20, 30, 255])]
+
+
+def test_pgm_with_maxval():
+    data = b"P5 2 1 15\n" + bytes([15, 0])
+    _, _, rows = read_pnm(data, 128)
+    assert rows == [bytes([255, 255, 255, 255, 0, 0, 0, 255])]
+
+
+def test_pnm_rejects_other_data():
+    with pytest.raises(ValueError):
+        read_pnm(b"P3\n1 1\n255\n0 0 0\n", 128)
@@ -0,0 +1,110 @@
+import os
+
+from tkfm import TransferJob, unique_path
+
+
+def write(path, data):
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def run(*args, **kwargs):
+    job = TransferJob(*args, **kwargs).start()
+    assert job.wait(10)
+    return job
+
+
+def test_unique_path(tmp_path):
+    path = str(tmp_path / "a.txt")
+    assert unique_path(path) == path
+
+    write(path, "")
+    assert unique_path(path) == str(tmp_path / "a (2).txt")
+    assert unique_path(path, {str(tmp_path / "a (2).txt")}) == str(tmp_path / "a (3).txt")
+
+
+def test_copy_keeps_existing_destination(tmp_path):
+    src = tmp_path / "src"
+    dest = tmp_path / "dest"
+    src.mkdir()
+    dest.mkdir()
+    write(src / "a", "new")
+    write(dest / "a", "old")
+
+    job = run([str(src / "a")], str(dest))
+    assert not job.errors
+    assert read(dest / "a") == "old"
+    assert read(dest / "a (2)") == "new"
+
+
+def test_same_named_sources_get_distinct_destinations(tmp_path):
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    sources = []
+    for parent in ("one", "two"):
+        (tmp_path / parent / "d").mkdir(parents=True)
+        write(tmp_path / parent / "d" / "f", parent)
+        write(tmp_path / parent / "a", parent)
+        sources += [str(tmp_path / parent / "a"), str(tmp_path / parent / "d")]
+
+    job = run(sources, str(dest))
+    assert not job.errors
+    assert sorted(os.listdir(dest)) == ["a", "a (2)", "d", "d (2)"]
+    assert {read(dest / "a"), read(dest / "a (2)")} == {"one", "two"}
+    assert {read(dest / "d" / "f"), read(dest / "d (2)" / "f")} == {"one", "two"}
+
+
+def test_move_with_taken_name_fails(tmp_path):
+    write(tmp_path / "a", "a")
+    write(tmp_path / "b", "b")
+
+    job = run([str(tmp_path / "a")], str(tmp_path), move=True, rename_to="b")
+    assert len(job.errors) == 1
+    assert isinstance(job.errors[0][1], FileExistsError)
+    assert read(tmp_path / "a") == "a"
+    assert read(tmp_path / "b") == "b"
+
+
+def test_move(tmp_path):
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    write(tmp_path / "a", "a")
+
+    job = run([str(tmp_path / "a")], str(dest), move=True)
+    assert not job.errors
+    assert job.created == ["a"]
+    assert not os.path.exists(tmp_path / "a")
+    assert read(dest / "a") == "a"
+
+
+def test_dry_run_copy_counts_without_copying(tmp_path):
+    src = tmp_path / "src"
+    dest = tmp_path / "dest"
+    (src / "d").mkdir(parents=True)
+    dest.mkdir()
+    write(src / "d" / "f", "12345")
+    write(src / "g", "123")
+
+    job = run([str(src / "d"), str(src / "g")], str(dest), dry_run=True)
+    progress = job.progress()
+    assert progress["files_total"] == 2
+    assert progress["bytes_total"] == 8
+    assert job.created == ["d", "g"]
+    assert os.listdir(dest) == []
+
+
+def test_dry_run_move_leaves_sources(tmp_path):
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    write(tmp_path / "a", "a")
+
+    job = run([str(tmp_path / "a")], str(dest), move=True, dry_run=True)
+    assert not job.errors
+    assert job.created == ["a"]
+    assert read(tmp_path / "a") == "a"
+    assert os.listdir(dest) == []
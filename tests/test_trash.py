@@ -0,0 +1,66 @@
+import os
+
+from tkfm import Trash
+
+
+def make_files(tmp_path, names):
+    src = tmp_path / "src"
+    src.mkdir()
+    for name in names:
+        (src / name).write_text(name)
+    return src
+
+
+def test_trash_and_restore(tmp_path):
+    trash = Trash(home_trash=str(tmp_path / "Trash"))
+    src = make_files(tmp_path, ["a", "b", "c"])
+
+    trashed, errors = trash.trash([str(src / name) for name in "abc"])
+    assert not errors and len(trashed) == 3
+    assert os.listdir(src) == []
+    items = sorted(trash.items())
+    assert [(name, original) for name, original, _ in items] == [
+        (name, str(src / name)) for name in "abc"]
+
+    restored, errors = trash.restore(["a", "c"])
+    assert restored == [str(src / "a"), str(src / "c")]
+    assert not errors
+    assert sorted(os.listdir(src)) == ["a", "c"]
+    assert [name for name, _, _ in trash.items()] == ["b"]
+
+
+def test_same_name_is_trashed_twice(tmp_path):
+    trash = Trash(home_trash=str(tmp_path / "Trash"))
+    src = make_files(tmp_path, ["a"])
+
+    trash.trash([str(src / "a")])
+    (src / "a").write_text("second")
+    trash.trash([str(src / "a")])
+
+    assert sorted(name for name, _, _ in trash.items()) == ["a", "a.2"]
+
+
+def test_restore_leaves_taken_paths_and_unknown_names(tmp_path):
+    trash = Trash(home_trash=str(tmp_path / "Trash"))
+    src = make_files(tmp_path, ["a"])
+
+    trash.trash([str(src / "a")])
+    (src / "a").write_text("new")
+
+    restored, errors = trash.restore(["a", "missing"])
+    assert restored == []
+    assert [type(e) for _, e in errors] == [FileExistsError, FileNotFoundError]
+    assert (src / "a").read_text() == "new"
+    assert [name for name, _, _ in trash.items()] == ["a"]
+
+
+def test_empty(tmp_path):
+    trash = Trash(home_trash=str(tmp_path / "Trash"))
+    src = make_files(tmp_path, ["a", "b"])
+    (src / "d").mkdir()
+    (src / "d" / "f").write_text("f")
+
+    trash.trash([str(src / name) for name in ("a", "b", "d")])
+    assert trash.empty() == 3
+    assert list(trash.items()) == []
+    assert os.listdir(tmp_path / "Trash" / "files") == []
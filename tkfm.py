@@ -1,35 +1,3710 @@
+from array import array
 from enum import Enum, auto
 import tkinter
+import tkinter.font
+import tkinter.simpledialog
 
 from functools import partial
 
 from pathlib import Path
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bisect
+import atexit
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import mimetypes
+import operator
+import multiprocessing
 import os
+import queue
+import re
+import select
+import shutil
+import sqlite3
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
 
 class FileType(Enum):
     DIRECTORY = "DIRECTORY"
     FILE = "FILE"
-
+    TEXT = "TEXT"
+    IMAGE = "IMAGE"
+    AUDIO = "AUDIO"
+    VIDEO = "VIDEO"
+    ARCHIVE = "ARCHIVE"
+    DOCUMENT = "DOCUMENT"
+    EXECUTABLE = "EXECUTABLE"
+
+    @staticmethod
     def from_filename(filename):
-        # return filetype given filename
-        pass
+        # return filetype given filename, from its extension only. Files
+        # without one are sniffed later, see TypeSniffer
+        return FILETYPE_EXTENSIONS.get(file_extension(filename), FileType.FILE)
 
     def get_icon(self):
-        return Icons[self.value]
+        # types without an icon of their own fall back to FILE
+        return icon_registry.for_file("", self)
+
+
+def file_extension(filename):
+    '''
+    Lowercase extension of filename with the dot, or "". A leading dot
+    (".bashrc") doesn't start an extension
+    '''
+    dot = filename.rfind(".")
+    if dot <= filename.rfind(os.sep) + 1:
+        return ""
+    return filename[dot:].lower()
+
+
+def extension_types():
+    '''
+    {extension: FileType}: the MIME major types of the built-in mimetypes
+    table (not the system's, so types don't depend on the machine), plus
+    what MIME types don't tell
+    '''
+    majors = {
+        "text": FileType.TEXT,
+        "image": FileType.IMAGE,
+        "audio": FileType.AUDIO,
+        "video": FileType.VIDEO,
+    }
+    types = {}
+    for ext, mime in mimetypes.types_map.items():
+        kind = majors.get(mime.split("/")[0])
+        if kind is not None:
+            types[ext] = kind
+
+    for kind, exts in (
+            (FileType.TEXT, ".md .rst .json .yaml .yml .toml .ini .cfg .conf .log .csv .tsv"
+                            " .c .h .cc .cpp .hpp .rs .go .java .js .rb .pl .lua .sh .sql"),
+            (FileType.ARCHIVE, ".zip .tar .gz .tgz .bz2 .xz .txz .zst .7z .rar .lz .lzma .jar .deb .rpm .iso"),
+            (FileType.DOCUMENT, ".pdf .ps .epub .doc .docx .odt .rtf .xls .xlsx .ods .ppt .pptx .odp"),
+            (FileType.EXECUTABLE, ".exe .msi .appimage .run"),
+            ):
+        for ext in exts.split():
+            types[ext] = kind
+    return types
+
+
+FILETYPE_EXTENSIONS = extension_types()
+
+
+class NullSpan:
+    # returned by Tracer.span when tracing is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+class Tracer:
+    '''
+    Opt-in timing of hot paths. Enabled with TKFM_TRACE=<file.json> (Chrome
+    trace-event format, open in chrome://tracing or Perfetto) or
+    TKFM_TRACE=summary (table printed to stderr at exit), or the --trace flag.
+    When off, span() returns a shared no-op context manager.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.output = None
+        self.events = []
+        # name -> [count, total, max]
+        self.summary = {}
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def enable(self, output):
+        '''
+        output: path of the trace-event JSON file, or "summary"
+        '''
+        # worker processes inherit TKFM_TRACE, only the app writes the trace
+        if self.enabled or multiprocessing.parent_process() is not None:
+            return
+        self.enabled = True
+        self.output = output
+        atexit.register(self.save)
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def record(self, name, start, duration, args=None):
+        stats = self.summary.get(name)
+        if stats is None:
+            stats = self.summary[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": duration * 1e6,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": args or {},
+        })
+
+    def instant(self, name, **args):
+        if not self.enabled:
+            return
+        self.events.append({
+            "name": name,
+            "ph": "i",
+            "s": "t",
+            "ts": (time.perf_counter() - self.origin) * 1e6,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+    def report(self, message, **args):
+        '''
+        Diagnostics: a line on stderr, and an instant event in the trace
+        so it can be lined up with the spans around it
+        '''
+        self.instant("report", message=message, **args)
+        print(message, file=sys.stderr)
+
+    def counter(self, name, value):
+        if not self.enabled:
+            return
+        self.events.append({
+            "name": name,
+            "ph": "C",
+            "ts": (time.perf_counter() - self.origin) * 1e6,
+            "pid": self.pid,
+            "args": {name: value},
+        })
+
+    def async_begin(self, name, id):
+        if self.enabled:
+            self.events.append({
+                "name": name, "cat": "nav", "ph": "b", "id": id, "pid": self.pid,
+                "ts": (time.perf_counter() - self.origin) * 1e6,
+            })
+
+    def async_end(self, name, id):
+        if self.enabled:
+            self.events.append({
+                "name": name, "cat": "nav", "ph": "e", "id": id, "pid": self.pid,
+                "ts": (time.perf_counter() - self.origin) * 1e6,
+            })
+
+    def format_summary(self):
+        lines = ["{:<28}{:>8}{:>12}{:>12}{:>12}".format("span", "count", "total ms", "mean ms", "max ms")]
+        for name, (count, total, longest) in sorted(self.summary.items(), key=lambda kv: -kv[1][1]):
+            lines.append("{:<28}{:>8}{:>12.2f}{:>12.3f}{:>12.2f}".format(
+                name, count, total * 1e3, total / count * 1e3, longest * 1e3))
+        return "\n".join(lines)
+
+    def save(self):
+        if self.output == "summary":
+            print(self.format_summary(), file=sys.stderr)
+        elif self.output:
+            with open(self.output, "w") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+tracer = Tracer()
+if os.environ.get("TKFM_TRACE"):
+    tracer.enable(os.environ["TKFM_TRACE"])
+
+
+class LagMonitor:
+    '''
+    Samples Tk main loop latency: a callback is scheduled every INTERVAL_MS
+    and the extra delay before it runs is recorded. Delays above STALL_MS
+    are also recorded as "stall" spans.
+    '''
+    INTERVAL_MS = 50
+    STALL_MS = 100
+
+    def __init__(self, root):
+        self.root = root
+        self.max_lag = 0.0
+        self.expected = None
+
+    def start(self):
+        self.schedule()
+
+    def schedule(self):
+        self.expected = time.perf_counter() + LagMonitor.INTERVAL_MS / 1000
+        self.root.after(LagMonitor.INTERVAL_MS, self.sample)
+
+    def sample(self):
+        now = time.perf_counter()
+        lag = max(now - self.expected, 0.0)
+        self.max_lag = max(self.max_lag, lag)
+
+        tracer.counter("loop_lag_ms", lag * 1000)
+        if lag * 1000 > LagMonitor.STALL_MS:
+            tracer.record("stall", self.expected, lag)
+
+        self.schedule()
+
+
+class SortKey(Enum):
+    NAME = "name"
+    SIZE = "size"
+    MTIME = "mtime"
+    TYPE = "type"
+
+    def needs_stat(self):
+        return self in (SortKey.SIZE, SortKey.MTIME)
+
+    def compute(self, listing, index):
+        name = listing.name(index)
+        if self == SortKey.NAME:
+            return natural_key(name)
+
+        # the name key breaks ties
+        if self == SortKey.TYPE:
+            return (os.path.splitext(name)[1].lower(), natural_key(name))
+        if self == SortKey.SIZE:
+            return (listing.size(index), natural_key(name))
+        return (listing.mtime_ns(index), natural_key(name))
+
+
+NATURAL_RE = re.compile(r"(\d+)")
+
+def natural_key(name):
+    '''
+    "file2" < "file10", case insensitive. Digit runs are always at odd
+    positions, so keys of different names stay comparable.
+    '''
+    parts = NATURAL_RE.split(name.lower())
+    parts[1::2] = map(int, parts[1::2])
+    return tuple(parts)
+
+
+class SortOrder:
+    '''
+    How the listing is ordered: a SortKey, direction, and whether
+    directories come first. Works on Views, i.e. on entry indexes of a
+    Listing. Keys are not kept per entry; the sorted index arrays are
+    cached by the Listing instead.
+    '''
+    def __init__(self, key=SortKey.NAME, reverse=False, dirs_first=True):
+        self.key = key
+        self.reverse = reverse
+        self.dirs_first = dirs_first
+
+    def config(self):
+        # what an ascending order depends on, used to cache sorted lists
+        return (self.key, self.dirs_first)
+
+    def group(self, listing, index):
+        if self.dirs_first and listing.kind(index) == FileType.DIRECTORY:
+            return 0
+        return 1
+
+    def full_key(self, listing, index):
+        return (self.group(listing, index), self.key.compute(listing, index))
+
+    def ascending(self, listing, indexes):
+        return array("I", sorted(indexes, key=partial(self.full_key, listing)))
+
+    def sort(self, listing, indexes):
+        '''
+        View of indexes of listing in this order
+        '''
+        return View(listing, self.apply_reverse(listing, self.ascending(listing, indexes)))
+
+    def apply_reverse(self, listing, ascending):
+        '''
+        Flip an ascending index array into this order. Directories stay
+        first, so each group is reversed on its own.
+        '''
+        if not self.reverse:
+            return ascending
+        return self.reverse_rows(listing, ascending)
+
+    def reverse_rows(self, listing, rows):
+        split = bisect.bisect_left(rows, 1, key=partial(self.group, listing))
+        return rows[split - 1::-1] + rows[:split - 1:-1] if split else rows[::-1]
+
+    def reverse_groups(self, files):
+        return View(files.listing, self.reverse_rows(files.listing, files.rows))
+
+    def group_bounds(self, files, group):
+        key = partial(self.group, files.listing)
+        return (bisect.bisect_left(files.rows, group, key=key),
+                bisect.bisect_right(files.rows, group, key=key))
+
+    def bisect(self, files, entry):
+        '''
+        Leftmost position of entry's key in files, which is in this order
+        '''
+        listing = files.listing
+        rows = files.rows
+        lo, hi = self.group_bounds(files, self.group(listing, entry.index))
+        key = self.key.compute(listing, entry.index)
+        row_key = partial(self.key.compute, listing)
+
+        if not self.reverse:
+            return bisect.bisect_left(rows, key, lo, hi, key=row_key)
+
+        # descending run: find the first position whose key is <= key
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if row_key(rows[mid]) > key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def insert(self, files, entry):
+        files.rows.insert(self.bisect(files, entry), entry.index)
+
+    def remove(self, files, entry):
+        '''
+        Remove entry from files if it is there, returns whether it was
+        '''
+        rows = files.rows
+        i = self.bisect(files, entry)
+        while i < len(rows) and rows[i] != entry.index:
+            i += 1
+        if i < len(rows):
+            del rows[i]
+            return True
+        return False
+
+
+class IconRegistry:
+    '''
+    Shared icon images. Each icon is decoded at most once, the first time
+    it is used, and the same PhotoImage is handed to every row and frame.
+    '''
+    def __init__(self, icons):
+        # icon name -> base64 GIF data
+        self.icons = icons
+
+        # icon name -> decoded PhotoImage
+        self.images = {}
+
+        # extension -> icon name, so the MIME lookup runs once per extension
+        self.resolved = {}
+
+        self.decode_count = 0
+
+    def register(self, name, data):
+        '''
+        name can be an extension (".png"), a MIME type ("image/png"),
+        a MIME major type ("image/*") or a FileType value ("IMAGE")
+        '''
+        self.icons[name] = data
+        self.images.pop(name, None)
+        self.resolved = {}
+
+    def get(self, name):
+        image = self.images.get(name)
+        if image is None:
+            image = tkinter.PhotoImage(data=self.icons[name])
+            self.images[name] = image
+            self.decode_count += 1
+        return image
+
+    def resolve(self, filename, filetype):
+        '''
+        Returns icon name for filename: extension first, then MIME type,
+        then MIME major type, then the FileType icon, falling back to FILE
+        '''
+        if filetype == FileType.DIRECTORY:
+            return filetype.value
+
+        ext = os.path.splitext(filename)[1].lower()
+        key = (ext, filetype)
+
+        name = self.resolved.get(key)
+        if name is None:
+            mime, _ = mimetypes.guess_type("x" + ext) if ext else (None, None)
+            candidates = [ext]
+            if mime:
+                candidates += [mime, mime.split("/")[0] + "/*"]
+            candidates += [filetype.value, FileType.FILE.value]
+
+            name = next(c for c in candidates if c and c in self.icons)
+            self.resolved[key] = name
+
+        return name
+
+    def for_file(self, filename, filetype):
+        return self.get(self.resolve(filename, filetype))
+
+
+"""
+Thumbnails. The readers below run in worker processes: they decode only
+the rows and columns that survive the downscale, and hand back RGBA rows
+"""
+
+def sample_axes(width, height, size):
+    '''
+    Returns (xs, ys): source columns and rows picked (nearest neighbour)
+    for a thumbnail whose longest side is at most size
+    '''
+    scale = max(width, height, size)
+    tw = max(1, width * size // scale)
+    th = max(1, height * size // scale)
+    xs = [(2 * i + 1) * width // (2 * tw) for i in range(tw)]
+    ys = [(2 * i + 1) * height // (2 * th) for i in range(th)]
+    return xs, ys
+
+
+def check_dimensions(width, height):
+    # decoding is pure Python, bigger images would pin a worker for seconds
+    if width * height > Thumbnailer.MAX_PIXELS:
+        raise ValueError("image too large: {}x{}".format(width, height))
+
+
+def image_dimensions(head):
+    '''
+    (width, height) from the first bytes of a PNG (IHDR) or GIF (logical
+    screen), None for other files
+    '''
+    if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR" and len(head) >= 24:
+        return struct.unpack(">II", head[16:24])
+    if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        return struct.unpack("<HH", head[6:10])
+    return None
+
+
+def png_unfilter(ftype, row, prev, bpp, high, low):
+    n = len(row)
+    if ftype == 1:
+        for i in range(bpp, n):
+            row[i] = (row[i] + row[i - bpp]) & 0xFF
+    elif ftype == 2:
+        # bytewise add without carries between bytes, on the whole row at once
+        a = int.from_bytes(row, "big")
+        b = int.from_bytes(prev, "big")
+        row[:] = (((a & low) + (b & low)) ^ ((a ^ b) & high)).to_bytes(n, "big")
+    elif ftype == 3:
+        for i in range(bpp):
+            row[i] = (row[i] + (prev[i] >> 1)) & 0xFF
+        for i in range(bpp, n):
+            row[i] = (row[i] + ((row[i - bpp] + prev[i]) >> 1)) & 0xFF
+    elif ftype == 4:
+        for i in range(bpp):
+            row[i] = (row[i] + prev[i]) & 0xFF
+        for i in range(bpp, n):
+            a = row[i - bpp]
+            b = prev[i]
+            c = prev[i - bpp]
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            if pa <= pb and pa <= pc:
+                row[i] = (row[i] + a) & 0xFF
+            elif pb <= pc:
+                row[i] = (row[i] + b) & 0xFF
+            else:
+                row[i] = (row[i] + c) & 0xFF
+    elif ftype != 0:
+        raise ValueError("bad PNG filter {}".format(ftype))
+
+
+def read_png(data, size):
+    '''
+    Non-interlaced PNG, any colour type and bit depth.
+    Returns (width, height, rgba_rows)
+    '''
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("not a PNG")
+
+    pos = 8
+    header = None
+    palette = b""
+    trns = None
+    # views into data, the compressed stream is never joined
+    idat = []
+    view = memoryview(data)
+    while pos + 8 <= len(data):
+        length, tag = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = view[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if tag == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+            check_dimensions(header[0], header[1])
+        elif tag == b"PLTE":
+            palette = bytes(chunk)
+        elif tag == b"tRNS":
+            trns = bytes(chunk)
+        elif tag == b"IDAT":
+            idat.append(chunk)
+        elif tag == b"IEND":
+            break
+
+    if header is None:
+        raise ValueError("PNG without IHDR")
+    width, height, depth, ctype, _, _, interlace = header
+    if interlace:
+        raise ValueError("interlaced PNG")
+
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[ctype]
+    stride = (width * channels * depth + 7) // 8
+    bpp = max(1, channels * depth // 8)
+    high = int.from_bytes(b"\x80" * stride, "big")
+    low = int.from_bytes(b"\x7f" * stride, "big")
+
+    maxval = (1 << depth) - 1
+    if ctype == 3:
+        alphas = trns or b""
+        colors = [tuple(palette[i * 3:i * 3 + 3]) + (alphas[i] if i < len(alphas) else 255,)
+                  for i in range(len(palette) // 3)]
+        colors += [(0, 0, 0, 255)] * (256 - len(colors))
+    # tRNS of grey and RGB images is one colour key, compared unscaled
+    key = None
+    if trns and ctype in (0, 2):
+        key = struct.unpack(">{}H".format(channels), trns[:channels * 2])
+
+    def pixel(row, x):
+        if depth == 8:
+            off = x * channels
+            values = row[off:off + channels]
+            raw = values
+        elif depth == 16:
+            off = x * channels * 2
+            raw = struct.unpack_from(">{}H".format(channels), row, off)
+            values = [v >> 8 for v in raw]
+        else:
+            bit = x * depth
+            v = (row[bit >> 3] >> (8 - depth - (bit & 7))) & maxval
+            raw = (v,)
+            values = (v if ctype == 3 else v * 255 // maxval,)
+
+        if ctype == 3:
+            return colors[values[0]]
+        alpha = 0 if key is not None and tuple(raw) == key else 255
+        if ctype == 0:
+            return (values[0],) * 3 + (alpha,)
+        if ctype == 2:
+            return tuple(values) + (alpha,)
+        if ctype == 4:
+            return (values[0],) * 3 + (values[1],)
+        return tuple(values)
+
+    xs, ys = sample_axes(width, height, size)
+    wanted = set(ys)
+    rows = []
+
+    # rows are inflated one at a time, chunk by chunk, only the previous
+    # row is kept
+    inflate = zlib.decompressobj()
+    chunks = iter(idat)
+    pending = b""
+    buf = b""
+    prev = bytearray(stride)
+    for y in range(height):
+        while len(buf) < stride + 1:
+            if not pending:
+                pending = next(chunks, None)
+                if pending is None:
+                    raise ValueError("truncated PNG")
+            buf += inflate.decompress(pending, stride + 1 - len(buf))
+            pending = inflate.unconsumed_tail
+        row = bytearray(buf[1:stride + 1])
+        png_unfilter(buf[0], row, prev, bpp, high, low)
+        buf = buf[stride + 1:]
+
+        if y in wanted:
+            rows.append(bytes(b for x in xs for b in pixel(row, x)))
+        prev = row
+
+    return width, height, rows
+
+
+def lzw_decode(data, min_size, count):
+    clear = 1 << min_size
+    end = clear + 1
+    base = [bytes([i]) for i in range(clear)] + [b"", b""]
+    table = list(base)
+    size = min_size + 1
+    out = bytearray()
+    prev = None
+
+    buf = 0
+    nbits = 0
+    for byte in data:
+        buf |= byte << nbits
+        nbits += 8
+        while nbits >= size:
+            code = buf & ((1 << size) - 1)
+            buf >>= size
+            nbits -= size
+
+            if code == clear:
+                table = list(base)
+                size = min_size + 1
+                prev = None
+                continue
+            if code == end:
+                return out
+
+            if prev is None:
+                entry = table[code]
+            elif code < len(table):
+                entry = table[code]
+                if len(table) < 4096:
+                    table.append(prev + entry[:1])
+            else:
+                entry = prev + prev[:1]
+                if len(table) < 4096:
+                    table.append(entry)
+
+            out += entry
+            prev = entry
+            if len(table) == 1 << size and size < 12:
+                size += 1
+            if len(out) >= count:
+                return out
+    return out
+
+
+def read_gif(data, size):
+    '''
+    First frame of a GIF. Returns (width, height, rgba_rows)
+    '''
+    if data[:6] not in (b"GIF87a", b"GIF89a"):
+        raise ValueError("not a GIF")
+    check_dimensions(*struct.unpack("<HH", data[6:10]))
+
+    flags = data[10]
+    pos = 13
+    colors = b""
+    if flags & 0x80:
+        count = 2 << (flags & 7)
+        colors = data[pos:pos + count * 3]
+        pos += count * 3
+
+    transparent = None
+    while True:
+        block = data[pos]
+        if block == 0x21:
+            label = data[pos + 1]
+            pos += 2
+            if label == 0xF9 and data[pos + 1] & 1:
+                transparent = data[pos + 4]
+            # skip sub-blocks
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+        elif block == 0x2C:
+            break
+        else:
+            raise ValueError("GIF without image")
+
+    _, _, width, height, flags = struct.unpack("<HHHHB", data[pos + 1:pos + 10])
+    check_dimensions(width, height)
+    pos += 10
+    if flags & 0x80:
+        count = 2 << (flags & 7)
+        colors = data[pos:pos + count * 3]
+        pos += count * 3
+
+    min_size = data[pos]
+    pos += 1
+    blocks = []
+    while data[pos]:
+        blocks.append(data[pos + 1:pos + 1 + data[pos]])
+        pos += data[pos] + 1
+
+    pixels = lzw_decode(b"".join(blocks), min_size, width * height)
+    pixels += bytes(width * height - len(pixels))
+
+    # stored row -> image row
+    if flags & 0x40:
+        order = [y for start, step in ((0, 8), (4, 8), (2, 4), (1, 2)) for y in range(start, height, step)]
+        stored = {y: i for i, y in enumerate(order)}
+    else:
+        stored = None
+
+    palette = [tuple(colors[i * 3:i * 3 + 3]) + (255,) for i in range(len(colors) // 3)]
+    palette += [(0, 0, 0, 255)] * (256 - len(palette))
+    if transparent is not None:
+        palette[transparent] = (0, 0, 0, 0)
+
+    xs, ys = sample_axes(width, height, size)
+    rows = []
+    for y in ys:
+        start = (stored[y] if stored else y) * width
+        rows.append(bytes(b for x in xs for b in palette[pixels[start + x]]))
+    return width, height, rows
+
+
+def read_pnm(data, size):
+    '''
+    Binary PGM (P5) and PPM (P6). Returns (width, height, rgba_rows)
+    '''
+    magic = data[:2]
+    if magic not in (b"P5", b"P6"):
+        raise ValueError("not a binary PGM/PPM")
+
+    # width, height, maxval, separated by whitespace and # comments
+    fields = []
+    pos = 2
+    while len(fields) < 3:
+        c = data[pos:pos + 1]
+        if not c:
+            raise ValueError("truncated PNM header")
+        if c == b"#":
+            pos = data.index(b"\n", pos)
+        elif c.isspace():
+            pos += 1
+        else:
+            start = pos
+            while data[pos:pos + 1].isdigit():
+                pos += 1
+            fields.append(int(data[start:pos]))
+    # one whitespace byte before the raster
+    pos += 1
+
+    width, height, maxval = fields
+    check_dimensions(width, height)
+    channels = 3 if magic == b"P6" else 1
+    sample = 2 if maxval > 255 else 1
+    stride = width * channels * sample
+
+    xs, ys = sample_axes(width, height, size)
+    rows = []
+    for y in ys:
+        row = data[pos + y * stride:pos + (y + 1) * stride]
+        out = bytearray()
+        for x in xs:
+            off = x * channels * sample
+            values = row[off:off + channels * sample:sample]
+            if maxval != 255:
+                values = [v * 255 // (maxval >> 8 if sample == 2 else maxval) for v in values]
+            out += bytes(values) * (3 // channels) + b"\xff"
+        rows.append(bytes(out))
+    return width, height, rows
+
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def write_png(width, height, rows, text):
+    '''
+    RGBA PNG with tEXt chunks
+    '''
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    raw = b"".join(b"\0" + row for row in rows)
+    return (b"\x89PNG\r\n\x1a\n"
+            + png_chunk(b"IHDR", header)
+            + b"".join(png_chunk(b"tEXt", key.encode("latin-1") + b"\0" + value.encode("latin-1"))
+                       for key, value in text.items())
+            + png_chunk(b"IDAT", zlib.compress(raw))
+            + png_chunk(b"IEND", b""))
+
+
+def read_png_text(path):
+    '''
+    tEXt chunks before the image data, as a dict
+    '''
+    text = {}
+    with open(path, "rb") as f:
+        if f.read(8) != b"\x89PNG\r\n\x1a\n":
+            return text
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                break
+            length, tag = struct.unpack(">I4s", head)
+            if tag in (b"IDAT", b"IEND"):
+                break
+            chunk = f.read(length + 4)[:length]
+            if tag == b"tEXt":
+                key, _, value = chunk.partition(b"\0")
+                text[key.decode("latin-1")] = value.decode("latin-1")
+    return text
+
+
+THUMBNAIL_READERS = {
+    ".png": read_png,
+    ".gif": read_gif,
+    ".ppm": read_pnm,
+    ".pgm": read_pnm,
+    ".pnm": read_pnm,
+}
+
+
+def cached_thumbnail(path, cache_dir):
+    '''
+    Looks up path in the freedesktop.org cache under cache_dir. Returns
+    (found, thumb): thumb is None for files recorded as failed, found is
+    False if there is no entry made from the file as it is now.
+    '''
+    st = os.stat(path)
+    uri = Path(path).as_uri()
+    name = hashlib.md5(uri.encode()).hexdigest() + ".png"
+
+    thumb = os.path.join(cache_dir, Thumbnailer.FLAVOR, name)
+    fail = os.path.join(cache_dir, "fail", Thumbnailer.FAIL_DIR, name)
+
+    # a thumbnail is valid if it was made from this URI at this mtime
+    for candidate in (thumb, fail):
+        try:
+            text = read_png_text(candidate)
+        except OSError:
+            continue
+        if (text.get("Thumb::URI") == uri and text.get("Thumb::MTime") == str(int(st.st_mtime))
+                and text.get("Thumb::Size", str(st.st_size)) == str(st.st_size)):
+            return True, (thumb if candidate == thumb else None)
+    return False, None
+
+
+def make_thumbnail(path, cache_dir, size=128):
+    '''
+    Runs in a worker process. Returns the path of a valid thumbnail in the
+    freedesktop.org cache under cache_dir, creating it if needed, or None
+    if path can't be thumbnailed (a failure entry is written for that).
+    '''
+    found, thumb = cached_thumbnail(path, cache_dir)
+    if found:
+        return thumb
+
+    st = os.stat(path)
+    uri = Path(path).as_uri()
+    name = hashlib.md5(uri.encode()).hexdigest() + ".png"
+    mtime = str(int(st.st_mtime))
+
+    thumb = os.path.join(cache_dir, Thumbnailer.FLAVOR, name)
+    fail = os.path.join(cache_dir, "fail", Thumbnailer.FAIL_DIR, name)
+
+    text = {
+        "Thumb::URI": uri,
+        "Thumb::MTime": mtime,
+        "Thumb::Size": str(st.st_size),
+        "Software": "tkfm",
+    }
+    try:
+        if st.st_size > Thumbnailer.MAX_FILE_SIZE:
+            raise ValueError("too large")
+        with open(path, "rb") as f:
+            head = f.read(TypeSniffer.SNIFF_BYTES)
+            # files without an extension by their contents, see TypeSniffer
+            ext = file_extension(path) or sniff_type(head)[1]
+            reader = THUMBNAIL_READERS[ext]
+            # too many pixels is known from the header, before reading the rest
+            dimensions = image_dimensions(head)
+            if dimensions is not None:
+                check_dimensions(*dimensions)
+            data = head + f.read()
+        width, height, rows = reader(data, size)
+    except (ValueError, KeyError, IndexError, struct.error, zlib.error, OSError):
+        target = fail
+        png = write_png(1, 1, [b"\0\0\0\0"], text)
+    else:
+        target = thumb
+        text["Thumb::Image::Width"] = str(width)
+        text["Thumb::Image::Height"] = str(height)
+        mime = mimetypes.guess_type(path)[0]
+        if mime:
+            text["Thumb::Mimetype"] = mime
+        png = write_png(len(rows[0]) // 4, len(rows), rows, text)
+
+    # written to a temporary name and renamed, readers never see half a file
+    os.makedirs(os.path.dirname(target), mode=0o700, exist_ok=True)
+    tmp = "{}.{}.tmp".format(target, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(png)
+    os.replace(tmp, target)
+
+    return thumb if target == thumb else None
+
+
+class Thumbnailer:
+    '''
+    Thumbnails of image files, shared with other applications through the
+    freedesktop.org cache (~/.cache/thumbnails). Files are decoded in a
+    process pool, only for rows that are visible; a revisit finds valid
+    cached thumbnails and decodes nothing: the cache is checked on a
+    thread first, only misses go to the process pool.
+    '''
+    # "normal" thumbnails are at most 128x128
+    FLAVOR = "normal"
+    SIZE = 128
+    # failed files are recorded here, so they are not retried until modified
+    FAIL_DIR = "tkfm"
+
+    # shown next to the 32x32 icons
+    ICON_SIZE = 32
+    WORKERS = 4
+    # bigger files keep their generic icon, as do images with more pixels
+    # (a 4K screenshot decodes in about a second)
+    MAX_FILE_SIZE = 64 * 1024 * 1024
+    MAX_PIXELS = 3840 * 2160
+    # row images kept in memory, least recently shown dropped first
+    MEMORY_ITEMS = 512
+    POLL_MS = 30
+
+    def __init__(self, root, callback, cache_dir=None):
+        '''
+        root: widget used for after()
+        callback: called without arguments after new thumbnails arrived
+        '''
+        self.root = root
+        self.callback = callback
+
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                    "thumbnails")
+        self.cache_dir = cache_dir
+
+        # Created on first use, so startup doesn't spawn processes
+        self.checker = None
+        self.pool = None
+
+        # path -> Future
+        self.pending = {}
+        # path -> PhotoImage, or None if there is no thumbnail
+        self.images = OrderedDict()
+        # paths in images to check again, shown as they are until then
+        self.stale = set()
+
+        self.results = queue.Queue()
+        self.poll_id = None
+
+    @staticmethod
+    def wants(name, kind=FileType.FILE):
+        ext = file_extension(name)
+        # sniffed images without an extension are tried too
+        return ext in THUMBNAIL_READERS or (not ext and kind == FileType.IMAGE)
+
+    def get(self, path):
+        '''
+        Returns the row image for path, or None if it has none (yet)
+        '''
+        image = self.images.get(path)
+        if image is not None:
+            self.images.move_to_end(path)
+        return image
+
+    def request(self, paths):
+        '''
+        Make thumbnails for paths, the visible rows. Requests for rows that
+        were scrolled away and haven't started yet are dropped.
+        '''
+        wanted = set(paths)
+        for path, future in list(self.pending.items()):
+            if path not in wanted and future.cancel():
+                del self.pending[path]
+
+        for path in paths:
+            if path in self.pending or (path in self.images and path not in self.stale):
+                continue
+            self.stale.discard(path)
+            # never thumbnail the thumbnails
+            if path.startswith(self.cache_dir + os.sep):
+                self.images[path] = None
+                continue
+
+            if self.checker is None:
+                self.checker = ThreadPoolExecutor(max_workers=Thumbnailer.WORKERS)
+            self.submit(path, self.checker.submit(cached_thumbnail, path, self.cache_dir))
+
+        if self.pending and self.poll_id is None:
+            self.poll_id = self.root.after(Thumbnailer.POLL_MS, self.poll)
+
+    def submit(self, path, future):
+        future.add_done_callback(partial(self.on_done, path))
+        self.pending[path] = future
+
+    def generate(self, path):
+        if self.pool is None:
+            # spawn: forking a process that has Tk and threads is unsafe
+            self.pool = ProcessPoolExecutor(
+                    max_workers=Thumbnailer.WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"))
+        try:
+            self.submit(path, self.pool.submit(make_thumbnail, path, self.cache_dir, Thumbnailer.SIZE))
+        except BrokenProcessPool:
+            # a worker died, start over with a new pool next time
+            self.pool = None
+            self.images[path] = None
+
+    def on_done(self, path, future):
+        # executor thread
+        if not future.cancelled():
+            self.results.put((path, future))
+
+    def poll(self):
+        self.poll_id = None
+
+        arrived = False
+        with tracer.span("thumbnail_load"):
+            try:
+                while True:
+                    path, future = self.results.get_nowait()
+                    if self.pending.get(path) is not future:
+                        continue
+                    del self.pending[path]
+
+                    try:
+                        thumb = future.result()
+                    except Exception:
+                        thumb = None
+                    # the checker returns (found, thumb), the pool a path
+                    if isinstance(thumb, tuple):
+                        found, thumb = thumb
+                        if not found:
+                            self.generate(path)
+                            continue
+                    self.images[path] = self.load(thumb) if thumb else None
+                    arrived = True
+            except queue.Empty:
+                pass
+
+        while len(self.images) > Thumbnailer.MEMORY_ITEMS:
+            path, _ = self.images.popitem(last=False)
+            self.stale.discard(path)
+
+        if arrived:
+            self.callback()
+
+        if self.pending:
+            self.poll_id = self.root.after(Thumbnailer.POLL_MS, self.poll)
+
+    def load(self, thumb):
+        try:
+            image = tkinter.PhotoImage(file=thumb)
+        except tkinter.TclError:
+            return None
+        factor = -(-max(image.width(), image.height()) // Thumbnailer.ICON_SIZE)
+        if factor > 1:
+            image = image.subsample(factor)
+        return image
+
+    def forget(self, paths=None):
+        '''
+        Files at paths (or any file) changed: their thumbnails are checked
+        against the disk cache again the next time they are visible
+        '''
+        if paths is None:
+            self.stale.update(self.images)
+        else:
+            self.stale.update(path for path in paths if path in self.images)
+
+    def stop(self):
+        if self.checker is not None:
+            self.checker.shutdown(wait=False, cancel_futures=True)
+            self.checker = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        self.pending = {}
+
+
+"""
+Type sniffing, for files whose name doesn't tell
+"""
+
+# (offset, leading bytes, FileType, extension the contents would have)
+MAGIC = [
+    (0, b"\x89PNG\r\n\x1a\n", FileType.IMAGE, ".png"),
+    (0, b"GIF87a", FileType.IMAGE, ".gif"),
+    (0, b"GIF89a", FileType.IMAGE, ".gif"),
+    (0, b"\xff\xd8\xff", FileType.IMAGE, ".jpg"),
+    (0, b"P5\n", FileType.IMAGE, ".pgm"),
+    (0, b"P6\n", FileType.IMAGE, ".ppm"),
+    (0, b"%PDF-", FileType.DOCUMENT, ".pdf"),
+    (0, b"%!PS", FileType.DOCUMENT, ".ps"),
+    (0, b"PK\x03\x04", FileType.ARCHIVE, ".zip"),
+    (0, b"\x1f\x8b", FileType.ARCHIVE, ".gz"),
+    (0, b"BZh", FileType.ARCHIVE, ".bz2"),
+    (0, b"\xfd7zXZ\x00", FileType.ARCHIVE, ".xz"),
+    (0, b"(\xb5/\xfd", FileType.ARCHIVE, ".zst"),
+    (0, b"7z\xbc\xaf\x27\x1c", FileType.ARCHIVE, ".7z"),
+    (0, b"Rar!\x1a\x07", FileType.ARCHIVE, ".rar"),
+    (257, b"ustar", FileType.ARCHIVE, ".tar"),
+    (0, b"ID3", FileType.AUDIO, ".mp3"),
+    (0, b"fLaC", FileType.AUDIO, ".flac"),
+    (0, b"OggS", FileType.AUDIO, ".ogg"),
+    (8, b"WAVE", FileType.AUDIO, ".wav"),
+    (8, b"AVI ", FileType.VIDEO, ".avi"),
+    (4, b"ftyp", FileType.VIDEO, ".mp4"),
+    (0, b"\x1aE\xdf\xa3", FileType.VIDEO, ".mkv"),
+    (0, b"\x7fELF", FileType.EXECUTABLE, ""),
+    (0, b"#!", FileType.EXECUTABLE, ""),
+    (0, b"MZ", FileType.EXECUTABLE, ".exe"),
+]
+
+
+def sniff_type(data):
+    '''
+    Returns (FileType, extension) for the first bytes of a file: a known
+    signature, else TEXT if data is UTF-8 without NULs, else FILE
+    '''
+    for offset, magic, kind, ext in MAGIC:
+        if data.startswith(magic, offset):
+            return kind, ext
+
+    if not data or b"\0" in data:
+        return FileType.FILE, ""
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # a character cut off at the end of the sample is still text
+        if e.start < len(data) - 3:
+            return FileType.FILE, ""
+    return FileType.TEXT, ".txt"
+
+
+class TypeSniffer:
+    '''
+    FileType of files without an extension, from their first bytes. Files
+    are read on a thread pool, only for visible rows, so slow media delays
+    an icon but never the rows. Results are cached by (st_dev, st_ino,
+    st_mtime_ns): a rescan or revisit costs at most a stat, no read.
+    '''
+    SNIFF_BYTES = 512
+    WORKERS = 4
+    # (st_dev, st_ino, st_mtime_ns) -> FileType, shared with the workers
+    CACHE_ITEMS = 65536
+    # path -> FileType, checked before anything is submitted
+    MEMORY_ITEMS = 4096
+    POLL_MS = 30
+
+    def __init__(self, root, callback):
+        '''
+        root: widget used for after()
+        callback: called without arguments after new types arrived
+        '''
+        self.root = root
+        self.callback = callback
+
+        # Created on first use
+        self.pool = None
+
+        # path -> (Future, Entry)
+        self.pending = {}
+        # path -> FileType
+        self.known = OrderedDict()
+        # paths in known to sniff again, used as they are until then
+        self.stale = set()
+
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.read_count = 0
+
+        self.results = queue.Queue()
+        self.poll_id = None
+
+    @staticmethod
+    def wants(entry):
+        return entry.kind == FileType.FILE and not file_extension(entry.name)
+
+    def get(self, path):
+        '''
+        Returns the sniffed FileType of path, or None if not known (yet)
+        '''
+        kind = self.known.get(path)
+        if kind is not None:
+            self.known.move_to_end(path)
+        return kind
+
+    def request(self, entries):
+        '''
+        Sniff entries, those of visible rows. Requests for rows that were
+        scrolled away and haven't started yet are dropped.
+        '''
+        wanted = {entry.path: entry for entry in entries}
+        for path, (future, _) in list(self.pending.items()):
+            if path not in wanted and future.cancel():
+                del self.pending[path]
+
+        for path, entry in wanted.items():
+            if path in self.pending:
+                # the results go to the listing shown now
+                self.pending[path] = (self.pending[path][0], entry)
+                continue
+            if path in self.known and path not in self.stale:
+                continue
+            self.stale.discard(path)
+
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=TypeSniffer.WORKERS)
+            future = self.pool.submit(self.sniff, path)
+            future.add_done_callback(partial(self.on_done, path))
+            self.pending[path] = (future, entry)
+
+        if self.pending and self.poll_id is None:
+            self.poll_id = self.root.after(TypeSniffer.POLL_MS, self.poll)
+
+    def sniff(self, path):
+        # executor thread
+        st = os.stat(path)
+        # fifos and devices are never opened
+        if not stat.S_ISREG(st.st_mode):
+            return FileType.FILE
+
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        with self.cache_lock:
+            kind = self.cache.get(key)
+            if kind is not None:
+                self.cache.move_to_end(key)
+                return kind
+
+        # O_NONBLOCK: if it became a fifo since the stat, don't wait on it
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            data = os.read(fd, TypeSniffer.SNIFF_BYTES)
+        finally:
+            os.close(fd)
+        kind, _ = sniff_type(data)
+
+        with self.cache_lock:
+            self.read_count += 1
+            self.cache[key] = kind
+            while len(self.cache) > TypeSniffer.CACHE_ITEMS:
+                self.cache.popitem(last=False)
+        return kind
+
+    def on_done(self, path, future):
+        # executor thread
+        if not future.cancelled():
+            self.results.put((path, future))
+
+    def poll(self):
+        self.poll_id = None
+
+        arrived = False
+        try:
+            while True:
+                path, future = self.results.get_nowait()
+                pending = self.pending.get(path)
+                if pending is None or pending[0] is not future:
+                    continue
+                del self.pending[path]
+                entry = pending[1]
+
+                try:
+                    kind = future.result()
+                except OSError:
+                    kind = FileType.FILE
+                self.known[path] = kind
+                if kind != FileType.FILE:
+                    entry.listing.set_kind(entry.index, kind)
+                    arrived = True
+        except queue.Empty:
+            pass
+
+        while len(self.known) > TypeSniffer.MEMORY_ITEMS:
+            path, _ = self.known.popitem(last=False)
+            self.stale.discard(path)
+
+        if arrived:
+            self.callback()
+
+        if self.pending:
+            self.poll_id = self.root.after(TypeSniffer.POLL_MS, self.poll)
+
+    def forget(self, paths=None):
+        '''
+        Files at paths (or any file) changed: they are sniffed again the
+        next time they are visible, a read only if their mtime changed
+        '''
+        if paths is None:
+            self.stale.update(self.known)
+        else:
+            self.stale.update(path for path in paths if path in self.known)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        self.pending = {}
+
+
+class Entry:
+    '''
+    Handle on one entry of a Listing. The data stays in the listing's
+    columns, handles and the name str are made when a row is looked at.
+    '''
+    __slots__ = ("listing", "index")
+
+    def __init__(self, listing, index):
+        self.listing = listing
+        self.index = index
+
+    def __repr__(self):
+        return "Entry({!r}, {})".format(self.name, self.kind.value)
+
+    def __eq__(self, other):
+        return isinstance(other, Entry) and other.listing is self.listing and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.listing), self.index))
+
+    @property
+    def name(self):
+        return self.listing.name(self.index)
+
+    @property
+    def kind(self):
+        return self.listing.kind(self.index)
+
+    def stat(self):
+        # full stat result, always from the disk
+        return self.listing.stat_entry(self.index)
+
+    def has_stat(self):
+        # size and mtime are known, reading them won't touch the disk
+        return self.listing.sizes[self.index] != Listing.UNKNOWN
+
+    @property
+    def path(self):
+        return os.path.join(self.listing.path, self.name)
+
+    @property
+    def size(self):
+        return self.listing.size(self.index)
+
+    @property
+    def mtime(self):
+        return self.listing.mtime_ns(self.index) / 1e9
+
+    @property
+    def mode(self):
+        return self.stat().st_mode
+
+    def is_hidden(self):
+        return self.listing.is_hidden(self.index)
+
+
+class View:
+    '''
+    Rows of one listing in display order, as an array of entry indexes.
+    Indexing gives Entry handles, slicing gives Views.
+    '''
+    __slots__ = ("listing", "rows")
+
+    def __init__(self, listing=None, rows=None):
+        self.listing = listing
+        self.rows = array("I") if rows is None else rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return View(self.listing, self.rows[row])
+        return Entry(self.listing, self.rows[row])
+
+    def __iter__(self):
+        listing = self.listing
+        for index in self.rows:
+            yield Entry(listing, index)
+
+    def __repr__(self):
+        return "View({} rows)".format(len(self.rows))
+
+    def names(self):
+        if self.listing is None:
+            return []
+        name = self.listing.name
+        return [name(index) for index in self.rows]
+
+
+class Listing:
+    '''
+    Entries of one directory, read with a single scandir pass. The kind of
+    each entry comes from d_type, so regular files and directories cost no
+    extra stat. Syscalls are counted so this can be checked.
+
+    Entries are stored column-wise: names packed in one NUL separated
+    buffer with an offsets array, kinds in a bytearray, sizes and mtimes in
+    array('q'). That is about 22 bytes per entry plus its name, instead of
+    an object, a str and a list slot per entry. Removed entries keep their
+    index (they are only dropped from views) until the next scan.
+    '''
+    KINDS = list(FileType)
+    KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+    # bytes extension -> kind code, for the scan loop
+    EXTENSION_CODES = dict(zip(map(os.fsencode, FILETYPE_EXTENSIONS),
+                               map(KIND_CODES.get, FILETYPE_EXTENSIONS.values())))
+
+    # sizes/mtimes of entries not stat'ed yet, and of failed stats
+    UNKNOWN = -1
+    FAILED = -2
+    UNKNOWN_ROW = array("q", [UNKNOWN])
+
+    # fixed bytes of a listing, for the cache budget
+    OVERHEAD = 1024
+    # find_all looks up fewer names one by one, more in one pass
+    FIND_SCAN_LIMIT = 16
+
+    def __init__(self, path):
+        self.path = str(path)
+
+        # b"\0name\0name\0": entry i is names[offsets[i]:offsets[i + 1] - 1]
+        self.names = bytearray(b"\0")
+        self.offsets = array("I", [1])
+        # Listing.KIND_CODES of each entry
+        self.kinds = bytearray()
+        # -1 until the entry is stat'ed
+        self.sizes = array("q")
+        self.mtimes = array("q")
+        # indexes of entries that are gone
+        self.removed = set()
+
+        # (SortOrder.config(), show_hidden) -> ascending index array
+        self.orders = {}
+        # set once every entry has its stat cached
+        self.stats_loaded = False
+
+        # (st_dev, st_ino, st_mtime_ns) of the directory, taken before the
+        # scan so changes made during the scan invalidate the listing
+        self.validator = None
+
+        # syscall counters
+        self.scandir_calls = 0
+        self.stat_calls = 0
+
+    def __len__(self):
+        # including removed entries, indexes run up to this
+        return len(self.kinds)
+
+    @classmethod
+    def scan(cls, path):
+        listing = cls(path)
+        for _ in listing.scan_batches():
+            pass
+        return listing
+
+    def scan_batches(self, batch_size=256, cancelled=None):
+        '''
+        Fills the columns, yielding the index range of each batch of new
+        entries as soon as it is read. Stops early once cancelled (a
+        threading.Event) is set.
+        '''
+        self.validator = self.dir_validator()
+        self.scandir_calls += 1
+
+        # the hot loop, columns and codes are looked up once
+        names = self.names
+        offsets = self.offsets
+        kinds = self.kinds
+        codes = Listing.KIND_CODES
+        directory = codes[FileType.DIRECTORY]
+        file = codes[FileType.FILE]
+        extension_codes = Listing.EXTENSION_CODES
+
+        start = len(kinds)
+        # bytes names, so no str is made per entry
+        with os.scandir(os.fsencode(self.path)) as it:
+            for direntry in it:
+                # is_dir() only needs a stat for symlinks (d_type is DT_LNK)
+                if direntry.is_symlink():
+                    self.stat_calls += 1
+
+                try:
+                    is_dir = direntry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                name = direntry.name
+                names += name
+                names.append(0)
+                offsets.append(len(names))
+                if is_dir:
+                    kinds.append(directory)
+                else:
+                    # FileType.from_filename on the bytes name
+                    dot = name.rfind(b".")
+                    kinds.append(extension_codes.get(name[dot:].lower(), file) if dot > 0 else file)
+
+                if len(kinds) - start >= batch_size:
+                    if cancelled is not None and cancelled.is_set():
+                        return
+                    self.pad_stats()
+                    yield range(start, len(kinds))
+                    start = len(kinds)
+
+        self.pad_stats()
+        yield range(start, len(kinds))
+
+    def pad_stats(self):
+        # sizes/mtimes of scanned entries, filled in per batch
+        missing = len(self.kinds) - len(self.sizes)
+        self.sizes.extend(Listing.UNKNOWN_ROW * missing)
+        self.mtimes.extend(Listing.UNKNOWN_ROW * missing)
+
+    def append(self, name, kind):
+        '''
+        Add an entry, name as bytes. Returns its index
+        '''
+        self.names += name
+        self.names.append(0)
+        self.offsets.append(len(self.names))
+        self.sizes.append(Listing.UNKNOWN)
+        self.mtimes.append(Listing.UNKNOWN)
+        # last, other threads only look at indexes below len(self.kinds)
+        self.kinds.append(Listing.KIND_CODES[kind])
+        return len(self.kinds) - 1
+
+    def name(self, index):
+        return os.fsdecode(bytes(self.names[self.offsets[index]:self.offsets[index + 1] - 1]))
+
+    def kind(self, index):
+        return Listing.KINDS[self.kinds[index]]
+
+    def set_kind(self, index, kind):
+        # a better guess than the extension, from TypeSniffer
+        self.kinds[index] = Listing.KIND_CODES[kind]
+
+    def is_hidden(self, index):
+        return self.names[self.offsets[index]] == 0x2E  # "."
+
+    def dir_validator(self):
+        self.stat_calls += 1
+        st = os.stat(self.path)
+        return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    def is_valid(self):
+        try:
+            return self.validator is not None and self.dir_validator() == self.validator
+        except OSError:
+            return False
+
+    def revalidate(self):
+        try:
+            self.validator = self.dir_validator()
+        except OSError:
+            self.validator = None
+
+    def update_name(self, old, name):
+        '''
+        Re-read a single name after a change. old is its Entry from find(),
+        or None. Returns the new Entry, or None if the name was removed.
+        An entry whose kind is unchanged is updated in place, so repeated
+        events for one file don't grow the listing.
+        '''
+        self.orders = {}
+        try:
+            st, kind = self.stat_kind(name)
+        except OSError:
+            if old is not None:
+                self.removed.add(old.index)
+            return None
+
+        if old is not None and old.kind == kind:
+            index = old.index
+        else:
+            if old is not None:
+                self.removed.add(old.index)
+            index = self.append(os.fsencode(name), kind)
+        self.sizes[index] = st.st_size
+        self.mtimes[index] = st.st_mtime_ns
+        return Entry(self, index)
+
+    def sorted_visible(self, sort_order, show_hidden):
+        '''
+        View of the visible entries in sort_order. The ascending index
+        array is cached per order, so switching between orders already
+        used costs no sort.
+        '''
+        config = (sort_order.config(), show_hidden)
+        ascending = self.orders.get(config)
+        if ascending is None:
+            ascending = self.orders[config] = sort_order.ascending(self, self.visible(show_hidden))
+        return View(self, sort_order.apply_reverse(self, ascending[:]))
+
+    def load_stats(self):
+        # stat every entry, off the Tk thread. Needed by size/mtime sorting
+        for index in range(len(self)):
+            self.fetch_stat(index)
+        self.stats_loaded = True
+
+    def fetch_stat(self, index):
+        if self.sizes[index] == Listing.UNKNOWN:
+            try:
+                self.stat_entry(index)
+            except OSError:
+                self.sizes[index] = Listing.FAILED
+                self.mtimes[index] = Listing.FAILED
+
+    def stat_entry(self, index):
+        st = self.stat(self.name(index))
+        self.sizes[index] = st.st_size
+        self.mtimes[index] = st.st_mtime_ns
+        return st
+
+    def size(self, index):
+        self.fetch_stat(index)
+        return self.sizes[index]
+
+    def mtime_ns(self, index):
+        self.fetch_stat(index)
+        return self.mtimes[index]
+
+    def estimate_size(self):
+        # bytes held by the listing, used for the cache budget
+        return (len(self.names) + self.offsets.itemsize * len(self.offsets) + len(self.kinds)
+                + self.sizes.itemsize * len(self.sizes) + self.mtimes.itemsize * len(self.mtimes)
+                + sum(order.itemsize * len(order) for order in self.orders.values())
+                + Listing.OVERHEAD)
+
+    def entry_for(self, name):
+        '''
+        Entry for a single name outside of a scan, costs one stat
+        '''
+        st, kind = self.stat_kind(name)
+        index = self.append(os.fsencode(name), kind)
+        self.sizes[index] = st.st_size
+        self.mtimes[index] = st.st_mtime_ns
+        return Entry(self, index)
+
+    def stat_kind(self, name):
+        st = self.stat(name)
+        if stat.S_ISDIR(st.st_mode):
+            return st, FileType.DIRECTORY
+        return st, FileType.from_filename(name)
+
+    def stat(self, name):
+        self.stat_calls += 1
+        path = os.path.join(self.path, name)
+        try:
+            return os.stat(path)
+        except OSError:
+            # dangling symlink
+            return os.lstat(path)
+
+    def find(self, name):
+        '''
+        Entry for name, or None. A search of the names buffer, no per-name
+        index is kept
+        '''
+        needle = b"\0" + os.fsencode(name) + b"\0"
+        pos = self.names.find(needle)
+        while pos >= 0:
+            index = bisect.bisect_right(self.offsets, pos + 1) - 1
+            if index not in self.removed:
+                return Entry(self, index)
+            pos = self.names.find(needle, pos + 1)
+        return None
+
+    def find_all(self, names):
+        '''
+        {name: Entry} for the names that are present. One pass over the
+        names buffer when there are many names.
+        '''
+        if len(names) <= Listing.FIND_SCAN_LIMIT:
+            found = {name: self.find(name) for name in names}
+            return {name: entry for name, entry in found.items() if entry is not None}
+
+        wanted = {os.fsencode(name): name for name in names}
+        found = {}
+        # the buffer starts and ends with a NUL
+        for index, raw in enumerate(bytes(self.names[1:-1]).split(b"\0")):
+            name = wanted.get(raw)
+            if name is not None and index not in self.removed:
+                found[name] = Entry(self, index)
+        return found
+
+    def visible(self, show_hidden):
+        '''
+        Index array of the entries that are shown
+        '''
+        if show_hidden and not self.removed:
+            return array("I", range(len(self)))
+        names = self.names
+        offsets = self.offsets
+        removed = self.removed
+        return array("I", (i for i in range(len(self))
+                           if i not in removed and (show_hidden or names[offsets[i]] != 0x2E)))
+
+    def get_stats(self):
+        return {
+            "entries": len(self) - len(self.removed),
+            "scandir": self.scandir_calls,
+            "stat": self.stat_calls,
+        }
+
+
+class ListingCache:
+    '''
+    Bounded LRU cache of parsed listings keyed by path. Entries are
+    revalidated against the directory's dev/inode/mtime before reuse.
+    Used from loader threads, so access goes through a lock.
+    '''
+    DEFAULT_BUDGET = 64 * 1024 * 1024
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        # bytes, as estimated by Listing.estimate_size
+        self.budget = budget
+        self.used = 0
+
+        # path -> (listing, size)
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        path = str(path)
+
+        with self.lock:
+            cached = self.listings.get(path)
+
+        # stat outside the lock, it can be slow on network mounts
+        if cached is not None and cached[0].is_valid():
+            with self.lock:
+                if path in self.listings:
+                    self.listings.move_to_end(path)
+                self.hits += 1
+            return cached[0]
+
+        with self.lock:
+            self.misses += 1
+            if cached is not None and self.listings.get(path) is cached:
+                self.remove(path)
+        return None
+
+    def put(self, listing):
+        size = listing.estimate_size()
+        if size > self.budget:
+            return
+
+        with self.lock:
+            if listing.path in self.listings:
+                self.remove(listing.path)
+
+            self.listings[listing.path] = (listing, size)
+            self.used += size
+            self.evict()
+
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    def evict(self):
+        # caller holds the lock
+        while self.used > self.budget:
+            path = next(iter(self.listings))
+            self.remove(path)
+            self.evictions += 1
+
+    def remove(self, path):
+        _, size = self.listings.pop(path)
+        self.used -= size
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+            self.used = 0
+
+    def get_stats(self):
+        return {
+            "listings": len(self.listings),
+            "bytes": self.used,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class MetadataIndex:
+    '''
+    Optional on-disk index of listed directories, in SQLite: the name,
+    kind, size and mtime of their entries, and the (dev, inode, mtime_ns)
+    validator of each directory. A directory whose validator still matches
+    is shown from the index at once while the real scan runs, and names of
+    every indexed directory can be searched without touching the disk.
+
+    Writes are made on one writer thread, one transaction per listing, and
+    only rows that changed are written. Cost and size are bounded: at most
+    max_entries entries are kept (least recently listed directories are
+    dropped first), directories over max_dir_entries are not indexed, and
+    listings arriving while WRITE_QUEUE others wait are not written.
+    '''
+    DEFAULT_MAX_ENTRIES = 1000000
+    DEFAULT_MAX_DIR_ENTRIES = 50000
+    WRITE_QUEUE = 8
+    SEARCH_LIMIT = 1000
+
+    # paths and names are bytes (BLOBs), they need not be valid UTF-8
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dirs (
+            id INTEGER PRIMARY KEY,
+            path BLOB UNIQUE NOT NULL,
+            validator TEXT NOT NULL,
+            entries INTEGER NOT NULL,
+            used REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS entries (
+            dir INTEGER NOT NULL,
+            name BLOB NOT NULL,
+            kind TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            PRIMARY KEY (dir, name)
+        ) WITHOUT ROWID;
+    """
+
+    KINDS = {kind.value: kind for kind in FileType}
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES, max_dir_entries=DEFAULT_MAX_DIR_ENTRIES):
+        if path is None:
+            path = MetadataIndex.default_path()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_dir_entries = max_dir_entries
+
+        # reads come from loader and background threads, one at a time
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            # WAL: reads don't wait for the writer
+            self.reader.execute("PRAGMA journal_mode=WAL")
+            self.reader.executescript(MetadataIndex.SCHEMA)
+
+        self.writes = queue.Queue(maxsize=MetadataIndex.WRITE_QUEUE)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self.rows_written = 0
+
+    @staticmethod
+    def default_path():
+        return os.path.join(
+                os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                "tkfm", "index.sqlite3")
+
+    @staticmethod
+    def validator_text(validator):
+        # st_ino can be past the range of SQLite integers
+        return "{} {} {}".format(*validator)
+
+    def get(self, path):
+        '''
+        Listing of path as last indexed, or None if it isn't indexed or the
+        directory changed since. Costs one stat and one query.
+        '''
+        path = str(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        validator = (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+        try:
+            with self.lock:
+                row = self.reader.execute(
+                        "SELECT id, validator FROM dirs WHERE path = ?", (os.fsencode(path),)).fetchone()
+                if row is None or row[1] != MetadataIndex.validator_text(validator):
+                    self.misses += 1
+                    return None
+                rows = self.reader.execute(
+                        "SELECT name, kind, size, mtime_ns FROM entries WHERE dir = ?", (row[0],)).fetchall()
+                self.hits += 1
+        except sqlite3.Error as e:
+            tracer.report("Cannot read index {}: {}".format(self.path, e))
+            return None
+
+        kinds = MetadataIndex.KINDS
+        listing = Listing(path)
+        for name, kind, size, mtime_ns in rows:
+            index = listing.append(name, kinds.get(kind, FileType.FILE))
+            listing.sizes[index] = size
+            listing.mtimes[index] = mtime_ns
+        listing.validator = validator
+        return listing
+
+    def search(self, query, show_hidden=False, limit=SEARCH_LIMIT):
+        '''
+        Listing rooted at "/" of indexed entries whose name contains query,
+        at most limit of them. Case is ignored for ASCII letters only.
+        '''
+        hidden = "" if show_hidden else (
+                "AND CAST(e.name AS TEXT) NOT LIKE '.%' AND CAST(d.path AS TEXT) NOT LIKE '%/.%'")
+        try:
+            with self.lock:
+                rows = self.reader.execute(
+                        "SELECT d.path, e.name, e.kind, e.size, e.mtime_ns"
+                        " FROM entries e JOIN dirs d ON d.id = e.dir"
+                        " WHERE instr(lower(CAST(e.name AS TEXT)), ?) > 0 " + hidden +
+                        " ORDER BY e.name LIMIT ?",
+                        (query.lower(), limit)).fetchall()
+        except sqlite3.Error as e:
+            tracer.report("Cannot read index {}: {}".format(self.path, e))
+            rows = []
+
+        kinds = MetadataIndex.KINDS
+        listing = Listing(os.sep)
+        for parent, name, kind, size, mtime_ns in rows:
+            # named relative to "/"
+            index = listing.append(os.path.join(parent, name)[1:], kinds.get(kind, FileType.FILE))
+            listing.sizes[index] = size
+            listing.mtimes[index] = mtime_ns
+        return listing
+
+    def put(self, listing):
+        '''
+        Index a listing that was just scanned. Its columns are copied here,
+        the writer thread compares them with the index and writes changes.
+        '''
+        if listing.validator is None:
+            return
+        entries = len(listing) - len(listing.removed)
+        if entries > self.max_dir_entries:
+            snapshot = (os.fsencode(listing.path), None)
+        else:
+            snapshot = (os.fsencode(listing.path), MetadataIndex.validator_text(listing.validator),
+                        bytes(listing.names), array("I", listing.offsets), bytes(listing.kinds),
+                        array("q", listing.sizes), array("q", listing.mtimes), set(listing.removed))
+        try:
+            self.writes.put_nowait(snapshot)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_loop(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            snapshot = self.writes.get()
+            try:
+                if snapshot is None:
+                    db.close()
+                    return
+                with db:
+                    self.write(db, *snapshot)
+            except sqlite3.Error as e:
+                tracer.report("Cannot write index {}: {}".format(self.path, e))
+            finally:
+                self.writes.task_done()
+
+    def write(self, db, path, validator, names=None, offsets=None, kinds=None, sizes=None, mtimes=None, removed=()):
+        # writer thread, inside a transaction
+        row = db.execute("SELECT id FROM dirs WHERE path = ?", (path,)).fetchone()
+        if validator is None:
+            # too big to index
+            if row is not None:
+                self.remove(db, row[0])
+            return
+
+        kind_values = [kind.value for kind in Listing.KINDS]
+        rows = {}
+        for index in range(len(kinds)):
+            if index not in removed:
+                name = names[offsets[index]:offsets[index + 1] - 1]
+                rows[name] = (kind_values[kinds[index]], sizes[index], mtimes[index])
+
+        if row is None:
+            dir_id = db.execute("INSERT INTO dirs (path, validator, entries, used) VALUES (?, ?, 0, 0)",
+                                (path, validator)).lastrowid
+            old = {}
+        else:
+            dir_id = row[0]
+            old = {name: (kind, size, mtime_ns) for name, kind, size, mtime_ns in db.execute(
+                    "SELECT name, kind, size, mtime_ns FROM entries WHERE dir = ?", (dir_id,))}
+
+        deleted = [(dir_id, name) for name in old if name not in rows]
+        changed = []
+        for name, (kind, size, mtime_ns) in rows.items():
+            previous = old.get(name)
+            if size == Listing.UNKNOWN and previous is not None and previous[0] == kind:
+                # not stat'ed this time, keep what is known
+                continue
+            if previous != (kind, size, mtime_ns):
+                changed.append((dir_id, name, kind, size, mtime_ns))
+
+        db.executemany("DELETE FROM entries WHERE dir = ? AND name = ?", deleted)
+        db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", changed)
+        db.execute("UPDATE dirs SET validator = ?, entries = ?, used = ? WHERE id = ?",
+                   (validator, len(rows), time.time(), dir_id))
+        self.rows_written += len(deleted) + len(changed)
+
+        self.trim(db, dir_id)
+
+    def trim(self, db, keep):
+        # drop least recently listed directories until under max_entries
+        total = db.execute("SELECT COALESCE(SUM(entries), 0) FROM dirs").fetchone()[0]
+        if total <= self.max_entries:
+            return
+        for dir_id, entries in db.execute(
+                "SELECT id, entries FROM dirs WHERE id != ? ORDER BY used", (keep,)).fetchall():
+            self.remove(db, dir_id)
+            total -= entries
+            if total <= self.max_entries:
+                break
+
+    def remove(self, db, dir_id):
+        db.execute("DELETE FROM entries WHERE dir = ?", (dir_id,))
+        db.execute("DELETE FROM dirs WHERE id = ?", (dir_id,))
+
+    def flush(self):
+        # wait until queued listings are written
+        self.writes.join()
+
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+        with self.lock:
+            self.reader.close()
+
+    def get_stats(self):
+        with self.lock:
+            dirs, entries = self.reader.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(entries), 0) FROM dirs").fetchone()
+        return {
+            "dirs": dirs,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "dropped": self.dropped,
+            "rows_written": self.rows_written,
+        }
+
+
+class DirLoader(threading.Thread):
+    '''
+    Lists a directory off the Tk thread. Batches are put on results as
+    (generation, kind, payload) and picked up by FileManager.poll_loader.
+    The payload of a batch is the range of new indexes in self.listing.
+    With a MetadataIndex, the indexed listing is put first as "indexed",
+    but only if the scan has nothing to show after INDEX_DEADLINE seconds:
+    reading the index costs more than scanning a local disk, it pays off
+    on slow or remote media.
+    '''
+    BATCH_SIZE = 256
+    INDEX_DEADLINE = 0.05
+
+    def __init__(self, path, generation, results, cache=None, watcher=None, load_stats=False, index=None):
+        super().__init__(daemon=True)
+        self.listing = Listing(path)
+        self.generation = generation
+        self.results = results
+        self.cache = cache
+        self.watcher = watcher
+        self.index = index
+        # stat entries here when the sort order needs size/mtime
+        self.load_stats = load_stats
+        self.cancelled = threading.Event()
+        # set once the scan put anything on results, under lock, so an
+        # indexed listing is never put after scanned batches
+        self.scanned = False
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        with tracer.span("list_dir", path=self.listing.path):
+            self.load()
+
+    def load(self):
+        # Watch before scanning, so changes made during the scan are seen
+        if self.watcher is not None:
+            try:
+                self.watcher.watch(self.listing.path, self.generation)
+            except OSError as e:
+                tracer.report("Cannot watch {}: {}".format(self.listing.path, e))
+
+        if self.cache is not None:
+            cached = self.cache.get(self.listing.path)
+            if cached is not None:
+                if self.load_stats and not cached.stats_loaded:
+                    cached.load_stats()
+                self.results.put((self.generation, "cached", cached))
+                return
+
+        timer = None
+        if self.index is not None:
+            timer = threading.Timer(DirLoader.INDEX_DEADLINE, self.load_indexed)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            # load_stats can be turned on mid-scan, entries before are stat-ed then
+            statted = 0
+            for batch in self.listing.scan_batches(DirLoader.BATCH_SIZE, self.cancelled):
+                if self.cancelled.is_set():
+                    return
+                if self.load_stats and batch:
+                    for index in range(statted, batch[-1] + 1):
+                        self.listing.fetch_stat(index)
+                    statted = batch[-1] + 1
+                self.put("batch", batch)
+            self.listing.stats_loaded = self.load_stats
+        except OSError as e:
+            self.put("error", e)
+            return
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if not self.cancelled.is_set():
+            if self.cache is not None:
+                self.cache.put(self.listing)
+            self.put("done", self.listing)
+            if self.index is not None:
+                self.index.put(self.listing)
+
+    def put(self, kind, payload):
+        with self.lock:
+            self.scanned = True
+            self.results.put((self.generation, kind, payload))
+
+    def load_indexed(self):
+        # the scan is slow: show the indexed listing until it is done
+        if self.scanned or self.cancelled.is_set():
+            return
+        indexed = self.index.get(self.listing.path)
+        with self.lock:
+            if indexed is not None and not self.scanned and not self.cancelled.is_set():
+                self.results.put((self.generation, "indexed", indexed))
+
+
+class SearchIndex:
+    '''
+    Filename index of everything below root, built on a background thread.
+    Names are indexed by trigram, so a query only checks the names in the
+    shortest posting list. While the index is still being built, every new
+    batch is matched against the current query and the matches are
+    streamed through results as (query_id, indexes, reset), indexes into
+    self.listing.
+    '''
+    BATCH_SIZE = 1000
+
+    def __init__(self, root, show_hidden=False):
+        self.root = str(root)
+        self.show_hidden = show_hidden
+
+        # Entries are named by their path relative to root
+        self.listing = Listing(root)
+        # lowercase basename of each entry
+        self.names = []
+        # trigram -> entry indexes
+        self.trigrams = {}
+
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.built = False
+
+        self.query = ""
+        self.query_id = 0
+        self.results = queue.Queue()
+
+        self.thread = threading.Thread(target=self.build, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def trigrams_of(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def build(self):
+        stack = [""]
+        batch = []
+
+        while stack and not self.cancelled.is_set():
+            rel = stack.pop()
+            try:
+                with os.scandir(os.path.join(self.root, rel)) as it:
+                    for direntry in it:
+                        name = direntry.name
+                        if not self.show_hidden and name.startswith("."):
+                            continue
+
+                        relname = os.path.join(rel, name)
+                        try:
+                            is_dir = direntry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            is_dir = False
+
+                        if is_dir:
+                            stack.append(relname)
+                            kind = FileType.DIRECTORY
+                        else:
+                            kind = FileType.from_filename(name)
+
+                        batch.append((relname, kind))
+                        if len(batch) >= SearchIndex.BATCH_SIZE:
+                            self.add_batch(batch)
+                            batch = []
+            except OSError:
+                continue
+
+        if self.cancelled.is_set():
+            return
+        self.add_batch(batch)
+        self.built = True
+
+    def add_batch(self, batch):
+        with self.lock:
+            start = len(self.names)
+            for relname, kind in batch:
+                i = self.listing.append(os.fsencode(relname), kind)
+                name = os.path.basename(relname).lower()
+                self.names.append(name)
+                for trigram in SearchIndex.trigrams_of(name):
+                    ids = self.trigrams.get(trigram)
+                    if ids is None:
+                        ids = self.trigrams[trigram] = array("I")
+                    ids.append(i)
+
+            if self.query:
+                query = self.query
+                matches = [i for i in range(start, len(self.names)) if query in self.names[i]]
+                if matches:
+                    self.results.put((self.query_id, matches, False))
+
+    def set_query(self, query):
+        '''
+        Start a new query, returns its id. Matches among the names indexed
+        so far are put on results right away, later ones as they are indexed.
+        '''
+        with self.lock:
+            self.query_id += 1
+            self.query = query.lower()
+            self.results.put((self.query_id, self.lookup(self.query), True))
+            return self.query_id
+
+    def lookup(self, query):
+        # caller holds the lock
+        if not query:
+            return []
+
+        names = self.names
+        if len(query) < 3:
+            ids = range(len(names))
+        else:
+            postings = []
+            for trigram in SearchIndex.trigrams_of(query):
+                ids = self.trigrams.get(trigram)
+                if ids is None:
+                    return []
+                postings.append(ids)
+            ids = min(postings, key=len)
+
+        return [i for i in ids if query in names[i]]
+
+
+def delete_paths(paths):
+    '''
+    Delete paths for good, directories with everything in them. Symlinks
+    are removed, not followed. Returns (deleted, errors).
+    '''
+    deleted = []
+    errors = []
+    for path in paths:
+        path = os.path.abspath(str(path))
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            deleted.append(path)
+        except OSError as e:
+            errors.append((path, e))
+    return deleted, errors
+
+
+def unique_path(path, taken=()):
+    '''
+    path, or "name (2).ext", "name (3).ext"... if path already exists or
+    is in taken
+    '''
+    def free(candidate):
+        return candidate not in taken and not os.path.lexists(candidate)
+
+    if free(path):
+        return path
+
+    base, ext = os.path.splitext(path)
+    n = 2
+    while not free("{} ({}){}".format(base, n, ext)):
+        n += 1
+    return "{} ({}){}".format(base, n, ext)
+
+
+class TransferJob:
+    '''
+    Copy or move sources into dest_dir on worker threads.
+
+    Moves within one filesystem are a single atomic rename per item.
+    Everything else is planned first (directories, files, symlinks), then
+    files are copied by a bounded pool using copy_file_range, sendfile, or
+    a large buffer, in that order of preference. Metadata is kept with
+    copystat. With dry_run, only the plan is made and counted.
+    '''
+    WORKERS = 4
+    BUFFER_SIZE = 1024 * 1024
+    # bytes per copy_file_range/sendfile call, small enough to cancel
+    CHUNK_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, sources, dest_dir, move=False, dry_run=False, workers=WORKERS, rename_to=None):
+        self.sources = [str(s) for s in sources]
+        self.dest_dir = str(dest_dir)
+        # new name for a single source, used as given: if it exists the
+        # transfer fails instead of picking a free name
+        self.rename_to = rename_to
+        self.move = move
+        self.dry_run = dry_run
+        self.workers = workers
+
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+        # names created in dest_dir, for the view update
+        self.created = []
+        self.errors = []
+
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.files_total = 0
+        self.files_done = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def progress(self):
+        end = self.finished_at or time.monotonic()
+        elapsed = max(end - (self.started_at or end), 1e-6)
+        with self.lock:
+            return {
+                "bytes": self.bytes_done,
+                "bytes_total": self.bytes_total,
+                "files": self.files_done,
+                "files_total": self.files_total,
+                "bytes_per_sec": self.bytes_done / elapsed,
+                "errors": len(self.errors),
+                "done": self.done.is_set(),
+            }
+
+    def run(self):
+        try:
+            self.transfer()
+        except Exception as e:
+            self.errors.append((self.dest_dir, e))
+        finally:
+            self.finished_at = time.monotonic()
+            self.done.set()
+
+    def transfer(self):
+        dest_dev = os.stat(self.dest_dir).st_dev
+
+        dirs = []
+        files = []
+        links = []
+        # cross-device moves are copied, then the sources are removed
+        to_remove = []
+        # destinations given out so far: sources with the same name (from
+        # search or duplicate results) must not get the same one
+        claimed = set()
+
+        for src in self.sources:
+            if self.cancelled.is_set():
+                return
+
+            name = self.rename_to or os.path.basename(os.path.normpath(src))
+            dst = os.path.join(self.dest_dir, name)
+
+            if self.move and os.path.normpath(src) == os.path.normpath(dst):
+                # moving onto itself
+                continue
+            if self.rename_to is None:
+                dst = unique_path(dst, claimed)
+            elif dst in claimed or os.path.lexists(dst):
+                self.errors.append((src, FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)))
+                continue
+            claimed.add(dst)
+
+            try:
+                st = os.lstat(src)
+            except OSError as e:
+                self.errors.append((src, e))
+                continue
+
+            if self.move and st.st_dev == dest_dev:
+                if not self.dry_run:
+                    try:
+                        os.rename(src, dst)
+                    except OSError as e:
+                        self.errors.append((src, e))
+                        continue
+                self.created.append(os.path.basename(dst))
+                continue
+
+            self.plan(src, dst, st, dirs, files, links)
+            self.created.append(os.path.basename(dst))
+            if self.move:
+                to_remove.append(src)
+
+        with self.lock:
+            self.files_total = len(files) + len(links)
+            self.bytes_total = sum(size for _, _, size in files)
+
+        if self.dry_run:
+            return
+
+        # destinations are created exclusively, anything already there
+        # is an error rather than merged into or overwritten
+        for src, dst in dirs:
+            try:
+                os.mkdir(dst)
+            except OSError as e:
+                self.errors.append((src, e))
+
+        for src, dst in links:
+            self.copy_link(src, dst)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for src, dst, size in files:
+                executor.submit(self.copy_file, src, dst)
+
+        # directory times after their contents are written
+        for src, dst in reversed(dirs):
+            try:
+                shutil.copystat(src, dst)
+            except OSError as e:
+                self.errors.append((dst, e))
+
+        if self.cancelled.is_set():
+            return
+
+        for src in to_remove:
+            if self.errors:
+                # never delete sources of a copy that had errors
+                break
+            if os.path.isdir(src) and not os.path.islink(src):
+                shutil.rmtree(src)
+            else:
+                os.remove(src)
+
+    def plan(self, src, dst, st, dirs, files, links):
+        if stat.S_ISLNK(st.st_mode):
+            links.append((src, dst))
+        elif stat.S_ISDIR(st.st_mode):
+            dirs.append((src, dst))
+            try:
+                with os.scandir(src) as it:
+                    for direntry in it:
+                        if self.cancelled.is_set():
+                            return
+                        child_st = direntry.stat(follow_symlinks=False)
+                        self.plan(direntry.path, os.path.join(dst, direntry.name), child_st, dirs, files, links)
+            except OSError as e:
+                self.errors.append((src, e))
+        elif stat.S_ISREG(st.st_mode):
+            files.append((src, dst, st.st_size))
+        # sockets, fifos and devices are skipped
+
+    def copy_link(self, src, dst):
+        try:
+            os.symlink(os.readlink(src), dst)
+        except OSError as e:
+            self.errors.append((src, e))
+        with self.lock:
+            self.files_done += 1
+
+    def copy_file(self, src, dst):
+        if self.cancelled.is_set():
+            return
+
+        try:
+            with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+                self.copy_data(fsrc, fdst)
+            if self.cancelled.is_set():
+                os.remove(dst)
+                return
+            shutil.copystat(src, dst)
+        except OSError as e:
+            self.errors.append((src, e))
+            return
+
+        with self.lock:
+            self.files_done += 1
+
+    def copy_data(self, fsrc, fdst):
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+
+        # kernel side copy: copy_file_range (reflinks/server side copy on
+        # some filesystems), then sendfile
+        for func in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if func is None:
+                continue
+            try:
+                while not self.cancelled.is_set():
+                    if func is os.sendfile:
+                        sent = func(outfd, infd, None, TransferJob.CHUNK_SIZE)
+                    else:
+                        sent = func(infd, outfd, TransferJob.CHUNK_SIZE)
+                    if sent == 0:
+                        return
+                    self.add_bytes(sent)
+                return
+            except OSError:
+                # not supported for this pair of files, retry with the
+                # next method from where this one stopped
+                continue
+
+        buf = bytearray(TransferJob.BUFFER_SIZE)
+        view = memoryview(buf)
+        while not self.cancelled.is_set():
+            n = fsrc.readinto(buf)
+            if not n:
+                return
+            fdst.write(view[:n])
+            self.add_bytes(n)
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes_done += n
+
+
+class Trash:
+    '''
+    freedesktop.org Trash. Items go to the home trash when they are on its
+    filesystem, otherwise to $topdir/.Trash/$uid or $topdir/.Trash-$uid of
+    their mount, so trashing is always a single rename. Trash directories
+    are resolved once per device.
+    '''
+    def __init__(self, home_trash=None):
+        if home_trash is None:
+            data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+            home_trash = os.path.join(data_home, "Trash")
+        self.home_trash = home_trash
+        self.uid = os.getuid()
+
+        # st_dev -> trash directory
+        self.trash_dirs = {}
+
+    @staticmethod
+    def mount_top(path):
+        path = os.path.abspath(path)
+        dev = os.lstat(path).st_dev
+        while True:
+            parent = os.path.dirname(path)
+            if parent == path or os.lstat(parent).st_dev != dev:
+                return path
+            path = parent
+
+    def ensure(self, trash_dir):
+        for sub in ("files", "info"):
+            os.makedirs(os.path.join(trash_dir, sub), mode=0o700, exist_ok=True)
+        return trash_dir
+
+    def trash_dir_for(self, path):
+        '''
+        Returns (trash directory, top directory for relative Path= or None)
+        '''
+        dev = os.lstat(path).st_dev
+        if dev in self.trash_dirs:
+            return self.trash_dirs[dev]
+
+        self.ensure(self.home_trash)
+        if os.stat(self.home_trash).st_dev == dev:
+            result = (self.home_trash, None)
+        else:
+            top = Trash.mount_top(path)
+            shared = os.path.join(top, ".Trash")
+            try:
+                st = os.lstat(shared)
+                usable = stat.S_ISDIR(st.st_mode) and st.st_mode & stat.S_ISVTX
+            except OSError:
+                usable = False
+
+            if usable:
+                result = (self.ensure(os.path.join(shared, str(self.uid))), top)
+            else:
+                try:
+                    result = (self.ensure(os.path.join(top, ".Trash-{}".format(self.uid))), top)
+                except OSError:
+                    # read-only or foreign mount: copy to the home trash
+                    result = (self.home_trash, None)
+
+        self.trash_dirs[dev] = result
+        return result
+
+    def reserve_name(self, trash_dir, name, info):
+        '''
+        Create info/NAME.trashinfo exclusively, which claims NAME in files/
+        '''
+        base, ext = os.path.splitext(name)
+        n = 1
+        while True:
+            info_path = os.path.join(trash_dir, "info", name + ".trashinfo")
+            try:
+                fd = os.open(info_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                n += 1
+                name = "{}.{}{}".format(base, n, ext)
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(info)
+            return name, info_path
+
+    def trash(self, paths):
+        '''
+        Move paths to the trash in one pass. Returns (trashed, errors).
+        '''
+        trashed = []
+        errors = []
+        date = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+        for path in paths:
+            path = os.path.abspath(str(path))
+            info_path = None
+            try:
+                trash_dir, top = self.trash_dir_for(path)
+                original = os.path.relpath(path, top) if top else path
+                info = "[Trash Info]\nPath={}\nDeletionDate={}\n".format(
+                        urllib.parse.quote(original), date)
+
+                name, info_path = self.reserve_name(trash_dir, os.path.basename(path), info)
+                target = os.path.join(trash_dir, "files", name)
+                try:
+                    os.rename(path, target)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.move(path, target)
+                trashed.append(path)
+            except OSError as e:
+                if info_path is not None:
+                    os.remove(info_path)
+                errors.append((path, e))
+
+        return trashed, errors
+
+    def items(self, trash_dir=None):
+        '''
+        Yields (name, original path, deletion date) lazily, so very large
+        trash directories are never read into memory at once
+        '''
+        trash_dir = trash_dir or self.home_trash
+        top = self.top_of(trash_dir)
+
+        try:
+            it = os.scandir(os.path.join(trash_dir, "info"))
+        except FileNotFoundError:
+            return
+        with it:
+            for direntry in it:
+                if not direntry.name.endswith(".trashinfo"):
+                    continue
+                try:
+                    original, date = Trash.read_info(direntry.path, top)
+                except OSError:
+                    continue
+                yield direntry.name[:-len(".trashinfo")], original, date
+
+    def top_of(self, trash_dir):
+        # directory that relative Path= values in trash_dir start from
+        return None if trash_dir == self.home_trash else Trash.mount_top(trash_dir)
+
+    @staticmethod
+    def read_info(info_path, top):
+        '''
+        Returns (original path, deletion date) from a .trashinfo file
+        '''
+        fields = {}
+        with open(info_path) as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep:
+                    fields[key] = value
+
+        original = urllib.parse.unquote(fields.get("Path", ""))
+        if top and not os.path.isabs(original):
+            original = os.path.join(top, original)
+        return original, fields.get("DeletionDate", "")
+
+    def restore(self, names, trash_dir=None):
+        '''
+        Move trashed items back to where they came from. Items whose
+        original path exists again are left in the trash. Only the
+        .trashinfo files of names are read.
+        '''
+        trash_dir = trash_dir or self.home_trash
+        top = self.top_of(trash_dir)
+        restored = []
+        errors = []
+
+        for name in dict.fromkeys(names):
+            info_path = os.path.join(trash_dir, "info", name + ".trashinfo")
+            original = name
+            try:
+                original, _ = Trash.read_info(info_path, top)
+                if os.path.lexists(original):
+                    raise FileExistsError(original)
+                os.makedirs(os.path.dirname(original), exist_ok=True)
+                os.rename(os.path.join(trash_dir, "files", name), original)
+                os.remove(info_path)
+                restored.append(original)
+            except OSError as e:
+                errors.append((original, e))
+
+        return restored, errors
+
+    def empty(self, trash_dir=None):
+        '''
+        Delete everything in a trash directory, streaming over it with
+        scandir. Returns the number of items removed.
+        '''
+        trash_dir = trash_dir or self.home_trash
+        count = 0
+
+        for sub in ("files", "info"):
+            try:
+                it = os.scandir(os.path.join(trash_dir, sub))
+            except FileNotFoundError:
+                continue
+            with it:
+                for direntry in it:
+                    try:
+                        if direntry.is_dir(follow_symlinks=False):
+                            shutil.rmtree(direntry.path)
+                        else:
+                            os.remove(direntry.path)
+                        if sub == "files":
+                            count += 1
+                    except OSError as e:
+                        tracer.report("Cannot remove {}: {}".format(direntry.path, e))
+
+        # the optional size cache of the spec would be stale now
+        try:
+            os.remove(os.path.join(trash_dir, "directorysizes"))
+        except OSError:
+            pass
+
+        return count
+
+
+class DirWatcher:
+    '''
+    Watches one directory at a time and collects the names that changed.
+    Subclasses fill self.pending from their own thread; FileManager drains
+    it from the Tk loop and applies one batched update.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # held across on_watch, so watches are installed in generation order
+        self.watch_lock = threading.Lock()
+        self.path = None
+        self.generation = -1
+
+        self.pending = set()
+        # set when the names are unknown, e.g. queue overflow: rescan
+        self.overflow = False
+        self.first_event = None
+        self.last_event = None
+
+        # stats
+        self.event_count = 0
+        self.started_at = time.monotonic()
+
+    def watch(self, path, generation):
+        '''
+        Move the watch to path. Called from loader threads, so a watch
+        from a replaced navigation (older generation) is ignored.
+        '''
+        with self.watch_lock:
+            with self.lock:
+                if generation < self.generation:
+                    return
+                self.generation = generation
+                self.path = str(path)
+                self.pending = set()
+                self.overflow = False
+                self.first_event = None
+
+            self.on_watch(str(path))
+
+    def on_watch(self, path):
+        pass
+
+    def dir_validator(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    def stop(self):
+        pass
+
+    def add_events(self, names, overflow=False):
+        now = time.monotonic()
+        with self.lock:
+            self.pending.update(names)
+            self.overflow = self.overflow or overflow
+            self.event_count += max(len(names), 1)
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+
+    def drain(self, quiet, max_delay):
+        '''
+        Returns (path, names, overflow, first_event) once events have been
+        quiet for quiet seconds, or have been pending for max_delay seconds.
+        Returns None otherwise.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            if self.first_event is None:
+                return None
+            if now - self.last_event < quiet and now - self.first_event < max_delay:
+                return None
+
+            batch = (self.path, self.pending, self.overflow, self.first_event)
+            self.pending = set()
+            self.overflow = False
+            self.first_event = None
+            return batch
+
+    def get_stats(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        return {
+            "backend": type(self).__name__,
+            "events": self.event_count,
+            "events_per_sec": self.event_count / elapsed,
+        }
+
+
+class InotifyWatcher(DirWatcher):
+    '''
+    Linux inotify through ctypes. A reader thread blocks in select on the
+    inotify fd and records changed names. A directory inotify can't watch,
+    e.g. once max_user_watches is reached, is polled like PollingWatcher.
+    '''
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+            | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        super().__init__()
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.rm_watch = libc.inotify_rm_watch
+        self.rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.wd = -1
+        # path polled instead, when inotify_add_watch failed
+        self.poll_path = None
+        self.poll_validator = None
+        self.next_poll = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.read_events, daemon=True)
+        self.thread.start()
+
+    def on_watch(self, path):
+        '''
+        Raises OSError if inotify can't watch path, the path is then polled.
+        '''
+        wd = self.add_watch(self.fd, os.fsencode(path), InotifyWatcher.MASK)
+        err = ctypes.get_errno() if wd < 0 else 0
+        validator = self.dir_validator(path) if wd < 0 else None
+
+        with self.lock:
+            old, self.wd = self.wd, wd
+            self.poll_path = path if wd < 0 else None
+            self.poll_validator = validator
+        if old >= 0 and old != wd:
+            self.rm_watch(self.fd, old)
+
+        if wd < 0:
+            raise OSError(err, os.strerror(err), path)
+
+    def poll_fallback(self):
+        now = time.monotonic()
+        if self.poll_path is None or now < self.next_poll:
+            return
+        self.next_poll = now + PollingWatcher.INTERVAL
+
+        path = self.poll_path
+        validator = self.dir_validator(path)
+        with self.lock:
+            if path != self.poll_path or validator == self.poll_validator:
+                return
+            self.poll_validator = validator
+        self.add_events([], overflow=True)
+
+    def stop(self):
+        self.stopped = True
+
+    def read_events(self):
+        while not self.stopped:
+            ready, _, _ = select.select([self.fd], [], [], 0.25)
+            self.poll_fallback()
+            if not ready:
+                continue
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+
+            names = []
+            overflow = False
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = InotifyWatcher.EVENT.unpack_from(buf, offset)
+                offset += InotifyWatcher.EVENT.size
+                name = buf[offset:offset + length].split(b"\0", 1)[0]
+                offset += length
+
+                if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                    overflow = True
+                elif wd != self.wd or mask & InotifyWatcher.IN_IGNORED:
+                    # event for a directory we already left
+                    continue
+                elif mask & (InotifyWatcher.IN_DELETE_SELF | InotifyWatcher.IN_MOVE_SELF):
+                    overflow = True
+                elif name:
+                    names.append(os.fsdecode(name))
+
+            if names or overflow:
+                self.add_events(names, overflow)
+
+        os.close(self.fd)
+
+
+class PollingWatcher(DirWatcher):
+    '''
+    Fallback when inotify is not available: checks the directory mtime
+    every INTERVAL seconds and asks for a rescan when it changed.
+    '''
+    INTERVAL = 1.0
+
+    def __init__(self):
+        super().__init__()
+        self.validator = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+
+    def on_watch(self, path):
+        self.validator = self.dir_validator(path)
+
+    def stop(self):
+        self.stopped = True
+
+    def poll(self):
+        while not self.stopped:
+            time.sleep(PollingWatcher.INTERVAL)
+
+            path = self.path
+            if path is None:
+                continue
+
+            validator = self.dir_validator(path)
+            if validator != self.validator and path == self.path:
+                self.validator = validator
+                self.add_events([], overflow=True)
+
+
+def make_watcher():
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError):
+        # no libc inotify (not Linux)
+        return PollingWatcher()
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1024 or unit == "TB":
+            break
+        size /= 1024
+    if unit == "B":
+        return "{} {}".format(int(size), unit)
+    return "{:.1f} {}".format(size, unit)
+
+
+class SizeMemo:
+    '''
+    Bounded LRU of finished subtree totals for DirSizer, keyed by
+    (dev, inode, mtime_ns) of the directory. The budget counts one per
+    directory plus one per hard link it carries; the least recently used
+    subtrees are dropped first. Filled from DirSizer threads, so access
+    goes through a lock.
+    '''
+    DEFAULT_BUDGET = 200000
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.used = 0
+
+        # key -> (size, files, links)
+        self.totals = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.evictions = 0
+
+    @staticmethod
+    def cost(totals):
+        return 1 + len(totals[2])
+
+    def get(self, key):
+        with self.lock:
+            totals = self.totals.get(key)
+            if totals is not None:
+                self.totals.move_to_end(key)
+            return totals
+
+    def put(self, key, totals):
+        with self.lock:
+            old = self.totals.pop(key, None)
+            if old is not None:
+                self.used -= SizeMemo.cost(old)
+            self.totals[key] = totals
+            self.used += SizeMemo.cost(totals)
+
+            while self.used > self.budget:
+                _, dropped = self.totals.popitem(last=False)
+                self.used -= SizeMemo.cost(dropped)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self.totals)
+
+
+class SizeNode:
+    '''
+    One directory being sized by DirSizer. Files with more than one link
+    are kept apart in links, keyed by (dev, inode), so that they are
+    counted once even when they show up in several subtrees.
+    '''
+    __slots__ = ("path", "key", "parent", "pending", "size", "files", "links")
+
+    def __init__(self, path, key, parent):
+        self.path = path
+        self.key = key
+        self.parent = parent
+        # this node's own scan plus unfinished child directories
+        self.pending = 1
+        self.size = 0
+        self.files = 0
+        self.links = {}
+
+    def add(self, size, files, links):
+        self.size += size
+        self.files += files
+        if links:
+            self.links.update(links)
+
+    def total(self):
+        return self.size + sum(self.links.values())
+
+
+class DirSizer:
+    '''
+    Recursive directory size, walked in parallel on a thread pool. Finished
+    subtrees are memoized in memo, a SizeMemo keyed by (dev, inode,
+    mtime_ns) of the directory, so asking again or asking about a parent
+    reuses them.
+
+    Note the memo key only changes when the directory itself changes, so a
+    file growing deeper in the tree is not noticed until that directory
+    (or an ancestor) is modified.
+    '''
+    WORKERS = 8
+
+    def __init__(self, path, memo, workers=WORKERS):
+        self.path = str(path)
+        self.memo = memo
+        self.workers = workers
+
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.executor = None
+
+        # running totals, for progress
+        self.bytes_seen = 0
+        self.files_seen = 0
+        self.dirs_seen = 0
+        self.errors = 0
+        self.seen_links = set()
+
+        self.result = None
+
+    def start(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self.errors += 1
+            self.result = 0
+            self.done.set()
+            return self
+
+        key = self.dir_key(st)
+        memoized = self.memo.get(key)
+        if memoized is not None:
+            size, files, links = memoized
+            self.bytes_seen = self.result = size + sum(links.values())
+            self.files_seen = files
+            self.done.set()
+            return self
+
+        root = SizeNode(self.path, key, None)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.executor.submit(self.visit, root)
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+        self.done.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.result
+
+    def progress(self):
+        with self.lock:
+            return {
+                "bytes": self.bytes_seen,
+                "files": self.files_seen,
+                "dirs": self.dirs_seen,
+                "errors": self.errors,
+                # also set by cancel(), with no result
+                "done": self.done.is_set(),
+                "cancelled": self.cancelled.is_set(),
+            }
+
+    @staticmethod
+    def dir_key(st):
+        return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    def visit(self, node):
+        if self.cancelled.is_set():
+            return
+
+        size = 0
+        files = 0
+        links = {}
+        children = []
+        errors = 0
+
+        try:
+            with os.scandir(node.path) as it:
+                for direntry in it:
+                    try:
+                        st = direntry.stat(follow_symlinks=False)
+                    except OSError:
+                        errors += 1
+                        continue
+
+                    if stat.S_ISDIR(st.st_mode):
+                        key = self.dir_key(st)
+                        memoized = self.memo.get(key)
+                        if memoized is not None:
+                            m_size, m_files, m_links = memoized
+                            size += m_size
+                            files += m_files
+                            links.update(m_links)
+                        else:
+                            children.append(SizeNode(direntry.path, key, node))
+                    elif st.st_nlink > 1:
+                        links[(st.st_dev, st.st_ino)] = st.st_size
+                        files += 1
+                    else:
+                        size += st.st_size
+                        files += 1
+        except OSError:
+            errors += 1
+
+        with self.lock:
+            node.add(size, files, links)
+            node.pending += len(children)
+
+            self.dirs_seen += 1
+            self.files_seen += files
+            self.errors += errors
+            self.bytes_seen += size
+            for link, link_size in links.items():
+                if link not in self.seen_links:
+                    self.seen_links.add(link)
+                    self.bytes_seen += link_size
+
+        for child in children:
+            if self.cancelled.is_set():
+                return
+            try:
+                self.executor.submit(self.visit, child)
+            except RuntimeError:
+                # executor shut down by cancel()
+                return
+
+        self.finish(node)
+
+    def finish(self, node):
+        '''
+        Drop one pending count of node. The last one to finish memoizes the
+        subtree and folds it into the parent.
+        '''
+        while node is not None:
+            with self.lock:
+                node.pending -= 1
+                if node.pending > 0 or self.cancelled.is_set():
+                    return
+
+                self.memo.put(node.key, (node.size, node.files, node.links))
+
+                parent = node.parent
+                if parent is not None:
+                    parent.add(node.size, node.files, node.links)
+                else:
+                    self.result = node.total()
+
+            if parent is None:
+                self.done.set()
+                self.executor.shutdown(wait=False)
+
+            node = parent
+
+
+class DuplicateFinder:
+    '''
+    Groups of identical files below root. Files are grouped by size, then
+    by a hash of their first and last PARTIAL_BLOCK bytes, and only the
+    files still sharing a group are hashed in full. Size groups are hashed
+    on a thread pool, a few at a time, so only the hashes of the groups in
+    flight are held however big the tree is.
+
+    Every duplicate group is put on results as soon as it is known, as an
+    array of indexes into self.listing, where files are named by their path
+    relative to root. Groups of larger files come first.
+    '''
+    WORKERS = 4
+    PARTIAL_BLOCK = 16 * 1024
+    CHUNK = 1024 * 1024
+    # empty files are all equal, they are not reported
+    MIN_SIZE = 1
+
+    def __init__(self, root, show_hidden=False, workers=WORKERS):
+        self.root = str(root)
+        self.show_hidden = show_hidden
+        self.workers = workers
+
+        # regular files below root, with sizes and mtimes from the walk
+        self.listing = Listing(root)
+
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.results = queue.Queue()
+        self.thread = None
+
+        # for progress
+        self.phase = "scanning"
+        self.files_seen = 0
+        # files sharing their size with another one
+        self.candidates = 0
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.groups_found = 0
+        # bytes freed by keeping one file of each group
+        self.extra_bytes = 0
+        self.errors = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def progress(self):
+        with self.lock:
+            return {
+                "phase": self.phase,
+                "files": self.files_seen,
+                "candidates": self.candidates,
+                "hashed": self.files_hashed,
+                "bytes_hashed": self.bytes_hashed,
+                "groups": self.groups_found,
+                "extra_bytes": self.extra_bytes,
+                "errors": self.errors,
+                "done": self.done.is_set(),
+                "cancelled": self.cancelled.is_set(),
+            }
+
+    def run(self):
+        try:
+            self.scan()
+            if not self.cancelled.is_set():
+                self.phase = "hashing"
+                self.hash_all()
+        finally:
+            self.phase = "done"
+            self.done.set()
+
+    def scan(self):
+        listing = self.listing
+        # (dev, inode) of files with several links, each is counted once
+        seen_links = set()
+        stack = [""]
+
+        while stack and not self.cancelled.is_set():
+            rel = stack.pop()
+            errors = 0
+            try:
+                with os.scandir(os.path.join(self.root, rel)) as it:
+                    for direntry in it:
+                        name = direntry.name
+                        if not self.show_hidden and name.startswith("."):
+                            continue
+                        try:
+                            st = direntry.stat(follow_symlinks=False)
+                        except OSError:
+                            errors += 1
+                            continue
+
+                        relname = os.path.join(rel, name)
+                        if stat.S_ISDIR(st.st_mode):
+                            stack.append(relname)
+                            continue
+                        if not stat.S_ISREG(st.st_mode) or st.st_size < DuplicateFinder.MIN_SIZE:
+                            continue
+                        if st.st_nlink > 1:
+                            link = (st.st_dev, st.st_ino)
+                            if link in seen_links:
+                                continue
+                            seen_links.add(link)
+
+                        index = listing.append(os.fsencode(relname), FileType.from_filename(name))
+                        listing.sizes[index] = st.st_size
+                        listing.mtimes[index] = st.st_mtime_ns
+            except OSError:
+                errors += 1
+
+            with self.lock:
+                self.files_seen = len(listing)
+                self.errors += errors
+
+    def size_groups(self):
+        '''
+        Yields index arrays of files of the same size, largest size first
+        '''
+        sizes = self.listing.sizes
+        order = array("I", sorted(range(len(sizes)), key=sizes.__getitem__, reverse=True))
+
+        start = 0
+        while start < len(order):
+            size = sizes[order[start]]
+            end = start + 1
+            while end < len(order) and sizes[order[end]] == size:
+                end += 1
+            if end - start > 1:
+                yield order[start:end]
+            start = end
+
+    def hash_all(self):
+        groups = list(self.size_groups())
+        with self.lock:
+            self.candidates = sum(len(group) for group in groups)
+
+        # a few groups are queued ahead of the workers, not all of them
+        slots = threading.Semaphore(self.workers * 2)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for group in groups:
+                slots.acquire()
+                if self.cancelled.is_set():
+                    break
+                future = executor.submit(self.hash_group, group)
+                future.add_done_callback(lambda _: slots.release())
+
+    def hash_group(self, indexes):
+        size = self.listing.sizes[indexes[0]]
+        # the partial hash reads small files whole
+        whole = size <= 2 * DuplicateFinder.PARTIAL_BLOCK
+
+        for same in self.split(indexes, full=False):
+            if whole:
+                self.report(same, size)
+                continue
+            for identical in self.split(same, full=True):
+                self.report(identical, size)
+
+    def split(self, indexes, full):
+        '''
+        Groups of 2 or more of indexes with the same hash
+        '''
+        by_hash = {}
+        for index in indexes:
+            if self.cancelled.is_set():
+                return []
+            digest = self.digest(index, full)
+            if digest is not None:
+                by_hash.setdefault(digest, []).append(index)
+        return [same for same in by_hash.values() if len(same) > 1]
+
+    def digest(self, index, full):
+        size = self.listing.sizes[index]
+        path = os.path.join(self.root, self.listing.name(index))
+        block = DuplicateFinder.PARTIAL_BLOCK
+        h = hashlib.blake2b(digest_size=16)
+        read = 0
+        try:
+            with open(path, "rb") as f:
+                if not full:
+                    data = f.read(block)
+                    if size > block:
+                        f.seek(max(block, size - block))
+                        data += f.read(block)
+                    h.update(data)
+                    read = len(data)
+                else:
+                    for chunk in iter(partial(f.read, DuplicateFinder.CHUNK), b""):
+                        if self.cancelled.is_set():
+                            return None
+                        h.update(chunk)
+                        read += len(chunk)
+        except OSError:
+            with self.lock:
+                self.errors += 1
+            return None
+
+        with self.lock:
+            if not full:
+                self.files_hashed += 1
+            self.bytes_hashed += read
+        return h.digest()
+
+    def report(self, indexes, size):
+        name = self.listing.name
+        group = array("I", sorted(indexes, key=name))
+        with self.lock:
+            self.groups_found += 1
+            self.extra_bytes += size * (len(group) - 1)
+        self.results.put(group)
+
+
+class Selection:
+    '''
+    Selected rows of FilesFrame, independent of the row widgets.
+
+    Selection is stored by filename as a set of keys and an inverted flag,
+    so select all and clear are O(1), as are toggling and membership, and
+    it survives refreshes. A shift-click range is kept as an interval of
+    view rows (O(1) to set, O(log n) to test) and is only turned into keys
+    when the view changes under it.
+    '''
+    def __init__(self):
+        self.keys = set()
+        # when True, self.keys holds the deselected names instead
+        self.inverted = False
+        # sorted, disjoint [lo, hi) intervals of rows in self.view
+        self.ranges = []
+        self.view = []
+
+        # row and name of the last plain or ctrl click, for shift-click
+        self.anchor_row = None
+        self.anchor_key = None
+
+    def set_view(self, files):
+        if files is self.view:
+            return
+        if self.ranges:
+            self.materialize()
+        self.view = files
+        self.anchor_row = None
+
+    def materialize(self):
+        ranges, self.ranges = self.ranges, []
+        for lo, hi in ranges:
+            for entry in self.view[lo:hi]:
+                self.set_key(entry.name, True)
+
+    def in_ranges(self, row):
+        i = bisect.bisect_right(self.ranges, (row, float("inf"))) - 1
+        return i >= 0 and self.ranges[i][0] <= row < self.ranges[i][1]
+
+    def is_selected(self, row, key):
+        if self.ranges and self.in_ranges(row):
+            return True
+        return (key in self.keys) != self.inverted
+
+    def set_key(self, key, selected):
+        if selected != self.inverted:
+            self.keys.add(key)
+        else:
+            self.keys.discard(key)
+
+    def is_empty(self):
+        return not self.inverted and not self.keys and not self.ranges
+
+    def clear(self):
+        self.keys = set()
+        self.inverted = False
+        self.ranges = []
+
+    def select_all(self):
+        self.keys = set()
+        self.inverted = True
+        self.ranges = []
+
+    def select_only(self, row, key):
+        self.clear()
+        self.set_key(key, True)
+        self.set_anchor(row, key)
+
+    def toggle(self, row, key):
+        if self.ranges:
+            self.materialize()
+        self.set_key(key, not self.is_selected(row, key))
+        self.set_anchor(row, key)
+
+    def set_anchor(self, row, key):
+        self.anchor_row = row
+        self.anchor_key = key
+
+    def select_range(self, row):
+        '''
+        Select everything between the anchor and row, replacing the selection
+        '''
+        anchor = self.anchor_row
+        if anchor is None or anchor >= len(self.view) or self.view[anchor].name != self.anchor_key:
+            # the view changed since the anchor was set
+            anchor = next((i for i, e in enumerate(self.view) if e.name == self.anchor_key), row)
+            self.anchor_row = anchor
+
+        self.clear()
+        self.ranges = [(min(anchor, row), max(anchor, row) + 1)]
+
+    def remove_keys(self, names):
+        if not self.inverted:
+            self.keys.difference_update(names)
+
+    def selected_keys(self):
+        '''
+        Selected names in view order. Linear, only used to act on them.
+        '''
+        if self.is_empty():
+            return []
+        return [e.name for row, e in enumerate(self.view) if self.is_selected(row, e.name)]
 
 
 class Item:
-    def __init__(self, root, row, filename, filetype):
+    '''
+    A pooled row slot in FilesFrame. Slots are never destroyed while the
+    frame lives, they are re-bound to whichever entry is scrolled into view.
+    '''
+    def __init__(self, root, slot):
         self.root = root
+        self.slot = slot
+
+        self.row = None
+        self.filename = None
+        self.filetype = None
+
+        self.label = ItemLabel(root)
+
+        # Fixed height rows so a row index maps directly to a y offset
+        self.label.place(
+                x=0, y=slot * FilesFrame.ROW_HEIGHT,
+                height=FilesFrame.ROW_HEIGHT, relwidth=1
+                )
+
+    def show(self, row, filename, filetype, selected=False, icon=None):
         self.row = row
         self.filename = filename
         self.filetype = filetype
 
-        self.label = ItemLabel(root, filename, filetype)
+        self.label.set_item(row, filename, filetype, icon)
+        self.label.set_selected(selected)
 
-        # Grid
-        self.label.grid(row=row, column=0, sticky="w")
+        if not self.label.winfo_ismapped():
+            self.label.place(
+                    x=0, y=self.slot * FilesFrame.ROW_HEIGHT,
+                    height=FilesFrame.ROW_HEIGHT, relwidth=1
+                    )
+
+    def hide(self):
+        self.row = None
+        self.label.place_forget()
 
     def destroy(self):
         # destroy icon and label
@@ -41,29 +3716,47 @@ class ItemLabel(tkinter.Label):
     COLOR_SELECTED = "cyan"
     COLOR_DESELECTED = "white"
 
-    def __init__(self, root, filename, filetype):
-        self.icon = tkinter.PhotoImage(data=filetype.get_icon())
-
+    def __init__(self, root):
         super().__init__(
                 root,
-                text=filename,
-                image=self.icon,
                 compound="left",
+                anchor="w",
                 bg=ItemLabel.COLOR_DESELECTED
                 )
 
         self.root = root
         self.fm = root.fm
 
-        self.filename = filename
-        self.filetype = filetype
+        self.row = None
+        self.filename = None
+        self.filetype = None
+        self.icon = None
 
         # Events
         self.bind("<Button-1>", self.on_click)
         self.bind("<Double-Button-1>", self.on_doubleclick)
+        self.bind("<Button-2>", self.on_right_click)
+        self.bind("<Button-3>", self.on_right_click)
 
         self.selected = False
 
+    def set_item(self, row, filename, filetype, icon=None):
+        '''
+        icon: thumbnail to show instead of the icon for the file type
+        '''
+        self.row = row
+
+        if icon is None:
+            icon = icon_registry.for_file(filename, filetype)
+        if icon is not self.icon:
+            self.icon = icon
+            self.configure(image=icon)
+
+        if filename != self.filename:
+            self.configure(text=filename)
+
+        self.filename = filename
+        self.filetype = filetype
 
     def set_selected(self, val):
         if val == self.selected:
@@ -84,17 +3777,27 @@ class ItemLabel(tkinter.Label):
     def deselect(self):
         self.set_selected(False)
 
+    # event.state bits
+    STATE_SHIFT = 0x1
+    STATE_CONTROL = 0x4
+
     def on_click(self, event):
-        print("inner onclick")
-        self.root.select_label(self)
+        tracer.instant("click", row=self.row)
+        if event.state & ItemLabel.STATE_SHIFT:
+            self.root.select_label(self, extend=True)
+        elif event.state & ItemLabel.STATE_CONTROL:
+            self.root.select_label(self, toggle=True)
+        else:
+            self.root.select_label(self)
+
+    def on_right_click(self, event):
+        if not self.selected:
+            self.root.select_label(self)
+        self.root.on_right_click(event)
 
     def on_doubleclick(self, event):
-        print("doubleclick")
-        if self.filetype == FileType.DIRECTORY:
-            self.fm.goto(self.filename, relative=True)
-        else:
-            # TODO: placeholder
-            print("Open:", self.filename)
+        tracer.instant("doubleclick", row=self.row)
+        self.fm.open(self.root.path_of(self.filename), self.filetype)
 
 
 class SideFrame(tkinter.Frame):
@@ -102,6 +3805,8 @@ class SideFrame(tkinter.Frame):
 
     COLOR = "gray"
     COLOR_SELECTED = "cyan"
+    # bookmarks whose directory does not exist
+    COLOR_MISSING = "gray30"
 
     DEFAULT_BOOKMARKS = [
         ("/", "/"),
@@ -116,28 +3821,42 @@ class SideFrame(tkinter.Frame):
 
         # TODO: get from config later
         self.labels = []
+        # bookmark index -> resolved Path, filled after the first paint
+        self.paths = {}
 
         for row, (name, pathstr) in enumerate(SideFrame.DEFAULT_BOOKMARKS):
-            path = Path(pathstr).expanduser()
-
             label = tkinter.Label(self, text=name, bg=SideFrame.COLOR, anchor="w")
             label.grid(row=row, column=0, sticky="ew")
 
             # Hover events
             label.bind("<Enter>", partial(self.on_label_enter, label=label))
             label.bind("<Leave>", partial(self.on_label_leave, label=label))
-            label.bind("<Button-1>", partial(self.on_label_click, path=path))
+            label.bind("<Button-1>", partial(self.on_label_click, index=row))
 
             self.labels.append(label)
 
+        # Resolving bookmarks touches the disk, don't hold up startup
+        self.after_idle(self.resolve_bookmarks)
+
+    def resolve(self, index):
+        path = self.paths.get(index)
+        if path is None:
+            path = self.paths[index] = Path(SideFrame.DEFAULT_BOOKMARKS[index][1]).expanduser()
+        return path
+
+    def resolve_bookmarks(self):
+        for index, label in enumerate(self.labels):
+            if not self.resolve(index).is_dir():
+                label.configure(fg=SideFrame.COLOR_MISSING)
+
     def on_label_enter(self, event, label):
         label.configure(bg=SideFrame.COLOR_SELECTED)
 
     def on_label_leave(self, event, label):
         label.configure(bg=SideFrame.COLOR)
 
-    def on_label_click(self, event, path):
-        self.fm.goto(path)
+    def on_label_click(self, event, index):
+        self.fm.goto(self.resolve(index))
 
 
 
@@ -147,39 +3866,444 @@ class NavFrame(tkinter.Frame):
 
         self.fm = root.get_fm()
 
-        # Setup Images
-        # TODO: streamline process
-        self.home_image = tkinter.PhotoImage(data=Icons["HOME"])
-        self.up_image = tkinter.PhotoImage(data=Icons["UP"])
-        self.forward_image = tkinter.PhotoImage(data=Icons["FORWARD"])
-        self.back_image = tkinter.PhotoImage(data=Icons["BACK"])
-
-        self.forward = tkinter.Button(self, image=self.forward_image, command=self.fm.forward)
-        self.back = tkinter.Button(self, image=self.back_image, command=self.fm.back)
-        self.up = tkinter.Button(self, image=self.up_image, command=self.fm.up)
-        self.home = tkinter.Button(self, image=self.home_image, command=self.fm.goto_home)
+        # Text placeholders until the icons are decoded, after first paint
+        self.forward = tkinter.Button(self, text=">", command=self.fm.forward)
+        self.back = tkinter.Button(self, text="<", command=self.fm.back)
+        self.up = tkinter.Button(self, text="^", command=self.fm.up)
+        self.home = tkinter.Button(self, text="~", command=self.fm.goto_home)
+        self.after_idle(self.load_icons)
 
         self.pathvar = tkinter.StringVar()
         self.pathvar.set(path)
         self.path_entry = tkinter.Entry(self, width=50, textvariable=self.pathvar)
         self.path_entry.bind("<Return>", self.on_enter)
 
+        # Filter box: narrows the listing as you type, or searches all
+        # subfolders when recursive is checked
+        self.filtervar = tkinter.StringVar()
+        self.filter_entry = tkinter.Entry(self, width=20, textvariable=self.filtervar)
+        self.recursivevar = tkinter.BooleanVar()
+        self.recursive = tkinter.Checkbutton(
+                self, text="Subfolders", variable=self.recursivevar,
+                command=self.on_filter_change
+                )
+        # searches the MetadataIndex instead, if there is one
+        self.everywherevar = tkinter.BooleanVar()
+        self.everywhere = tkinter.Checkbutton(
+                self, text="Everywhere", variable=self.everywherevar,
+                command=self.on_filter_change
+                )
+        self.suppress_filter = False
+        self.filtervar.trace_add("write", self.on_filter_change)
+
         self.back.grid(row=0, column=0)
         self.forward.grid(row=0, column=1)
         self.up.grid(row=0, column=2)
         self.home.grid(row=0, column=3)
         self.path_entry.grid(row=0, column=4)
+        self.filter_entry.grid(row=0, column=5)
+        self.recursive.grid(row=0, column=6)
+        if self.fm.index is not None:
+            self.everywhere.grid(row=0, column=7)
+
+    def load_icons(self):
+        for button, name in [(self.back, "BACK"), (self.forward, "FORWARD"),
+                             (self.up, "UP"), (self.home, "HOME")]:
+            button.configure(image=icon_registry.get(name))
+
+    def set_path(self, path):
+        self.pathvar.set(path)
+
+    def clear_filter(self):
+        self.suppress_filter = True
+        self.filtervar.set("")
+        self.suppress_filter = False
+
+    def on_filter_change(self, *args):
+        if self.suppress_filter:
+            return
+
+        text = self.filtervar.get()
+        if self.everywherevar.get() and text and self.fm.index is not None:
+            self.fm.search_everywhere(text)
+        elif self.recursivevar.get() and text:
+            self.fm.search(text)
+        else:
+            self.fm.set_filter(text)
+
+    def on_enter(self, event):
+        path = self.pathvar.get()
+        if not os.path.isdir(path):
+            # TODO: Show error message?
+            return
+
+        self.fm.goto(self.pathvar.get())
+
+
+class DetailsRow:
+    '''
+    A pooled row slot of DetailsView: a background rectangle, an icon and
+    one text item per column, all tagged with the slot so the whole row
+    moves with a single canvas call.
+    '''
+    def __init__(self, canvas, slot, columns):
+        self.canvas = canvas
+        self.tag = "details_slot{}".format(slot)
+
+        self.row = None
+        self.filename = None
+        self.filetype = None
+        self.selected = None
+        self.icon = None
+        # last text of each cell, so unchanged cells are not reconfigured
+        self.texts = [None] * columns
+        # canvas y of the row top
+        self.y = 0
+
+        tags = ("details", "details_row", self.tag)
+        self.bg = canvas.create_rectangle(0, 0, 0, 0, width=0, fill=ItemLabel.COLOR_DESELECTED, tags=tags)
+        self.image = canvas.create_image(0, 0, anchor="w", tags=tags)
+        self.cells = [canvas.create_text(0, 0, anchor="w", tags=tags) for _ in range(columns)]
+
+    def move_to(self, y):
+        if y != self.y:
+            self.canvas.move(self.tag, 0, y - self.y)
+            self.y = y
+
+    def hide(self):
+        self.row = None
+        self.filename = None
+        self.canvas.itemconfigure(self.tag, state="hidden")
+
+    def show(self):
+        self.canvas.itemconfigure(self.tag, state="normal")
+
+    def set_icon(self, icon):
+        if icon is not self.icon:
+            self.icon = icon
+            self.canvas.itemconfigure(self.image, image=icon)
+
+    def set_text(self, column, text):
+        if text != self.texts[column]:
+            self.texts[column] = text
+            self.canvas.itemconfigure(self.cells[column], text=text)
+
+    def set_selected(self, val):
+        if val != self.selected:
+            self.selected = val
+            color = ItemLabel.COLOR_SELECTED if val else ItemLabel.COLOR_DESELECTED
+            self.canvas.itemconfigure(self.bg, fill=color)
+
+
+class DetailsView:
+    '''
+    Name, size, modified and type columns drawn straight onto
+    FilesFrameCanvas, one canvas item per cell and no widgets per row.
+    Like the Item pool, a fixed set of row slots is re-bound to whatever is
+    scrolled into view. The header takes the first row of the canvas and
+    is moved to the top of the visible area; click a title to sort by that
+    column, drag a title border to resize it.
+    '''
+    # (sort key, title, initial width)
+    COLUMNS = [
+            (SortKey.NAME, "Name", 320),
+            (SortKey.SIZE, "Size", 90),
+            (SortKey.MTIME, "Modified", 140),
+            (SortKey.TYPE, "Type", 160),
+            ]
+    MIN_WIDTH = 40
+    PADDING = 6
+    # distance from a title border, in pixels, that grabs it for resizing
+    GRIP = 4
+    HEADER_COLOR = "gray85"
+    TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.canvas = frame.canvas_parent
+        self.fm = frame.fm
+
+        self.active = False
+        self.widths = [width for _, _, width in DetailsView.COLUMNS]
+        self.rows = []
+
+        # Created on first activation
+        self.header = None
+        self.char_width = None
+
+        # (extension, FileType) -> type column text
+        self.type_names = {}
+
+        # (column, x at press, width at press) while resizing
+        self.drag = None
+        self.cursor = ""
+
+        self.canvas.bind("<Button-1>", self.on_click, "+")
+        self.canvas.bind("<B1-Motion>", self.on_drag, "+")
+        self.canvas.bind("<ButtonRelease-1>", self.on_release, "+")
+        self.canvas.bind("<Double-Button-1>", self.on_doubleclick, "+")
+        self.canvas.bind("<Button-2>", self.on_right_click, "+")
+        self.canvas.bind("<Button-3>", self.on_right_click, "+")
+        self.canvas.bind("<Motion>", self.on_motion, "+")
+
+    def set_active(self, active):
+        self.active = active
+        if active and self.header is None:
+            font = tkinter.font.nametofont("TkDefaultFont")
+            self.char_width = max(1, font.measure("abcdefghijklmnopqrstuvwxyz") // 26)
+            self.create_header()
+        if not active:
+            for slot in self.rows:
+                slot.hide()
+        state = "normal" if active else "hidden"
+        self.canvas.itemconfigure("details_header", state=state)
+
+    def create_header(self):
+        canvas = self.canvas
+        tags = ("details", "details_header")
+        self.header = {
+            "bg": canvas.create_rectangle(0, 0, 0, 0, width=0, fill=DetailsView.HEADER_COLOR, tags=tags),
+            "titles": [canvas.create_text(0, 0, anchor="w", tags=tags) for _ in DetailsView.COLUMNS],
+            "borders": [canvas.create_line(0, 0, 0, 0, fill="gray60", tags=tags) for _ in DetailsView.COLUMNS],
+            "y": 0,
+        }
+        self.layout()
+
+    def column_x(self):
+        # left edge of every column, after the icon
+        x = FilesFrame.ROW_HEIGHT
+        edges = []
+        for width in self.widths:
+            edges.append(x)
+            x += width
+        return edges, x
+
+    def layout(self):
+        '''
+        Place header and row items horizontally, after a resize
+        '''
+        canvas = self.canvas
+        edges, right = self.column_x()
+        header = self.header
+        height = FilesFrame.ROW_HEIGHT
+        y = header["y"]
+
+        for i, x in enumerate(edges):
+            canvas.coords(header["titles"][i], x + DetailsView.PADDING, y + height / 2)
+            border = x + self.widths[i]
+            canvas.coords(header["borders"][i], border, y + 4, border, y + height - 4)
+
+        for slot in self.rows:
+            self.layout_row(slot, edges)
+            # cell texts are truncated to the column width
+            slot.texts = [None] * len(DetailsView.COLUMNS)
+
+    def layout_row(self, slot, edges):
+        canvas = self.canvas
+        y = slot.y + FilesFrame.ROW_HEIGHT / 2
+        canvas.coords(slot.image, 2, y)
+        for cell, x in zip(slot.cells, edges):
+            canvas.coords(cell, x + DetailsView.PADDING, y)
+
+    def visible_range(self):
+        canvas = self.canvas
+        top = canvas.canvasy(0)
+        height = max(canvas.winfo_height(), 1)
+
+        # canvas row 0 is the header
+        first = max(0, int(top // FilesFrame.ROW_HEIGHT) - 1 - FilesFrame.BUFFER_ROWS)
+        count = height // FilesFrame.ROW_HEIGHT + 2 * FilesFrame.BUFFER_ROWS + 2
+        return first, count
+
+    def draw(self):
+        canvas = self.canvas
+        files = self.frame.files
+        first, count = self.visible_range()
+        edges, right = self.column_x()
+        width = max(right, canvas.winfo_width())
+
+        while len(self.rows) < count:
+            slot = DetailsRow(canvas, len(self.rows), len(DetailsView.COLUMNS))
+            self.layout_row(slot, edges)
+            self.rows.append(slot)
+
+        images = []
+        sniffs = []
+        for i, slot in enumerate(self.rows):
+            row = first + i
+            if row >= len(files):
+                if slot.row is not None:
+                    slot.hide()
+                continue
+
+            entry = files[row]
+            self.frame.sniff(entry, sniffs)
+            if slot.row is None:
+                slot.show()
+            slot.row = row
+            slot.filename = entry.name
+            slot.filetype = entry.kind
+
+            y = (row + 1) * FilesFrame.ROW_HEIGHT
+            slot.move_to(y)
+            canvas.coords(slot.bg, 0, y, width, y + FilesFrame.ROW_HEIGHT)
+
+            slot.set_icon(self.frame.icon_for(entry, images))
+            for column, text in enumerate(self.cell_texts(entry)):
+                slot.set_text(column, self.truncate(text, self.widths[column]))
+            slot.set_selected(self.frame.selection.is_selected(row, entry.name))
+
+        self.frame.sniffer.request(sniffs)
+        self.frame.thumbnails.request(images)
+        self.draw_header(width)
+
+    def draw_header(self, width):
+        canvas = self.canvas
+        header = self.header
+        y = canvas.canvasy(0)
+        if y != header["y"]:
+            canvas.move("details_header", 0, y - header["y"])
+            header["y"] = y
+        canvas.coords(header["bg"], 0, y, width, y + FilesFrame.ROW_HEIGHT)
+
+        order = self.fm.sort_order
+        for i, (key, title, _) in enumerate(DetailsView.COLUMNS):
+            if key == order.key:
+                title += " ▼" if order.reverse else " ▲"
+            canvas.itemconfigure(header["titles"][i], text=title)
+        canvas.tag_raise("details_header")
+
+    def cell_texts(self, entry):
+        # size and mtime are left empty until the loader stat'ed the entry,
+        # rendering never waits on the disk
+        if not entry.has_stat() or entry.size < 0:
+            return entry.name, "", "", self.type_name(entry)
+        size = "" if entry.kind == FileType.DIRECTORY else format_size(entry.size)
+        mtime = time.strftime(DetailsView.TIME_FORMAT, time.localtime(entry.mtime))
+        return entry.name, size, mtime, self.type_name(entry)
+
+    def type_name(self, entry):
+        if entry.kind == FileType.DIRECTORY:
+            return "Folder"
+        ext = os.path.splitext(entry.name)[1].lower()
+        key = (ext, entry.kind)
+        name = self.type_names.get(key)
+        if name is None:
+            mime = mimetypes.guess_type("x" + ext)[0] if ext else None
+            if mime:
+                name = mime
+            elif ext:
+                name = ext[1:].upper() + " file"
+            else:
+                # sniffed, or "File"
+                name = entry.kind.value.capitalize()
+            self.type_names[key] = name
+        return name
+
+    def truncate(self, text, width):
+        # estimated from the average character width, measuring every
+        # cell would cost a font lookup per text
+        chars = max(1, (width - 2 * DetailsView.PADDING) // self.char_width)
+        if len(text) <= chars:
+            return text
+        return text[:chars - 1] + "…"
+
+    def repaint_selection(self):
+        for slot in self.rows:
+            if slot.row is not None:
+                slot.set_selected(self.frame.selection.is_selected(slot.row, slot.filename))
+
+    """
+    Events
+    """
+    def border_at(self, x):
+        # column whose right border is under x, or None
+        edges, _ = self.column_x()
+        for i, left in enumerate(edges):
+            if abs(left + self.widths[i] - x) <= DetailsView.GRIP:
+                return i
+        return None
+
+    def column_at(self, x):
+        edges, _ = self.column_x()
+        for i, left in enumerate(edges):
+            if left <= x < left + self.widths[i]:
+                return i
+        return None
+
+    def slot_at(self, event):
+        row = int(self.canvas.canvasy(event.y) // FilesFrame.ROW_HEIGHT) - 1
+        for slot in self.rows:
+            if slot.row == row:
+                return slot
+        return None
+
+    def on_motion(self, event):
+        if not self.active:
+            return
+        over_border = event.y < FilesFrame.ROW_HEIGHT and self.border_at(event.x) is not None
+        cursor = "sb_h_double_arrow" if over_border else ""
+        if cursor != self.cursor:
+            self.cursor = cursor
+            self.canvas.configure(cursor=cursor)
+
+    def on_click(self, event):
+        if not self.active:
+            return
+
+        if event.y < FilesFrame.ROW_HEIGHT:
+            column = self.border_at(event.x)
+            if column is not None:
+                self.drag = (column, event.x, self.widths[column])
+            return
+
+        slot = self.slot_at(event)
+        if slot is None:
+            self.frame.deselect_all()
+        elif event.state & ItemLabel.STATE_SHIFT:
+            self.frame.select_label(slot, extend=True)
+        elif event.state & ItemLabel.STATE_CONTROL:
+            self.frame.select_label(slot, toggle=True)
+        else:
+            self.frame.select_label(slot)
 
-    def set_path(self, path):
-        self.pathvar.set(path)
+    def on_drag(self, event):
+        if self.drag is None:
+            return
+        column, start_x, start_width = self.drag
+        width = max(DetailsView.MIN_WIDTH, start_width + event.x - start_x)
+        if width != self.widths[column]:
+            self.widths[column] = width
+            self.layout()
+            self.draw()
+
+    def on_release(self, event):
+        if not self.active:
+            return
+        if self.drag is not None:
+            self.drag = None
+            return
+        if event.y < FilesFrame.ROW_HEIGHT and self.border_at(event.x) is None:
+            column = self.column_at(event.x)
+            if column is not None:
+                self.frame.sort_by(DetailsView.COLUMNS[column][0])
 
-    def on_enter(self, event):
-        path = self.pathvar.get()
-        if not os.path.isdir(path):
-            # TODO: Show error message?
+    def on_doubleclick(self, event):
+        if not self.active or event.y < FilesFrame.ROW_HEIGHT:
+            return
+        slot = self.slot_at(event)
+        if slot is None:
             return
+        tracer.instant("doubleclick", row=slot.row)
+        self.fm.open(self.frame.path_of(slot.filename), slot.filetype)
 
-        self.fm.goto(self.pathvar.get())
+    def on_right_click(self, event):
+        if not self.active:
+            return
+        slot = self.slot_at(event)
+        if slot is not None and not self.frame.selection.is_selected(slot.row, slot.filename):
+            self.frame.select_label(slot)
+        self.frame.on_right_click(event)
 
 
 class FilesFrameCanvas(tkinter.Canvas):
@@ -187,14 +4311,17 @@ class FilesFrameCanvas(tkinter.Canvas):
         super().__init__(
                 root,
                 height=400 - root.nav_frame.winfo_height(),
-                scrollregion=(0,0, 500, 5000) # TODO what are these numbers?
+                yscrollincrement=FilesFrame.ROW_HEIGHT
                 )
-        self.scrollbar = tkinter.Scrollbar(root, command=self.yview)
+        self.scrollbar = tkinter.Scrollbar(root, command=self.on_scrollbar)
         self.scrollbar.grid(row=1, column=2, sticky="ns")
         self.configure(yscrollcommand=self.scrollbar.set)
 
         self.files_frame = FilesFrame(self, root)
-        self.create_window((0,0), window=self.files_frame, anchor='nw')
+        self.window = self.create_window((0,0), window=self.files_frame, anchor='nw')
+        self.set_row_count(0)
+
+        self.bind("<Configure>", self.on_configure)
 
         # Mousewheel
         # OS X: MouseWheel
@@ -203,9 +4330,27 @@ class FilesFrameCanvas(tkinter.Canvas):
         self.bind_all("<Button-4>", partial(self.on_mousewheel_scroll, distance=-2))
         self.bind_all("<Button-5>", partial(self.on_mousewheel_scroll, distance=2))
 
+    def set_row_count(self, count):
+        # Scrollregion is derived from the row count, rows themselves are
+        # only created for the visible part of the canvas
+        if self.files_frame.details.active:
+            # the details header takes the first row
+            count += 1
+        height = max(count * FilesFrame.ROW_HEIGHT, self.winfo_height())
+        self.configure(scrollregion=(0, 0, self.winfo_width(), height))
+
+    def on_configure(self, event):
+        self.itemconfigure(self.window, width=event.width)
+        self.set_row_count(len(self.files_frame.files))
+        self.files_frame.update_visible()
+
+    def on_scrollbar(self, *args):
+        self.yview(*args)
+        self.files_frame.update_visible()
 
     def on_mousewheel_scroll(self, event, distance):
         self.yview_scroll(distance, "units")
+        self.files_frame.update_visible()
 
     def on_mousewheel(self, event):
         # self.yview_scroll(-1*event.delta, "units")
@@ -218,87 +4363,403 @@ class FilesFrame(tkinter.Frame):
     MOUSE_MULTIPLE = "multiple"
     # some drag enum?
 
+    # Row geometry: fits the 32x32 icons plus some padding
+    ROW_HEIGHT = 36
+    # Extra rows rendered above and below the visible area
+    BUFFER_ROWS = 4
+
     def __init__(self, canvas_parent, root):
-        super().__init__(canvas_parent)
+        super().__init__(canvas_parent, bg=ItemLabel.COLOR_DESELECTED)
         self.canvas_parent = canvas_parent
         self.root = root
         self.fm = root.get_fm()
 
+        # Entries of the current listing, in display order
+        self.files = View()
+
+        # Pool of row widgets, reused while scrolling
         self.items = []
+        self.first_row = 0
 
         self.mouse_mode = FilesFrame.MOUSE_SINGLE
 
-        self.selected_labels = []
+        # Keyed by name so selection survives refreshes that insert or
+        # remove rows, and scrolling
+        self.selection = Selection()
+
+        # Thumbnails of image files in view, drawn as they are made
+        self.thumbnails = Thumbnailer(self, self.update_visible)
+        # Types of files in view that have no extension
+        self.sniffer = TypeSniffer(self, self.update_visible)
+
+        # Rows drawn as canvas items with columns, instead of the Item pool
+        self.details = DetailsView(self)
 
         self.bind("<Button-1>", self.on_click)
 
         # Right click context menu
         # On OS X, right click is Button2
         self.popup = tkinter.Menu(self, tearoff=0)
-        self.popup.add_command(label="New Folder")
+        self.popup.add_command(label="New Folder", command=self.on_new_folder)
+        self.popup.add_separator()
+        self.popup.add_command(label="Copy", command=lambda: self.fm.copy(self.selected_paths()))
+        self.popup.add_command(label="Cut", command=lambda: self.fm.cut(self.selected_paths()))
+        self.popup.add_command(label="Paste here", command=self.fm.paste)
+        self.popup.add_command(label="Rename", command=self.on_rename)
+        self.popup.add_command(label="Move to Trash", command=lambda: self.fm.rm(self.selected_paths()))
+        self.popup.add_separator()
+        self.popup.add_command(label="Properties", command=self.on_properties)
         self.popup.add_separator()
-        self.popup.add_command(label="Paste here")
+        self.popup.add_command(label="Find Duplicates", command=self.fm.find_duplicates)
+        self.popup.add_command(label="Select Extra Copies", command=self.select_duplicate_copies)
         self.popup.add_separator()
-        self.popup.add_command(label="Properties")
+
+        self.sort_menu = tkinter.Menu(self.popup, tearoff=0)
+        self.sortvar = tkinter.StringVar(value=SortKey.NAME.value)
+        self.reversevar = tkinter.BooleanVar(value=False)
+        self.dirs_firstvar = tkinter.BooleanVar(value=True)
+        for label, key in [("Name", SortKey.NAME), ("Size", SortKey.SIZE),
+                           ("Modified", SortKey.MTIME), ("Type", SortKey.TYPE)]:
+            self.sort_menu.add_radiobutton(
+                    label=label, value=key.value, variable=self.sortvar,
+                    command=self.on_sort_change
+                    )
+        self.sort_menu.add_separator()
+        self.sort_menu.add_checkbutton(label="Descending", variable=self.reversevar, command=self.on_sort_change)
+        self.sort_menu.add_checkbutton(label="Folders first", variable=self.dirs_firstvar, command=self.on_sort_change)
+        self.popup.add_cascade(label="Sort by", menu=self.sort_menu)
+
+        self.detailsvar = tkinter.BooleanVar(value=False)
+        self.popup.add_checkbutton(label="Details", variable=self.detailsvar,
+                                   command=lambda: self.set_details(self.detailsvar.get()))
 
         self.bind("<Button-2>", self.on_right_click)
+        self.bind("<Button-3>", self.on_right_click)
         # TODO: for macs
         self.bind("<Control-Button-1>", self.on_right_click)
 
+    def refresh(self, files):
+        self.selection.clear()
+        self.selection.set_view(files)
+        self.files = files
 
-        self.scrollbar = tkinter.Scrollbar(self)
-        # self.scrollbar.pack(side=RIGHT, fill="y")
+        self.canvas_parent.set_row_count(len(files))
+        self.canvas_parent.yview_moveto(0)
 
-    def refresh(self, files):
-        self.selected_labels = []
+        self.update_visible()
 
-        for item in self.items:
-            # print("destroying label:", label)
-            item.destroy()
+    def update_files(self, files, removed=()):
+        '''
+        Like refresh, but keeps scroll position and selection. Only the
+        pooled rows are re-bound, and rows whose name and icon did not
+        change are left alone, so the cost does not depend on len(files).
+        removed: names that are gone, dropped from the selection
+        '''
+        self.selection.set_view(files)
+        self.selection.remove_keys(removed)
 
-        self.items = []
+        self.files = files
+        self.canvas_parent.set_row_count(len(files))
+        self.update_visible()
+
+    def visible_range(self):
+        '''
+        Returns (first, count): the first row index that needs a widget and
+        the number of rows needed to cover the canvas plus the buffer.
+        '''
+        canvas = self.canvas_parent
+        top = canvas.canvasy(0)
+        height = max(canvas.winfo_height(), 1)
+
+        first = max(0, int(top // FilesFrame.ROW_HEIGHT) - FilesFrame.BUFFER_ROWS)
+        count = height // FilesFrame.ROW_HEIGHT + 2 * FilesFrame.BUFFER_ROWS + 2
+        return first, count
+
+    def update_visible(self):
+        '''
+        Bind pooled row widgets to the rows currently scrolled into view
+        '''
+        with tracer.span("widget_build", rows=len(self.files)):
+            self.bind_visible()
 
-        self.test_icons=[]
+    def bind_visible(self):
+        if self.details.active:
+            self.details.draw()
+            return
 
-        for row, f in enumerate(files):
-            filename, filetype = f
+        first, count = self.visible_range()
 
-            label = Item(self, row, filename, filetype)
-            # label.grid(row=row, column=1, sticky="w")
-            self.items.append(label)
+        # Grow the pool if the canvas got taller. The pool never shrinks
+        while len(self.items) < count:
+            self.items.append(Item(self, len(self.items)))
 
+        self.first_row = first
+        self.canvas_parent.coords(self.canvas_parent.window, 0, first * FilesFrame.ROW_HEIGHT)
+        self.configure(height=len(self.items) * FilesFrame.ROW_HEIGHT)
 
-    def deselect_all(self):
-        for label in self.selected_labels:
-            label.deselect()
-        self.selected_labels = []
+        images = []
+        sniffs = []
+        for slot, item in enumerate(self.items):
+            row = first + slot
+            if row < len(self.files):
+                entry = self.files[row]
+                self.sniff(entry, sniffs)
+                thumbnail = self.thumbnail_for(entry, images)
+                item.show(row, entry.name, entry.kind, self.selection.is_selected(row, entry.name), thumbnail)
+            else:
+                item.hide()
+
+        self.sniffer.request(sniffs)
+        self.thumbnails.request(images)
+
+    def sniff(self, entry, sniffs):
+        '''
+        Applies the sniffed type of entry if there is one. Entries without
+        an extension are added to sniffs, to be requested from the
+        TypeSniffer.
+        '''
+        if not TypeSniffer.wants(entry):
+            return
+        sniffs.append(entry)
+        kind = self.sniffer.get(entry.path)
+        if kind is not None and kind != FileType.FILE:
+            entry.listing.set_kind(entry.index, kind)
+
+    def thumbnail_for(self, entry, images):
+        '''
+        Thumbnail of entry if one is ready. Paths of image files are added
+        to images, to be requested from the Thumbnailer.
+        '''
+        if entry.kind == FileType.DIRECTORY or not Thumbnailer.wants(entry.name, entry.kind):
+            return None
+        path = entry.path
+        images.append(path)
+        return self.thumbnails.get(path)
+
+    def icon_for(self, entry, images):
+        thumbnail = self.thumbnail_for(entry, images)
+        if thumbnail is not None:
+            return thumbnail
+        return icon_registry.for_file(entry.name, entry.kind)
+
+    def set_details(self, active):
+        '''
+        Switch between the icon rows and the details columns
+        '''
+        if active == self.details.active:
+            return
+        self.detailsvar.set(active)
+        self.details.set_active(active)
+        self.canvas_parent.itemconfigure(self.canvas_parent.window, state="hidden" if active else "normal")
+        self.fm.set_details(active)
+
+        self.canvas_parent.set_row_count(len(self.files))
+        self.update_visible()
+
+    def forget_files(self, paths=None):
+        # files changed on disk, their thumbnails and types are checked again
+        self.thumbnails.forget(paths)
+        self.sniffer.forget(paths)
+
+    def repaint_selection(self):
+        if self.details.active:
+            self.details.repaint_selection()
+            return
 
+        # only the pooled rows have widgets to update
+        for item in self.items:
+            if item.row is not None:
+                item.label.set_selected(self.selection.is_selected(item.row, item.filename))
+
+    def deselect_all(self):
+        self.selection.clear()
+        self.repaint_selection()
+
+    def select_all(self):
+        self.selection.select_all()
+        self.repaint_selection()
+
+    def select_duplicate_copies(self):
+        # all duplicates but one per group, ready for Move to Trash
+        self.selection.clear()
+        for name in self.fm.duplicate_copies():
+            self.selection.set_key(name, True)
+        self.repaint_selection()
+
+    def select_label(self, label, extend=False, toggle=False):
+        if extend:
+            self.selection.select_range(label.row)
+        elif toggle or self.mouse_mode == FilesFrame.MOUSE_MULTIPLE:
+            self.selection.toggle(label.row, label.filename)
+        else:
+            self.selection.select_only(label.row, label.filename)
 
-    def select_label(self, label):
-        if self.mouse_mode == FilesFrame.MOUSE_SINGLE:
-            self.deselect_all()
+        self.repaint_selection()
 
-        # for both SINGLE and MULTIPLE
-        self.selected_labels.append(label)
-        label.select()
+    def selected_names(self):
+        return self.selection.selected_keys()
 
     def on_click(self, event):
-        print("FilesFrame.on_click()")
+        tracer.instant("files_frame_click")
         self.deselect_all()
 
     def on_right_click(self, event):
-        print("right click", event.x_root, event.y_root)
+        tracer.instant("right_click")
         self.popup.post(event.x_root, event.y_root)
 
+    def path_of(self, name):
+        # names are relative to the listing shown: the current path, or the
+        # root of search results
+        base = self.files.listing.path if self.files.listing is not None else self.fm.path
+        return os.path.join(base, name)
+
+    def selected_paths(self):
+        return [self.path_of(name) for name in self.selected_names()]
+
+    def on_new_folder(self):
+        name = tkinter.simpledialog.askstring("New Folder", "Name:", parent=self)
+        if name:
+            try:
+                self.fm.mkdir(name)
+            except OSError as e:
+                tracer.report("Cannot create folder: {}".format(e))
+
+    def on_rename(self):
+        names = self.selected_names()
+        if len(names) != 1:
+            return
+        old_path = self.path_of(names[0])
+        old = os.path.basename(old_path)
+        new = tkinter.simpledialog.askstring("Rename", "New name:", initialvalue=old, parent=self)
+        if new and new != old:
+            try:
+                # renamed where it is, search results may be in other folders
+                self.fm.rename(old_path, os.path.join(os.path.dirname(old_path), new))
+            except OSError as e:
+                tracer.report("Cannot rename: {}".format(e))
+
+    def sort_by(self, key):
+        # column header click: a new key sorts ascending, the same key flips
+        if SortKey(self.sortvar.get()) == key:
+            self.reversevar.set(not self.reversevar.get())
+        else:
+            self.sortvar.set(key.value)
+            self.reversevar.set(False)
+        self.on_sort_change()
+
+    def on_sort_change(self):
+        self.fm.set_sort(
+                SortKey(self.sortvar.get()),
+                self.reversevar.get(),
+                self.dirs_firstvar.get()
+                )
+
+    def on_properties(self):
+        # Properties of the selection, or of the current directory
+        paths = self.selected_paths() or [str(self.fm.path)]
+        for path in paths:
+            try:
+                PropertiesWindow(self.root, self.fm, path)
+            except OSError as e:
+                tracer.report("Cannot show properties: {}".format(e))
+
+
+class PropertiesWindow(tkinter.Toplevel):
+    # How often the running total of a directory size is redrawn
+    UPDATE_MS = 100
+
+    def __init__(self, root, fm, filename):
+        # before the window exists, a missing file raises OSError here
+        info = fm.get_info(filename)
+
+        super().__init__(root)
+        self.fm = fm
+        self.sizer = None
+        self.update_id = None
+
+        self.title("Properties: " + info["name"])
+
+        rows = [
+            ("Name", info["name"]),
+            ("Path", info["path"]),
+            ("Type", info["type"]),
+            ("Modified", time.strftime("%Y-%m-%d %H:%M", time.localtime(info["updated_at"]))),
+        ]
+        for row, (name, value) in enumerate(rows):
+            tkinter.Label(self, text=name + ":", anchor="e").grid(row=row, column=0, sticky="e")
+            tkinter.Label(self, text=value, anchor="w").grid(row=row, column=1, sticky="w")
+
+        self.sizevar = tkinter.StringVar()
+        tkinter.Label(self, text="Size:", anchor="e").grid(row=len(rows), column=0, sticky="e")
+        tkinter.Label(self, textvariable=self.sizevar, anchor="w").grid(row=len(rows), column=1, sticky="w")
+
+        if info["type"] == FileType.DIRECTORY.value:
+            self.sizer = fm.dir_size(info["path"])
+            self.update_size()
+        else:
+            self.sizevar.set(format_size(info["size"]))
+
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+    def update_size(self):
+        self.update_id = None
+        if not self.winfo_exists():
+            return
+
+        progress = self.sizer.progress()
+        if progress["cancelled"]:
+            return
+        if progress["done"]:
+            text = "{} ({} files)".format(format_size(self.sizer.result), progress["files"])
+        else:
+            text = "{}... ({} files)".format(format_size(progress["bytes"]), progress["files"])
+            self.update_id = self.after(PropertiesWindow.UPDATE_MS, self.update_size)
+        self.sizevar.set(text)
+
+    def close(self):
+        if self.update_id is not None:
+            self.after_cancel(self.update_id)
+            self.update_id = None
+        if self.sizer is not None:
+            self.sizer.cancel()
+        self.destroy()
+
 
 class FileManager:
-    def __init__(self, root, start_path):
+    # How often the Tk loop picks up batches from the loader thread
+    POLL_MS = 15
+    # How often progress of copy/move jobs is redrawn
+    JOBS_POLL_MS = 200
+    # loaded batches smaller than 1/MERGE_SPLICE_RATIO of the rows so far
+    # are bisected into them, larger ones merged by sorting
+    MERGE_SPLICE_RATIO = 32
+
+    # Watcher events are coalesced until they are quiet for WATCH_QUIET
+    # seconds, or at most WATCH_MAX_DELAY seconds during a steady stream
+    WATCH_POLL_MS = 50
+    WATCH_QUIET = 0.1
+    WATCH_MAX_DELAY = 0.5
+    # batches with more names than this rescan instead of stat-ing each name
+    WATCH_RESCAN_THRESHOLD = 1000
+
+    def __init__(self, root, start_path, index=None):
         self.root = root
 
         self.path = start_path
 
+        # optional MetadataIndex, for instant revisits and search everywhere
+        self.index = index
+
         # Stores path or paths
         self.clipboard = []
+        # whether paste moves (cut) or copies the clipboard
+        self.clipboard_cut = False
+
+        self.trash = Trash()
+
+        # Running TransferJobs
+        self.jobs = []
+        self.jobs_poll_id = None
 
         self.history = [start_path]
         self.history_index = 0
@@ -307,33 +4768,224 @@ class FileManager:
 
         self.show_hidden = False
 
-        # Debug mode, don't perform any file IO
-        self.dry_run = True
+        # Listing of the current path, including hidden entries
+        self.listing = None
+
+        # Background listing. generation is bumped on every navigation so
+        # results of a replaced scan are dropped
+        self.generation = 0
+        self.loader = None
+        self.poll_id = None
+        self.keep_view = False
+        self.results = queue.Queue()
+        self.cache = ListingCache()
+
+        # subtree totals of directories whose size was asked for
+        self.size_memo = SizeMemo()
+
+        self.sort_order = SortOrder()
+        # sorts on worker threads, self.files may not be in sort_order yet
+        self.sorts_running = 0
+
+        # Details view shows size and mtime, loaders stat every entry
+        self.details = False
+
+        # Results of run_in_background, picked up by poll_tasks
+        self.tasks = queue.Queue()
+        self.tasks_running = 0
+        self.tasks_poll_id = None
+
+        # Type-to-filter. filter_view is the last result, reused while the
+        # filter text only grows
+        self.filter_text = ""
+        self.filter_view = None
+
+        # Recursive search below the current path
+        self.search_index = None
+        self.search_query_id = None
+        self.search_results = View()
+        self.search_poll_id = None
+        # searches of the MetadataIndex, numbered so late results are dropped
+        self.index_searches = 0
+
+        # Duplicate files below a path, shown instead of the listing while
+        # set. duplicate_groups holds the group number of each row
+        self.duplicates = None
+        self.duplicate_results = View()
+        self.duplicate_groups = array("I")
+        self.duplicates_poll_id = None
+
+        # Live updates of the current directory, created on first refresh
+        self.watcher = None
+        self.watch_stats = {
+            "batches": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_latency": 0.0,
+            "max_latency": 0.0,
+        }
+        # (first_event, batch size) of a watcher batch applied by rescan
+        self.watch_reload = None
+        # visible entries received so far for the current load
+        self.files = View()
+        # (key, index) of those, ascending, while the load is streaming
+        self.load_keys = []
+        # just the indexes of load_keys
+        self.load_rows = array("I")
+        # load_keys is None while the rows so far are re-sorted for a new
+        # order, batches and the end of the load wait until that is done
+        self.load_pending = []
+        self.load_finished = False
+
+        # Debug mode, don't perform any file IO. Jobs still plan and count
+        # the work they would do
+        self.dry_run = os.environ.get("TKFM_DRY_RUN", "") not in ("", "0")
 
 
     """
     File functions
     """
+    def copy(self, paths):
+        self.clipboard = [str(p) for p in paths]
+        self.clipboard_cut = False
+
+    def cut(self, paths):
+        self.clipboard = [str(p) for p in paths]
+        self.clipboard_cut = True
+
     # paste either from 1) copy clipboard, 2) cut clipboard
     def paste(self):
-        # if cut clipboard, call rename instead
-
-        # else paste here
-        pass
+        '''
+        Copy or move the clipboard into the current path, on worker
+        threads. Returns the TransferJob.
+        '''
+        if not self.clipboard:
+            return None
+
+        job = TransferJob(self.clipboard, self.path, move=self.clipboard_cut, dry_run=self.dry_run)
+        if self.clipboard_cut:
+            # cut items can only be pasted once
+            self.clipboard = []
+        return self.start_job(job)
+
+    def start_job(self, job):
+        self.jobs.append(job)
+        job.start()
+        if self.jobs_poll_id is None:
+            self.jobs_poll_id = self.root.after(FileManager.JOBS_POLL_MS, self.poll_jobs)
+        return job
+
+    def poll_jobs(self):
+        '''
+        Show progress of running jobs, and update the view for finished ones
+        '''
+        self.jobs_poll_id = None
+
+        for job in list(self.jobs):
+            progress = job.progress()
+            if not progress["done"]:
+                continue
+
+            self.jobs.remove(job)
+            for src, error in job.errors:
+                tracer.report("Cannot transfer {}: {}".format(src, error))
+            if job.dry_run:
+                tracer.report("Dry run: {} files, {}".format(progress["files_total"], format_size(progress["bytes_total"])))
+
+            if os.path.normpath(job.dest_dir) == os.path.normpath(str(self.path)):
+                self.apply_changes(job.created)
+            if job.move:
+                # sources may be shown, if they are in the current path
+                here = [os.path.basename(s) for s in job.sources
+                        if os.path.dirname(os.path.normpath(s)) == os.path.normpath(str(self.path))]
+                if here:
+                    self.apply_changes(here)
+
+        if self.jobs:
+            progress = self.jobs[0].progress()
+            self.root.set_status("{} of {} ({}/s)".format(
+                format_size(progress["bytes"]),
+                format_size(progress["bytes_total"]),
+                format_size(progress["bytes_per_sec"])
+                ))
+            self.jobs_poll_id = self.root.after(FileManager.JOBS_POLL_MS, self.poll_jobs)
+        else:
+            self.root.set_status(None)
 
     # called directly from drag and drop or rename
     # called indirectly through paste() from cut/paste
-    def rename(old_path, new_path):
-        pass
+    def rename(self, old_path, new_path):
+        '''
+        Rename/move old_path to new_path. Within one filesystem this is an
+        atomic rename, otherwise a move job is started.
+        '''
+        old_path = str(old_path)
+        new_path = str(new_path)
+        if os.path.lexists(new_path):
+            raise FileExistsError(new_path)
 
-    def mkdir(path):
+        if self.dry_run:
+            # nothing changed on disk, so neither does the view
+            return
 
-        # refresh?
-        pass
+        try:
+            os.rename(old_path, new_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # cross device: copy then remove, under the new name, which
+            # fails like os.rename if it is taken by then
+            job = TransferJob(
+                    [old_path], os.path.dirname(new_path), move=True,
+                    rename_to=os.path.basename(new_path)
+                    )
+            return self.start_job(job)
+
+        changed = [os.path.basename(p) for p in (old_path, new_path)
+                   if os.path.dirname(p) == os.path.normpath(str(self.path))]
+        if changed:
+            self.apply_changes(changed)
+
+    def mkdir(self, name):
+        path = os.path.join(self.path, name)
+        if self.dry_run:
+            return
+        os.mkdir(path)
 
-    def rm(path, safe=True):
-        # dont implement real "rm" yet, only move to trash
-        pass
+        # only the new row is added
+        self.apply_changes([name])
+
+    def rm(self, paths, safe=True):
+        '''
+        Move paths to the trash, or with safe=False delete them for good,
+        on a worker thread. The view is updated once for the whole batch.
+        '''
+        if isinstance(paths, (str, Path)):
+            paths = [paths]
+        paths = [str(p) for p in paths]
+        verb = "trash" if safe else "delete"
+
+        if self.dry_run:
+            tracer.report("Dry run: would {} {} items".format(verb, len(paths)))
+            return
+
+        work = self.trash.trash if safe else delete_paths
+        self.run_in_background(partial(work, paths), partial(self.on_removed, verb))
+
+    def on_removed(self, verb, result):
+        removed, errors = result
+        for path, error in errors:
+            tracer.report("Cannot {} {}: {}".format(verb, path, error))
+
+        if self.duplicates is not None and removed:
+            self.drop_duplicates(removed)
+
+        here = os.path.normpath(str(self.path))
+        names = [os.path.basename(p) for p in removed if os.path.dirname(p) == here]
+        if len(names) > FileManager.WATCH_RESCAN_THRESHOLD:
+            self.reload()
+        elif names:
+            self.apply_changes(names)
 
     """
     Movement functions
@@ -344,7 +4996,7 @@ class FileManager:
         # if history index is not 0, subtract 1,
         # get path, run goto (add_to_history=False)
         if self.history_index <= 0 or len(self.history) <= 1:
-            print("Cannot go back")
+            tracer.instant("cannot_go_back")
         else:
             self.history_index -= 1
             self.goto(self.history[self.history_index], add_to_history=False)
@@ -355,7 +5007,7 @@ class FileManager:
         # add 1 to it, get path, run goto (add_to_history=False)
         if self.history_index + 1 >= len(self.history):
             # do nothing
-            print("cannot go forward")
+            tracer.instant("cannot_go_forward")
         else:
             self.history_index += 1
             self.goto(self.history[self.history_index], add_to_history=False)
@@ -368,11 +5020,12 @@ class FileManager:
     def goto(self, path, add_to_history=True, relative=False):
         # set new path
 
-        if relative:
-            self.path = Path(os.path.join(self.path, path))
-        else:
-            # TODO is Path(...) necessary here? check where goto is called
-            self.path = Path(path)
+        with tracer.span("resolve_path"):
+            if relative:
+                self.path = Path(os.path.join(self.path, path))
+            else:
+                # TODO is Path(...) necessary here? check where goto is called
+                self.path = Path(path)
 
         # if add_to_history, first remove all entries in history AFTER history_index
         # add to history, set history index to last
@@ -380,7 +5033,7 @@ class FileManager:
             self.history = self.history[:self.history_index + 1]
             self.history.append(self.path)
             self.history_index = len(self.history) - 1
-            print("Added to history:", self.path)
+            tracer.instant("history_add", path=str(self.path))
 
         # Set path in navbar
         self.root.nav_frame.set_path(str(self.path))
@@ -400,58 +5053,825 @@ class FileManager:
     """
 
     def list_dir(self):
-        # TODO: fix this
-        filenames =  os.listdir(self.path)
+        '''
+        Returns the visible entries of the current path, in sort order
+        '''
+        self.listing = Listing.scan(self.path)
+
+        return self.listing.sorted_visible(self.sort_order, self.show_hidden)
+
+    # mostly called indirectly by some functions
+    # also possible to add button to call directly?
+    def refresh(self, use_cache=True, keep_view=False):
+        '''
+        1. Start reloading files from path on a worker thread, reusing a
+           cached listing if the directory did not change
+        2. FilesFrame is refreshed from poll_loader as batches arrive
+
+        With keep_view, the rows already shown stay up until the scan is
+        done and are then reconciled with it, keeping selection and scroll.
+        '''
+        self.cancel_load()
+
+        index = self.search_index
+        if index is not None and index.root != str(self.path):
+            index.cancel()
+            self.search_index = None
+
+        if self.watcher is None:
+            self.watcher = make_watcher()
+            self.root.after(FileManager.WATCH_POLL_MS, self.poll_watcher)
+
+        self.generation += 1
+        tracer.async_begin("navigate", self.generation)
+        self.keep_view = keep_view
+        cache = self.cache if use_cache else None
+        self.loader = DirLoader(
+                self.path, self.generation, self.results, cache, self.watcher,
+                load_stats=self.details or self.sort_order.key.needs_stat(),
+                index=self.index
+                )
+        self.loader.start()
+
+        self.load_keys = []
+        self.load_rows = array("I")
+        self.load_pending = []
+        self.load_finished = False
+        if not keep_view:
+            self.files = View(self.loader.listing)
+            self.clear_filter()
+            self.show(reset=True)
+
+        self.poll_id = self.root.after(FileManager.POLL_MS, self.poll_loader)
 
-        if not self.show_hidden:
-            filenames = [f for f in filenames if not f.startswith(".")]
+    def reload(self):
+        # manual reload: always rescan, but only touch rows that changed
+        self.refresh(use_cache=False, keep_view=True)
 
-        filenames.sort()
+    def trace_layout(self, generation):
+        # time until Tk is idle again, i.e. geometry and redraw are done
+        start = time.perf_counter()
 
-        files = [(f, self.to_filetype(f)) for f in filenames]
+        def idle():
+            tracer.record("layout", start, time.perf_counter() - start)
+            tracer.async_end("navigate", generation)
 
-        return files
+        self.root.after_idle(idle)
 
-    def to_filetype(self, filename):
+    def cancel_load(self):
+        if self.loader is not None:
+            tracer.async_end("navigate", self.generation)
+            self.loader.cancel()
+            self.loader = None
+
+        if self.poll_id is not None:
+            self.root.after_cancel(self.poll_id)
+            self.poll_id = None
+
+    def poll_loader(self):
         '''
-        filename is relative to current path
+        Drain finished batches into FilesFrame. Reschedules itself until
+        the current load is done; batches of older generations are dropped.
         '''
-        path = os.path.join(self.path, filename)
-        if os.path.isdir(path):
-            return FileType.DIRECTORY
-        return FileType.FILE
+        self.poll_id = None
+        if self.loader is None:
+            return
 
-    # mostly called indirectly by some functions
-    # also possible to add button to call directly?
-    def refresh(self):
+        new_files = []
+        done = False
+        reconciling = False
+        listing = self.loader.listing
+
+        try:
+            while True:
+                generation, kind, payload = self.results.get_nowait()
+                if generation != self.generation:
+                    continue
+
+                if kind == "batch":
+                    if self.keep_view:
+                        # shown all at once by reconcile
+                        continue
+                    elif self.show_hidden:
+                        new_files += payload
+                    else:
+                        new_files += [i for i in payload if not listing.is_hidden(i)]
+                elif kind == "indexed":
+                    if not self.keep_view:
+                        # the scan is reconciled with it once done, like a reload
+                        self.keep_view = True
+                        self.listing = payload
+                        self.sort_view(payload, partial(self.show_indexed, payload))
+                elif kind in ("done", "cached"):
+                    if self.keep_view:
+                        # the load ends in apply_reconcile
+                        self.reconcile(payload)
+                        new_files = []
+                        reconciling = True
+                    elif kind == "cached":
+                        self.listing = payload
+                        self.sort_view(payload, partial(self.apply_sort, payload))
+                    else:
+                        self.listing = payload
+                    done = True
+                elif kind == "error":
+                    tracer.report("Cannot list {}: {}".format(self.path, payload))
+                    done = True
+        except queue.Empty:
+            pass
+
+        if new_files:
+            with tracer.span("sort", rows=len(self.files) + len(new_files)):
+                self.merge_batch(listing, new_files)
+            self.show()
+
+        if reconciling:
+            return
+        if done and self.load_keys is None:
+            # ended by resort_load
+            self.load_finished = True
+        elif done:
+            self.end_load()
+        else:
+            self.poll_id = self.root.after(FileManager.POLL_MS, self.poll_loader)
+
+    def end_load(self):
+        self.finish_load()
+        self.loader = None
+        self.root.mark_startup("first_listing")
+        if tracer.enabled:
+            self.trace_layout(self.generation)
+
+    def show_indexed(self, listing, files):
+        if listing is not self.listing:
+            # the scan was reconciled first
+            return
+        self.files = files
+        self.show()
+        self.root.mark_startup("first_listing")
+
+    def merge_batch(self, listing, indexes):
+        '''
+        Merge newly loaded entries into self.files. The sort keys of the
+        rows loaded so far are kept in self.load_keys until the load is
+        done, so each batch only computes keys for its own entries. Only
+        the batch is sorted, then merged with the rows so far: a small
+        batch is bisected in and the runs in between copied as slices, a
+        large one is merged by timsort, which finds the two sorted runs.
+        '''
+        if self.load_keys is None:
+            self.load_pending += indexes
+            return
+
+        key = partial(self.sort_order.full_key, listing)
+        batch = sorted([(key(i), i) for i in indexes])
+
+        keys = self.load_keys
+        rows = self.load_rows
+        if not keys or keys[-1] < batch[0]:
+            keys += batch
+            rows.extend(map(operator.itemgetter(1), batch))
+        elif len(batch) * FileManager.MERGE_SPLICE_RATIO > len(keys):
+            keys += batch
+            keys.sort()
+            self.load_rows = array("I", map(operator.itemgetter(1), keys))
+        else:
+            merged_keys = []
+            merged_rows = array("I")
+            start = 0
+            for item in batch:
+                pos = bisect.bisect_right(keys, item, start)
+                merged_keys += keys[start:pos]
+                merged_rows += rows[start:pos]
+                merged_keys.append(item)
+                merged_rows.append(item[1])
+                start = pos
+            merged_keys += keys[start:]
+            merged_rows += rows[start:]
+            self.load_keys = merged_keys
+            self.load_rows = merged_rows
+
+        self.files = View(listing, self.sort_order.apply_reverse(listing, self.load_rows[:]))
+
+    def finish_load(self):
+        # the streamed order is the listing's order, keep it for sorted_visible
+        if self.load_keys and self.listing is self.loader.listing:
+            self.listing.orders[(self.sort_order.config(), self.show_hidden)] = self.load_rows
+        self.load_keys = []
+        self.load_rows = array("I")
+
+    def poll_watcher(self):
         '''
-        1. Reload fles from path
-        2. Triggers parent (FilesFrame) refresh
+        Apply coalesced watcher events as one batched update
         '''
+        self.root.after(FileManager.WATCH_POLL_MS, self.poll_watcher)
+
+        # events that arrive during a load are kept until it is done
+        if self.loader is not None:
+            return
 
-        # reload files from path
-        files = self.list_dir()
+        batch = self.watcher.drain(FileManager.WATCH_QUIET, FileManager.WATCH_MAX_DELAY)
+        if batch is None:
+            return
 
-        # TODO: getter instead?
-        self.root.files_frame.refresh(files)
+        path, names, overflow, first_event = batch
+        if path != str(self.path):
+            return
 
-        # do you upload path bar here?
-        pass
+        if overflow or len(names) > FileManager.WATCH_RESCAN_THRESHOLD:
+            # latency is recorded by reconcile once the rescan is drawn
+            self.watch_reload = (first_event, len(names))
+            self.reload()
+        else:
+            self.apply_changes(names)
+            self.record_watch_batch(first_event, len(names))
+
+    def record_watch_batch(self, first_event, size):
+        latency = time.monotonic() - first_event
+        stats = self.watch_stats
+        stats["batches"] += 1
+        stats["last_batch_size"] = size
+        stats["max_batch_size"] = max(stats["max_batch_size"], size)
+        stats["last_latency"] = latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+
+    def get_watch_stats(self):
+        stats = dict(self.watch_stats)
+        if self.watcher is not None:
+            stats.update(self.watcher.get_stats())
+        return stats
+
+    def show(self, removed=(), reset=False):
+        '''
+        Push self.files, narrowed by the filter, to FilesFrame. While a
+        recursive search or duplicates are shown, FilesFrame shows their
+        results instead.
+        '''
+        if self.search_query_id is not None or self.duplicates is not None:
+            return
+
+        files = self.files
+        if self.filter_text:
+            self.filter_view = self.filter_entries(self.files, self.filter_text)
+            files = self.filter_view
+
+        if reset:
+            self.root.files_frame.refresh(files)
+        else:
+            self.root.files_frame.update_files(files, removed)
+
+    @staticmethod
+    def filter_entries(files, text):
+        text = text.lower()
+        name = files.listing.name
+        return View(files.listing, array("I", (i for i in files.rows if text in name(i).lower())))
+
+    def set_filter(self, text):
+        '''
+        Narrow the current listing to names containing text. When the new
+        text contains the previous one, only the previous result is scanned.
+        '''
+        self.stop_search()
+        self.stop_duplicates()
+
+        previous = self.filter_text
+        self.filter_text = text
+
+        if not text:
+            self.filter_view = None
+            self.show(reset=True)
+            return
+
+        if previous and self.filter_view is not None and previous.lower() in text.lower():
+            base = self.filter_view
+        else:
+            base = self.files
+
+        self.filter_view = self.filter_entries(base, text)
+        self.root.files_frame.refresh(self.filter_view)
+
+    def clear_filter(self):
+        self.stop_search()
+        self.stop_duplicates()
+        self.filter_text = ""
+        self.filter_view = None
+        self.root.nav_frame.clear_filter()
+
+    def search(self, query):
+        '''
+        Search names in all folders below the current path. The index is
+        built once per path in the background; matches stream in while it
+        is being built.
+        '''
+        self.stop_duplicates()
+        index = self.search_index
+        if index is None or index.root != str(self.path) or index.show_hidden != self.show_hidden:
+            if index is not None:
+                index.cancel()
+            index = self.search_index = SearchIndex(self.path, self.show_hidden)
+
+        self.search_results = View(index.listing)
+        self.search_query_id = index.set_query(query)
+        self.root.files_frame.refresh(self.search_results)
+
+        if self.search_poll_id is None:
+            self.search_poll_id = self.root.after(FileManager.POLL_MS, self.poll_search)
+
+    def search_everywhere(self, query):
+        '''
+        Search names in every folder of the MetadataIndex, from the index
+        alone. Folders never listed aren't found, nor are changes made
+        since a folder was last listed.
+        '''
+        self.stop_duplicates()
+        self.index_searches += 1
+        query_id = self.search_query_id = ("index", self.index_searches)
+        self.run_in_background(partial(self.index.search, query, self.show_hidden),
+                               partial(self.show_index_results, query_id))
+
+    def show_index_results(self, query_id, listing):
+        if query_id != self.search_query_id:
+            return
+        self.search_results = View(listing, array("I", range(len(listing))))
+        self.root.files_frame.refresh(self.search_results)
+
+    def stop_search(self):
+        if self.search_query_id is None:
+            return
+
+        self.search_query_id = None
+        self.search_results = View()
+        index = self.search_index
+        if index is not None and not index.built:
+            # an unfinished index would be missing names, build it again
+            index.cancel()
+            self.search_index = None
+        if self.search_poll_id is not None:
+            self.root.after_cancel(self.search_poll_id)
+            self.search_poll_id = None
+        self.show(reset=True)
+
+    def poll_search(self):
+        self.search_poll_id = None
+        index = self.search_index
+
+        reset = None
+        added = []
+        try:
+            while True:
+                query_id, matches, is_reset = index.results.get_nowait()
+                if query_id != self.search_query_id:
+                    continue
+                if is_reset:
+                    reset = matches
+                    added = []
+                else:
+                    added += matches
+        except queue.Empty:
+            pass
+
+        if reset is not None or added:
+            name = index.listing.name
+            if reset is not None:
+                rows = array("I", sorted(reset + added, key=name))
+            else:
+                # the rows shown are sorted already, only new matches are placed
+                rows = array("I", self.search_results.rows)
+                for i in added:
+                    rows.insert(bisect.bisect_right(rows, name(i), key=name), i)
+            self.search_results = View(index.listing, rows)
+            self.root.files_frame.update_files(self.search_results)
+
+        if not index.built or not index.results.empty():
+            self.search_poll_id = self.root.after(FileManager.POLL_MS, self.poll_search)
+
+    def find_duplicates(self):
+        '''
+        Find duplicate files below the current path. Groups are shown as
+        they are found, until the next navigation or filter.
+        '''
+        self.clear_filter()
+
+        finder = self.duplicates = DuplicateFinder(self.path, self.show_hidden).start()
+        self.duplicate_results = View(finder.listing)
+        self.duplicate_groups = array("I")
+        self.root.files_frame.refresh(self.duplicate_results)
+
+        self.duplicates_poll_id = self.root.after(FileManager.JOBS_POLL_MS, self.poll_duplicates)
+
+    def cancel_duplicates(self):
+        # stop hashing, groups found so far stay shown
+        if self.duplicates is not None:
+            self.duplicates.cancel()
+
+    def stop_duplicates(self):
+        if self.duplicates is None:
+            return
+
+        self.duplicates.cancel()
+        self.duplicates = None
+        self.duplicate_results = View()
+        self.duplicate_groups = array("I")
+        if self.duplicates_poll_id is not None:
+            self.root.after_cancel(self.duplicates_poll_id)
+            self.duplicates_poll_id = None
+        self.root.set_status(None)
+        self.show(reset=True)
+
+    def poll_duplicates(self):
+        self.duplicates_poll_id = None
+        finder = self.duplicates
+
+        rows = self.duplicate_results.rows
+        groups = self.duplicate_groups
+        changed = False
+        try:
+            while True:
+                group = finder.results.get_nowait()
+                number = groups[-1] + 1 if groups else 0
+                rows.extend(group)
+                groups.extend(array("I", [number]) * len(group))
+                changed = True
+        except queue.Empty:
+            pass
+
+        if changed:
+            self.root.files_frame.update_files(self.duplicate_results)
+
+        progress = finder.progress()
+        if progress["phase"] == "scanning":
+            status = "Duplicates: {} files scanned".format(progress["files"])
+        else:
+            status = "Duplicates: {} of {} files hashed, {} groups, {} in extra copies".format(
+                    progress["hashed"], progress["candidates"], progress["groups"],
+                    format_size(progress["extra_bytes"]))
+            if progress["done"] and progress["cancelled"]:
+                status += " (cancelled)"
+        self.root.set_status(status)
+
+        if not progress["done"] or not finder.results.empty():
+            self.duplicates_poll_id = self.root.after(FileManager.JOBS_POLL_MS, self.poll_duplicates)
+
+    def duplicate_copies(self):
+        '''
+        Names of every shown duplicate but the first of its group, the ones
+        to trash to keep a single copy
+        '''
+        name = self.duplicate_results.listing.name
+        groups = self.duplicate_groups
+        return [name(index) for row, index in enumerate(self.duplicate_results.rows)
+                if row > 0 and groups[row] == groups[row - 1]]
+
+    def drop_duplicates(self, paths):
+        '''
+        Remove trashed paths from the duplicates shown, and the groups
+        left with a single file
+        '''
+        listing = self.duplicate_results.listing
+        gone = {os.path.relpath(path, listing.path) for path in paths}
+        name = listing.name
+
+        kept = [(index, group) for index, group in zip(self.duplicate_results.rows, self.duplicate_groups)
+                if name(index) not in gone]
+        counts = {}
+        for _, group in kept:
+            counts[group] = counts.get(group, 0) + 1
+        kept = [(index, group) for index, group in kept if counts[group] > 1]
+
+        self.duplicate_results = View(listing, array("I", (index for index, _ in kept)))
+        self.duplicate_groups = array("I", (group for _, group in kept))
+        self.root.files_frame.update_files(self.duplicate_results, removed=gone)
+
+    def set_sort(self, key=None, reverse=None, dirs_first=None):
+        '''
+        Change the sort order of the current listing. Only reversing flips
+        the rows in place, other changes reuse cached orders of the listing;
+        size/mtime need one stat per entry, done off the Tk thread.
+        '''
+        old = self.sort_order
+        new = SortOrder(
+                old.key if key is None else key,
+                old.reverse if reverse is None else reverse,
+                old.dirs_first if dirs_first is None else dirs_first,
+                )
+        self.sort_order = new
+
+        if self.loader is not None:
+            # the scan goes on, only what it loaded so far is re-sorted
+            self.resort_load(new.config() != old.config())
+            return
+        if self.listing is None:
+            return
+
+        if new.config() == old.config():
+            if new.reverse != old.reverse:
+                with tracer.span("sort", rows=len(self.files)):
+                    self.files = new.reverse_groups(self.files)
+                self.show()
+            return
+
+        listing = self.listing
+        self.sort_view(listing, partial(self.apply_sort, listing))
+
+    def resort_load(self, changed):
+        '''
+        The order changed during a load. Later batches are merged in the
+        new order (and stat-ed, if it needs that), the rows loaded so far
+        are re-sorted on a worker thread. Rows shown until a rescan is
+        reconciled go through sort_view.
+        '''
+        if self.sort_order.key.needs_stat():
+            self.loader.load_stats = True
+
+        if self.keep_view:
+            if self.listing is not None:
+                self.sort_view(self.listing, partial(self.apply_sort, self.listing))
+            return
+
+        listing = self.loader.listing
+        if not changed:
+            if self.load_keys is not None:
+                self.files = View(listing, self.sort_order.apply_reverse(listing, self.load_rows[:]))
+                self.show()
+            return
+        if not self.load_rows and not self.load_pending:
+            # nothing loaded yet
+            return
+
+        order = self.sort_order
+        generation = self.generation
+        rows = self.load_rows
+        self.load_keys = None
+
+        def sort():
+            key = partial(order.full_key, listing)
+            with tracer.span("sort", rows=len(rows)):
+                return sorted([(key(i), i) for i in rows])
+
+        def done(keys):
+            if generation != self.generation or order.config() != self.sort_order.config():
+                # replaced by a newer load or order
+                return
+            self.load_keys = keys
+            self.load_rows = array("I", map(operator.itemgetter(1), keys))
+            pending, self.load_pending = self.load_pending, []
+            if pending:
+                self.merge_batch(listing, pending)
+            else:
+                self.files = View(listing, self.sort_order.apply_reverse(listing, self.load_rows[:]))
+            self.show()
+            if self.load_finished:
+                self.load_finished = False
+                self.end_load()
+
+        def failed(error):
+            if generation == self.generation and order.config() == self.sort_order.config():
+                self.refresh()
+
+        self.run_in_background(sort, done, failed)
+
+    def set_details(self, active):
+        self.details = active
+        listing = self.listing
+        if active and listing is not None and self.loader is None and not listing.stats_loaded:
+            self.run_in_background(listing.load_stats, lambda _: self.show())
+
+    def sort_view(self, listing, callback):
+        '''
+        Calls callback(view) on the Tk thread with the visible entries of
+        listing in the current order. Orders the listing has cached are
+        used right away, others are sorted on a worker thread (after a stat
+        per entry if the order needs one). Dropped if the order or hidden
+        setting changed meanwhile.
+        '''
+        order = self.sort_order
+        show_hidden = self.show_hidden
+        config = (order.config(), show_hidden)
+        if config in listing.orders:
+            callback(listing.sorted_visible(order, show_hidden))
+            return
+
+        entries = (len(listing), len(listing.removed))
+        self.sorts_running += 1
+
+        def sort():
+            if order.key.needs_stat() and not listing.stats_loaded:
+                listing.load_stats()
+            with tracer.span("sort", rows=len(listing)):
+                return order.ascending(listing, listing.visible(show_hidden))
+
+        def done(ascending):
+            self.sorts_running -= 1
+            if (self.sort_order.config(), self.show_hidden) != config:
+                # a newer order was asked for
+                return
+            if (len(listing), len(listing.removed)) != entries:
+                # entries were added or removed while sorting
+                self.sort_view(listing, callback)
+                return
+            listing.orders[config] = ascending
+            # the current reverse flag, it may have changed meanwhile
+            callback(listing.sorted_visible(self.sort_order, show_hidden))
+
+        def failed(error):
+            self.sorts_running -= 1
+            # changes were only applied to the listing while sorting,
+            # rescan so the rows shown catch up
+            if listing is self.listing and self.sorts_running == 0:
+                self.reload()
+
+        self.run_in_background(sort, done, failed)
+
+    def apply_sort(self, listing, files, reset=False):
+        if listing is not self.listing:
+            # navigated away meanwhile
+            return
+        self.files = files
+        self.show(reset=reset)
+
+    def run_in_background(self, func, callback, failed=None):
+        '''
+        Run func on a worker thread, then callback(result) on the Tk thread.
+        If func raises, the error is reported and failed(error) is called
+        instead, so callers can undo their bookkeeping.
+        '''
+        def run():
+            try:
+                self.tasks.put((callback, failed, func(), None))
+            except Exception as e:
+                self.tasks.put((callback, failed, None, e))
+
+        self.tasks_running += 1
+        threading.Thread(target=run, daemon=True).start()
+        if self.tasks_poll_id is None:
+            self.tasks_poll_id = self.root.after(FileManager.POLL_MS, self.poll_tasks)
+
+    def poll_tasks(self):
+        self.tasks_poll_id = None
+        try:
+            while True:
+                callback, failed, result, error = self.tasks.get_nowait()
+                try:
+                    if error is None:
+                        callback(result)
+                    else:
+                        tracer.report("Background task failed: {!r}".format(error))
+                        if failed is not None:
+                            failed(error)
+                finally:
+                    self.tasks_running -= 1
+        except queue.Empty:
+            pass
+        finally:
+            if self.tasks_running > 0 and self.tasks_poll_id is None:
+                self.tasks_poll_id = self.root.after(FileManager.POLL_MS, self.poll_tasks)
+
+    def reconcile(self, listing):
+        '''
+        Replace the current listing with a fresh scan of the same path,
+        keyed by filename. FilesFrame keeps selection and scroll, and only
+        re-binds the visible rows. The scan is sorted and compared with the
+        rows shown on a worker thread, the load ends in apply_reconcile.
+        '''
+        old_files = self.files
+        order = self.sort_order
+        show_hidden = self.show_hidden
+        config = (order.config(), show_hidden)
+
+        def compare():
+            ascending = listing.orders.get(config)
+            if ascending is None:
+                if order.key.needs_stat() and not listing.stats_loaded:
+                    listing.load_stats()
+                with tracer.span("sort", rows=len(listing)):
+                    ascending = order.ascending(listing, listing.visible(show_hidden))
+            return ascending, FileManager.removed_names(old_files, listing)
+
+        self.run_in_background(compare, partial(self.apply_reconcile, self.generation, listing, config),
+                               partial(self.reconcile_failed, self.generation))
+
+    @staticmethod
+    def removed_names(old_files, listing):
+        '''
+        Names in old_files that listing, a fresh scan of the same directory,
+        doesn't have. Nothing is compared if the directory is unchanged
+        since old_files was read; otherwise names are compared as bytes and
+        only the missing ones are decoded.
+        '''
+        old = old_files.listing
+        if old is None or not old_files.rows:
+            return []
+        if old.validator is not None and old.validator == listing.validator:
+            return []
+
+        present = set(bytes(listing.names).split(b"\0"))
+        names = old.names
+        offsets = old.offsets
+        removed = []
+        for index in old_files.rows:
+            raw = bytes(names[offsets[index]:offsets[index + 1] - 1])
+            if raw not in present:
+                removed.append(os.fsdecode(raw))
+        return removed
+
+    def apply_reconcile(self, generation, listing, config, result):
+        if generation != self.generation:
+            # another load replaced this one
+            return
+        if config != (self.sort_order.config(), self.show_hidden):
+            # the order changed while comparing
+            self.reconcile(listing)
+            return
+        ascending, removed = result
+        listing.orders[config] = ascending
+
+        self.listing = listing
+        self.files = View(listing, self.sort_order.apply_reverse(listing, ascending[:]))
+        # any file may have changed, cached thumbnails are revalidated by mtime
+        self.root.files_frame.forget_files()
+        self.show(removed)
+
+        if self.watch_reload is not None:
+            self.record_watch_batch(*self.watch_reload)
+            self.watch_reload = None
+
+        self.end_load()
+
+    def reconcile_failed(self, generation, error):
+        # the rows shown stay as they were
+        if generation == self.generation:
+            self.watch_reload = None
+            self.end_load()
+
+    def apply_changes(self, names):
+        '''
+        Incremental update for a few known names in the current directory
+        (after mkdir/paste/rm, or from a watcher). Costs one stat per name
+        and a bisect per changed row, independent of the directory size.
+        '''
+        if self.listing is None or self.loader is not None:
+            self.reload()
+            return
+
+        names = list(dict.fromkeys(names))
+        found = self.listing.find_all(names)
+
+        # while a sort runs, only the listing is updated: the sort notices
+        # and sorts again, rows can't be placed in an order not there yet
+        sorting = self.sorts_running > 0
+
+        removed = []
+        for name in names:
+            old = found.get(name)
+            if old is not None and (sorting or self.sort_order.remove(self.files, old)):
+                removed.append(name)
 
-    def get_info(self):
+            new = self.listing.update_name(old, name)
+            if new is not None and not sorting and (self.show_hidden or not new.is_hidden()):
+                self.sort_order.insert(self.files, new)
+
+        # the listing is up to date again, keep it valid for the cache
+        self.listing.revalidate()
+
+        self.root.files_frame.forget_files([os.path.join(self.listing.path, name) for name in names])
+
+        self.show(removed)
+
+    def get_info(self, filename):
         # maybe show string?
         # filesize, permissions/owners, timestamp?
+        # filename is relative to the current path, or absolute
+        parent, name = os.path.split(os.path.normpath(os.path.join(self.path, filename)))
+        listing = self.listing if self.listing is not None and self.listing.path == parent else None
+        entry = listing.find(name) if listing is not None else None
+        if entry is None:
+            entry = Listing(parent).entry_for(name)
+
+        st = entry.stat()
         return {
-            "name": "",
-            "path": "",
-            "created_at": "",
-            "updated_at": "",
-            "size": 0,
+            "name": entry.name,
+            "path": entry.path,
+            "created_at": st.st_ctime,
+            "updated_at": st.st_mtime,
+            "size": st.st_size,
+            "mode": st.st_mode,
+            "type": entry.kind.value,
         }
 
-    def filesize(self):
-        # not sure what to return: string or int
-        pass
+    def filesize(self, filename):
+        # bytes, formatting is up to the caller
+        # blocks for directories, the UI uses dir_size() instead
+        info = self.get_info(filename)
+        if info["type"] == FileType.DIRECTORY.value:
+            return self.dir_size(info["path"]).wait()
+        return info["size"]
+
+    def dir_size(self, path):
+        '''
+        Start a recursive size computation for path, returns the DirSizer.
+        Subtree totals are shared between calls through self.size_memo
+        '''
+        return DirSizer(path, self.size_memo).start()
 
     def set_show_hidden(self, val):
         self.show_hidden = val
@@ -460,11 +5880,39 @@ class FileManager:
 
     def toggle_show_hidden(self):
         self.set_show_hidden(not self.show_hidden)
-        self.refresh()
+
+        # Filter the full listing in memory instead of rescanning
+        if self.loader is None and self.listing is not None and self.listing.path == str(self.path):
+            self.sort_view(self.listing, partial(self.apply_sort, self.listing, reset=True))
+        else:
+            self.refresh()
 
     # open file
-    def open(self):
-        pass
+    def open(self, path, filetype=None):
+        '''
+        Go into a directory, open anything else in the desktop's default
+        application (os.startfile on Windows, open on macOS, xdg-open
+        elsewhere). filetype saves a stat when the caller knows it.
+        '''
+        if filetype is None:
+            filetype = FileType.DIRECTORY if os.path.isdir(path) else FileType.FILE
+        if filetype == FileType.DIRECTORY:
+            self.goto(path)
+            return
+
+        tracer.instant("open", path=path)
+        if self.dry_run:
+            tracer.report("Dry run: would open {}".format(path))
+            return
+        try:
+            if hasattr(os, "startfile"):
+                os.startfile(path)
+            else:
+                opener = "open" if sys.platform == "darwin" else "xdg-open"
+                subprocess.Popen([opener, path], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            tracer.report("Cannot open {}: {}".format(path, e))
 
     def open_terminal(self):
         pass
@@ -472,13 +5920,22 @@ class FileManager:
 ###
 
 class Tkfm(tkinter.Tk):
-    def __init__(self):
+    def __init__(self, starting_path=None, index=None):
+        '''
+        index: optional MetadataIndex
+        '''
+        # startup milestones, seconds since __init__
+        self.started_at = time.perf_counter()
+        self.startup = {}
+
         super().__init__()
 
         # TODO: use Path.cwd() or config file?
-        starting_path = Path.home()
+        if starting_path is None:
+            starting_path = Path.home()
+        starting_path = Path(starting_path)
 
-        self.fm = FileManager(self, starting_path)
+        self.fm = FileManager(self, starting_path, index)
 
         # UI
 
@@ -486,7 +5943,6 @@ class Tkfm(tkinter.Tk):
         self.geometry('{}x{}'.format(800, 400))
         self.nav_frame = NavFrame(self, str(starting_path))
         self.nav_frame.grid(row=0, column=0, columnspan=2, sticky="w")
-        self.nav_frame.update()
 
         # Side frame
         self.side_frame = SideFrame(self)
@@ -495,20 +5951,34 @@ class Tkfm(tkinter.Tk):
         # Files frame
         # Create canvas and scrollbar
         self.files_frame_canvas = FilesFrameCanvas(self)
-        self.files_frame_canvas.grid(row=1,column=1, sticky="w")
+        self.files_frame_canvas.grid(row=1,column=1, sticky="nsew")
         self.files_frame = self.files_frame_canvas.files_frame
 
         # Let files frame expand to available space
         self.grid_columnconfigure(1, weight=1)
+        self.grid_rowconfigure(1, weight=1)
 
-        # Refresh fm after UI is done. TODO: maybe better workflow?
+        # Listing starts on its worker thread now, rows are drawn as they
+        # arrive after the window is up
         self.fm.refresh()
 
-        self.files_frame.update()
-        self.files_frame_canvas.config(scrollregion=self.files_frame_canvas.bbox("all"))
+        self.bind("<Expose>", self.on_first_expose, "+")
+
+        if tracer.enabled:
+            self.lag_monitor = LagMonitor(self)
+            self.lag_monitor.start()
 
         # Keyboard Shortcuts
         self.bind('<Command-g>', lambda _: self.fm.toggle_show_hidden())
+        self.bind('<F5>', lambda _: self.fm.reload())
+        self.bind('<Command-c>', lambda _: self.fm.copy(self.files_frame.selected_paths()))
+        self.bind('<Command-x>', lambda _: self.fm.cut(self.files_frame.selected_paths()))
+        self.bind('<Command-v>', lambda _: self.fm.paste())
+        self.bind('<Delete>', self.on_delete)
+        self.bind('<Command-a>', lambda _: self.files_frame.select_all())
+        self.bind('<Command-d>', lambda _: self.files_frame.set_details(not self.files_frame.details.active))
+        self.bind('<Escape>', lambda _: self.files_frame.deselect_all())
+        self.bind('<Command-period>', lambda _: self.fm.cancel_duplicates())
         self.bind('<Command-q>', self.quit)
 
 
@@ -516,11 +5986,38 @@ class Tkfm(tkinter.Tk):
         # self.attributes('-topmost',True)
         # self.after_idle(self.on_idle)
         self.lift()
-        self.update()
+
+        self.mark_startup("init")
 
     def get_fm(self):
         return self.fm
 
+    def mark_startup(self, name):
+        '''
+        Record a startup milestone once: init, first_paint, first_listing
+        '''
+        if name in self.startup:
+            return
+        elapsed = time.perf_counter() - self.started_at
+        self.startup[name] = elapsed
+        if tracer.enabled:
+            tracer.record("startup_" + name, self.started_at, elapsed)
+
+    def on_first_expose(self, event):
+        self.mark_startup("first_paint")
+        self.unbind("<Expose>")
+
+    def on_delete(self, event):
+        # root bindings also fire in the path and filter boxes, where
+        # Delete edits text
+        if isinstance(self.focus_get(), tkinter.Entry):
+            return
+        self.fm.rm(self.files_frame.selected_paths())
+
+    def set_status(self, text):
+        # progress of background jobs, shown in the title for now
+        self.title("tkfm - " + text if text else "tkfm")
+
 
     def quit(self, event):
         self.quit()
@@ -539,13 +6036,41 @@ Icons = {
     "FILE": "R0lGODlhIAAgAPYAAAAAADMzM0tLS0xMTE5OTk9PT1BQUFFRUVJSUlNTU1RUVFVVVVZWVldXV1hYWFlZWVpaWltbW1xcXF1dXWBgYGNjY2RkZGZmZmhoaGpqamtra21tbW9vb3BwcHJycnNzc3Z2dnd3d3p6en19fYCAgIGBgYODg4SEhIaGhoiIiImJiYuLi4yMjI6Ojo+Pj5CQkJKSkpOTk5aWlpmZmZycnJ6enrCwsLGxsbu7u7y8vL29vb6+vr+/v8DAwMHBwcLCwsPDw8TExMbGxsfHx8jIyNra2tvb29zc3N3d3d7e3t/f3+Dg4OHh4eLi4uPj4+Tk5OXl5ebm5ufn5+jo6Onp6erq6uvr6+zs7O3t7e7u7u/v7/Dw8PHx8fLy8vPz8/T09PX19fb29vf39/j4+Pn5+fr6+vv7+/z8/P39/f7+/gAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACH5BAEAAAAALAAAAAAgACAAAAf+gACCg4SFhoeIiYqLgzMzNDU0MzIxLiwpJyUjIiAeHBoYFhaJMmhoaWVppqZnrWavZbFks2MViDFoR0hFUEpKS0zBTcNNTsbGTWMTiDBpSElFUUvATMPHT9jZTsqIL2lJSkZRTDo45jg56eo5PFBPYxKILWi+R1LWTthQ+1H9/lDwEK2gtwTJlCY71ulYyFBHDylRxkRApAINsCRT8vGLIqXjlI8gp4yBgAgFmmpJqDzhkYPhjpcwd/igQmXMA0QmTtpgUgVKPykfaVKpQrRolTEOEJE400RalSg9dMDkQbUqjx9WrIxpgGjEmXw8OU6hWSWrlSto014ZswCRiK/+T5hYkeLjpVUePfL2AIIFyxgFiEKYeQKFyZWxQ89e6ZulseMsYxAg+jC48GEfVfX28MHZRxAtWsYYQNTBjM8mWBIvxpIF9JbXsLeIIYBog+koqFWz1vKai+/fsgcgylCGoxMsVX7g3cz5h/MfQIR04SJGAKILxW9AQX529xYuXbx4+fJFfJfqiCoUr3LcCpC8zaEDmQ9kSHn0hyiQ4fgkS/fW34X3BRhhhAEGGF/gZ8gE+03Rn3vwOUdfEBQSgaCChTxABlAPLsYbeOMRKMYYYhiIISEMjMGhf+/FN98QI5JoonWHJDBGFA76t1gWAYYYhhglXkijIQXcmON/vAkpeGCBBiY4ZCEHlBiGFyQCaeWVWAJ5QCIMdOnll2CG2UAAjJRp5plmBgIAOw=="
 }
 
-app = Tkfm()
-
-# hack
-while True:
-    try:
-        app.mainloop()
-        break
-    except UnicodeDecodeError:
-        pass
+icon_registry = IconRegistry(Icons)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tk file manager")
+    parser.add_argument("path", nargs="?", help="starting directory")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write a Chrome trace-event file, or 'summary' for a table at exit")
+    parser.add_argument("--index", nargs="?", metavar="FILE", const="", default=os.environ.get("TKFM_INDEX"),
+                        help="keep a SQLite index of listed folders, by default in "
+                             + MetadataIndex.default_path())
+    parser.add_argument("--index-max-entries", type=int, default=MetadataIndex.DEFAULT_MAX_ENTRIES,
+                        help="entries kept in the index, least recently listed folders are dropped")
+    parser.add_argument("--index-max-dir-entries", type=int, default=MetadataIndex.DEFAULT_MAX_DIR_ENTRIES,
+                        help="bigger folders are not indexed")
+    args = parser.parse_args()
+
+    if args.trace:
+        tracer.enable(args.trace)
+
+    index = None
+    if args.index is not None:
+        index = MetadataIndex(args.index or None, args.index_max_entries, args.index_max_dir_entries)
+        # queued writes are finished at exit
+        atexit.register(index.close)
+
+    app = Tkfm(args.path, index)
+
+    # hack
+    while True:
+        try:
+            app.mainloop()
+            break
+        except UnicodeDecodeError:
+            pass
 